@@ -0,0 +1,195 @@
+"""
+Synthetic course collections for the benchmarks, and a local server for
+their data. The size of the collection is set on the command line:
+
+    pytest benchmarks --notebooks 20 --cells 100 --assets 10 --output-size 100k
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import base64
+import functools
+import json
+import os
+import random
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+
+from kosu import __version__
+from kosu.kosu import KOSU
+from kosu.data import parse_size
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('kosu', "Size of the synthetic course collection")
+    group.addoption('--courses', type=int, default=2, help="Courses in the collection. Default: 2.")
+    group.addoption('--notebooks', type=int, default=8, help="Notebooks in each course. Default: 8.")
+    group.addoption('--cells', type=int, default=50, help="Cells in each notebook. Default: 50.")
+    group.addoption('--assets', type=int, default=8, help="Images, and data files, in each course. Default: 8.")
+    group.addoption('--output-size', default='20k', help="Size of each image output in the notebooks. Default: 20k.")
+    group.addoption('--data-size', default='1M', help="Size of each data file. Default: 1M.")
+
+
+def pytest_benchmark_update_json(config, benchmarks, output_json):
+    """
+    Keep the kosu version and the size of the collection with the results,
+    so runs on different versions can be compared like for like.
+    """
+    output_json['kosu'] = __version__
+    output_json['collection'] = sizes(config)
+
+
+def sizes(config):
+    return {name: config.getoption(name) for name in ['courses', 'notebooks', 'cells', 'assets', 'output_size', 'data_size']}
+
+
+def make_notebook(cells, images, data_files, data_url, output_size, seed=0):
+    """
+    Make a notebook with markdown and code cells, some of them tagged, with
+    references to the images and data, and big image outputs.
+
+    Returns:
+        dict. The notebook.
+    """
+    rng = random.Random(seed)
+    png = base64.b64encode(rng.randbytes(output_size) if hasattr(rng, 'randbytes') else os.urandom(output_size)).decode()
+    nb_cells = []
+    for i in range(cells):
+        image, data_file = images[i % len(images)], data_files[i % len(data_files)]
+        tags = [['exercise'], ['info'], ['hide'], [], []][i % 5]
+        if i % 2:
+            nb_cells.append({
+                'cell_type': 'code', 'execution_count': i, 'metadata': {'tags': tags},
+                'source': [f"data = load('../data/{data_file}')\n", f"url = '{data_url}{data_file}'\n", "plot(data)"],
+                'outputs': [
+                    {'output_type': 'stream', 'name': 'stdout', 'text': [f"{n} {rng.random()}\n" for n in range(20)]},
+                    {'output_type': 'display_data', 'metadata': {},
+                     'data': {'image/png': png, 'text/plain': ['<Figure>']}},
+                ],
+            })
+        else:
+            nb_cells.append({
+                'cell_type': 'markdown', 'metadata': {'tags': tags},
+                'source': [f"## Section {i}\n", "Some text about the data.\n", f"![](../images/{image})"],
+            })
+    return {
+        'cells': nb_cells,
+        'metadata': {'kernelspec': {'display_name': 'Python 3', 'language': 'python', 'name': 'python3'}},
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+
+
+def make_collection(root, data_url, courses=2, notebooks=8, cells=50, assets=8, output_size=20_000, data_size=1_000_000):
+    """
+    Make a course collection like the one `kosu init` makes, with
+    `courses` courses of `notebooks` notebooks each, all of `cells` cells,
+    and `assets` images and data files for each course.
+
+    Returns:
+        dict. The .kosu.yaml settings, the course names, and the data files
+            by name.
+    """
+    for folder in ['notebooks', 'images', 'references', 'scripts', 'templates']:
+        (root / folder).mkdir(exist_ok=True)
+    include = KOSU['path'] / 'include'
+    (root / 'templates' / 'README.md').write_bytes((include / 'README.md').read_bytes())
+    (root / 'environment.yaml').write_bytes((include / 'environment.yaml').read_bytes())
+    (root / 'references' / 'useful.pdf').write_bytes((include / 'useful.pdf').read_bytes())
+    (root / 'scripts' / 'example.py').write_bytes((include / 'example.py').read_bytes())
+
+    data, names = {}, []
+    for c in range(courses):
+        course = f'course_{c}'
+        images = [f'{course}_image_{k}.png' for k in range(assets)]
+        data_files = [f'{course}_data_{k}.csv' for k in range(assets)]
+        for image in images:
+            (root / 'images' / image).write_bytes(os.urandom(output_size))
+        for data_file in data_files:
+            row = b'1.0,2.0,3.0,4.0\n'
+            data[data_file] = row * (data_size // len(row))
+        nbs = [f'{course}_notebook_{n}.ipynb' for n in range(notebooks)]
+        for n, nb in enumerate(nbs):
+            notebook = make_notebook(cells, images[n:] + images[:n], data_files[n:] + data_files[:n],
+                                     data_url, output_size, seed=n)
+            with open(root / 'notebooks' / nb, 'w') as f:
+                json.dump(notebook, f)
+        config = {
+            'title': f'Course {c}',
+            'data_url': data_url,
+            'data': data_files,
+            'scripts': ['example.py'],
+            'references': ['useful.pdf'],
+            'curriculum': {1: nbs[:-2]},
+            'extras': nbs[-2:-1],
+            'demos': nbs[-1:],
+        }
+        with open(root / f'{course}.yaml', 'w') as f:
+            yaml.safe_dump(config, f)
+        names.append(course)
+
+    settings = {
+        'notebooks-source': 'notebooks', 'notebooks-target': 'notebooks',
+        'master-target': 'master', 'demos-target': 'demos',
+        'references-source': 'references', 'references-target': 'references',
+        'scripts-source': 'scripts', 'images-source': 'images', 'images-target': 'images',
+        'cache-size': 0,  # Really process the notebooks every time.
+        'data-cache': False,  # Really download the data every time.
+        'url-cache-ttl': 0,  # Really check the URLs every time.
+        'data-url-stems': [data_url],
+        's3-bucket': 'kosu-benchmark',
+        'all': names,
+    }
+    with open(root / '.kosu.yaml', 'w') as f:
+        yaml.safe_dump(settings, f)
+    return {'settings': settings, 'courses': names, 'data': data}
+
+
+class Handler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def collection(tmp_path_factory, request):
+    """
+    A synthetic course collection, whose data is served from a local server.
+    """
+    options = sizes(request.config)
+    root = tmp_path_factory.mktemp('collection')
+    served = tmp_path_factory.mktemp('served')
+    handler = functools.partial(Handler, directory=str(served))
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    url = f'http://127.0.0.1:{httpd.server_address[1]}/data/'
+    made = make_collection(root, url,
+                           courses=options['courses'],
+                           notebooks=options['notebooks'],
+                           cells=options['cells'],
+                           assets=options['assets'],
+                           output_size=parse_size(options['output_size']),
+                           data_size=parse_size(options['data_size']),
+                           )
+    (served / 'data').mkdir()
+    for name, data in made['data'].items():
+        (served / 'data' / name).write_bytes(data)
+    made['root'] = root
+    yield made
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def project(collection, monkeypatch):
+    """
+    Work in the collection, with its settings in place of kosu's own.
+    """
+    monkeypatch.chdir(collection['root'])
+    for key, value in collection['settings'].items():
+        monkeypatch.setitem(KOSU, key, value)
+    return collection
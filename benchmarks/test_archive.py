@@ -0,0 +1,33 @@
+"""
+Writing the ZIP file for a course.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import os
+import zipfile
+
+import pytest
+
+from kosu.kosu import build_course
+from kosu.archive import write_zip
+
+
+@pytest.fixture
+def built(project):
+    course = project['courses'][0]
+    _ = build_course(course, clean=False, zip=False, upload=False, clobber=True)
+    return course
+
+
+@pytest.mark.benchmark(group='write_zip')
+@pytest.mark.parametrize('level', [0, 6])
+def test_write_zip(benchmark, built, level):
+    def setup():
+        if os.path.exists(f'{built}.zip'):
+            os.remove(f'{built}.zip')
+
+    zipped, _ = benchmark.pedantic(write_zip, args=(built, 'build', built), kwargs={'level': level},
+                                   setup=setup, rounds=5)
+    with zipfile.ZipFile(zipped) as z:
+        assert z.testzip() is None
@@ -0,0 +1,27 @@
+"""
+Downloading a course's data from a local server.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import shutil
+
+import pytest
+
+from kosu.kosu import build_data, load_course
+
+
+@pytest.mark.benchmark(group='build_data')
+@pytest.mark.parametrize('connections', [1, 8])
+def test_build_data(benchmark, project, tmp_path, connections):
+    config = load_course(project['courses'][0])
+    path = tmp_path / config['course']
+
+    def setup():
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir()
+
+    benchmark.pedantic(build_data, args=(path, config), kwargs={'connections': connections},
+                       setup=setup, rounds=5)
+    for fname in config['data']:
+        assert (path / 'data' / fname).stat().st_size == len(project['data'][fname])
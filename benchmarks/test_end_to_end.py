@@ -0,0 +1,18 @@
+"""
+Testing every course in the collection, as `kosu test --all` does.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import pytest
+from click.testing import CliRunner
+
+from kosu import cli
+
+
+@pytest.mark.benchmark(group='kosu test --all')
+@pytest.mark.parametrize('jobs', ['1', '0'])
+def test_all(benchmark, project, jobs):
+    runner = CliRunner()
+    result = benchmark.pedantic(runner.invoke, args=(cli, ['test', '--all', '--jobs', jobs]), rounds=3)
+    assert result.exit_code == 0, result.output
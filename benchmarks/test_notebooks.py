@@ -0,0 +1,38 @@
+"""
+Processing notebooks, one at a time and a course at a time.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import shutil
+
+import pytest
+
+from kosu.kosu import build_notebooks, load_course
+from kosu.customize import process_notebook
+
+
+@pytest.mark.benchmark(group='process_notebook')
+@pytest.mark.parametrize('stream', [False, True])
+def test_process_notebook(benchmark, project, tmp_path, stream):
+    config = load_course(project['courses'][0])
+    infile = f"notebooks/{config['curriculum'][1][0]}"
+    refs = benchmark(process_notebook, infile, tmp_path / 'out.ipynb', kernel='kosu',
+                     master=tmp_path / 'master.ipynb', data_url_stems=project['settings']['data-url-stems'],
+                     stream=stream)
+    assert refs[0] and refs[1] and refs[2]
+
+
+@pytest.mark.benchmark(group='build_notebooks')
+@pytest.mark.parametrize('jobs', [1, 0])
+def test_build_notebooks(benchmark, project, tmp_path, jobs):
+    config = load_course(project['courses'][0])
+    path = tmp_path / config['course']
+
+    def setup():
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir()
+
+    *_, data_urls, data_files = benchmark.pedantic(build_notebooks, args=(path, config), kwargs={'jobs': jobs},
+                                                   setup=setup, rounds=5)
+    assert set(data_files) == set(config['data'])
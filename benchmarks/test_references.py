@@ -0,0 +1,50 @@
+"""
+Finding references in the notebooks that come with kosu: one scan with the
+combined pattern, against one scan per kind of reference, which is how it
+used to be done.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import json
+import re
+
+import pytest
+
+from kosu.kosu import KOSU
+from kosu.customize import _cell_texts
+from kosu.references import find_references, reference_pattern
+
+
+def separate(texts):
+    refs = {'images': [], 'data_urls': [], 'data_files': []}
+    for text in texts:
+        refs['images'] += re.findall(r"\.\./images/([-_.a-zA-Z0-9]+)", text)
+        refs['data_files'] += re.findall(r"\.\./data/([-_.a-zA-Z0-9]+)", text)
+        refs['data_urls'] += re.findall(r"(https://geocomp\.s3\.amazonaws\.com/data/[-_.a-zA-Z0-9]+)", text)
+    return refs
+
+
+def combined(texts):
+    pattern = reference_pattern()
+    refs = None
+    for text in texts:
+        refs = find_references(text, pattern, refs)
+    return refs
+
+
+@pytest.fixture(scope='module')
+def texts():
+    texts = []
+    for fname in sorted((KOSU['path'] / 'include').glob('*.ipynb')):
+        with open(fname, encoding='utf-8') as f:
+            for cell in json.load(f)['cells']:
+                texts.extend(_cell_texts(cell))
+    return texts
+
+
+@pytest.mark.benchmark(group='references')
+@pytest.mark.parametrize('func', [separate, combined])
+def test_find_references(benchmark, texts, func):
+    refs = benchmark(func, texts)
+    assert refs == separate(texts)
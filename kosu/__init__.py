@@ -2,16 +2,32 @@ from .kosu import *
 from .customize import *
 
 
-from pkg_resources import get_distribution, DistributionNotFound
-try:
-    VERSION = get_distribution(__name__).version
-except DistributionNotFound:
+def get_version():
+    """
+    The installed version of kosu, or the one setuptools_scm wrote into
+    _version.py when it isn't installed.
+    """
+    from importlib.metadata import version, PackageNotFoundError
     try:
-        from ._version import version as VERSION
-    except ImportError:
-        raise ImportError(
-            "Failed to find (autogenerated) _version.py. "
-            "This might be because you are installing from GitHub's tarballs, "
-            "use the PyPI ones."
-            )
-__version__ = VERSION
+        return version(__name__)
+    except PackageNotFoundError:
+        try:
+            from ._version import version
+            return version
+        except ImportError:
+            raise ImportError(
+                "Failed to find (autogenerated) _version.py. "
+                "This might be because you are installing from GitHub's tarballs, "
+                "use the PyPI ones."
+                )
+
+
+def __getattr__(name):
+    """
+    Look up the version when it's first asked for, instead of on import,
+    since reading the package metadata is slow.
+    """
+    if name in ['VERSION', '__version__']:
+        globals()['VERSION'] = globals()['__version__'] = get_version()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
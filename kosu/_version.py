@@ -0,0 +1,5 @@
+# coding: utf-8
+# file generated by setuptools_scm
+# don't change, don't track in version control
+version = '0.1.dev1+g0d0fc93'
+version_tuple = (0, 1, 'dev1+g0d0fc93')
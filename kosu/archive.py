@@ -0,0 +1,216 @@
+"""
+Making and updating the course ZIP files.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import collections
+import copy
+import os
+import pathlib
+import struct
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Types that are already compressed, so are stored in the ZIP as they are.
+STORED_SUFFIXES = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.pdf', '.zip', '.gz', '.tgz',
+                   '.bz2', '.xz', '.zst', '.7z', '.rar', '.npz', '.parquet', '.mp3', '.mp4', '.mov'}
+STREAM_SIZE = 64 * 1024 * 1024  # Bigger files are compressed as they are written.
+WINDOW = 256 * 1024 * 1024  # The most bytes of files to read ahead of writing.
+
+
+def zip_members(root_dir, base_dir, sources=None):
+    """
+    List the directories and files to put in the archive, in the same way
+    as `shutil.make_archive()`, with their size and modification time.
+
+    Args:
+        root_dir (path): The directory the archive is relative to.
+        base_dir (path): The directory to archive, relative to `root_dir`.
+        sources (dict): Files to take from elsewhere, mapping archive name
+            to path. They are listed as if they were in `root_dir`.
+
+    Returns:
+        dict. Maps archive name to (path, [size, mtime_ns]).
+    """
+    root_dir = pathlib.Path(root_dir)
+    sources = sources or {}
+    extra = {}
+    for arcname in sources:
+        parent, _, name = arcname.rpartition('/')
+        extra.setdefault(parent, set()).add(name)
+
+    members = {}
+    for dirpath, dirnames, filenames in os.walk(root_dir / base_dir):
+        dirnames.sort()
+        dirpath = pathlib.Path(dirpath)
+        dirname = dirpath.relative_to(root_dir).as_posix()
+        for name in [''] + sorted(set(filenames) | extra.get(dirname, set())):
+            arcname = f'{dirname}/{name}'
+            path = pathlib.Path(sources.get(arcname, dirpath / name))
+            stat = path.stat()
+            members[arcname] = (path, [stat.st_size, stat.st_mtime_ns])
+    return members
+
+
+def append_raw(zout, info, data=None, zin=None):
+    """
+    Add a member that is already compressed to an open archive: either
+    `data`, or the member's compressed bytes in another open archive, `zin`.
+    This is the only function that uses the internals of `zipfile`.
+
+    The member's header is always written without ZIP64 fields, so it must
+    be smaller than `zipfile.ZIP64_LIMIT`, compressed or not. Its offset
+    can be bigger, since `zipfile` writes that in the central directory.
+    """
+    if max(info.file_size, info.compress_size) >= zipfile.ZIP64_LIMIT:
+        raise ValueError(f"{info.filename} is too big to write without ZIP64.")
+    if zin is not None:
+        zin.fp.seek(info.header_offset)
+        header = zin.fp.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        zin.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    info = copy.copy(info)
+    info.flag_bits &= ~0x08  # The sizes go in the header, not after the data.
+    info.extra = zipfile._strip_extra(info.extra, (1,))  # Any old ZIP64 fields.
+    info.header_offset = zout.fp.tell()
+    zout.fp.write(info.FileHeader(zip64=False))
+    if zin is None:
+        zout.fp.write(data)
+    else:
+        remaining = info.compress_size
+        while remaining:
+            chunk = zin.fp.read(min(remaining, 1 << 20))
+            zout.fp.write(chunk)
+            remaining -= len(chunk)
+    zout.filelist.append(info)
+    zout.NameToInfo[info.filename] = info
+    zout.start_dir = zout.fp.tell()
+    return
+
+
+def copy_raw(zin, zout, info):
+    """
+    Copy a member from one open archive to another without decompressing
+    and recompressing it.
+    """
+    append_raw(zout, info, zin=zin)
+    return
+
+
+def compression_type(arcname, level):
+    """
+    How to compress a member: not at all if the level is 0 or the file is
+    of a type that is already compressed, otherwise with deflate.
+    """
+    if level == 0 or pathlib.Path(arcname).suffix.lower() in STORED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def compress(path, arcname, level):
+    """
+    Read and compress a file, ready to be written into an archive.
+
+    Returns:
+        tuple. The member's `ZipInfo` and its compressed bytes.
+    """
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    info.compress_type = compression_type(arcname, level)
+    with open(path, 'rb') as f:
+        data = f.read()
+    info.file_size, info.CRC = len(data), zlib.crc32(data)
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    info.compress_size = len(data)
+    return info, data
+
+
+def write_zip(zip_name, root_dir, base_dir, previous=None, level=6, jobs=None, sources=None):
+    """
+    Make a ZIP of `root_dir/base_dir`, like `shutil.make_archive()`, but
+    faster. Files that are already compressed, like images and PDFs, are
+    stored as they are. The others are compressed by several threads at
+    once and written into the ZIP in order; only very large files are
+    compressed as they are written.
+
+    If the ZIP already exists, members whose files have the same size and
+    modification time as recorded in `previous` are copied across as they
+    are, instead of being compressed again. Members that no longer exist
+    are left out. The new ZIP replaces the old one only when it is complete.
+
+    Args:
+        zip_name (str): The name of the ZIP file, without the extension.
+        root_dir (path): The directory the archive is relative to.
+        base_dir (path): The directory to archive, relative to `root_dir`.
+        previous (dict): The record returned when the ZIP was last made.
+        level (int): The deflate level, from 0 (store everything) to 9.
+        jobs (int): How many threads to compress with.
+        sources (dict): Files to take straight from where they are instead
+            of from `root_dir`, mapping archive name to path.
+
+    Returns:
+        tuple. The path of the ZIP file, and the record to pass as
+            `previous` next time.
+    """
+    zip_path = pathlib.Path(f"{zip_name}.zip").resolve()
+    previous = previous or {}
+    jobs = jobs or min(32, (os.cpu_count() or 1) + 4)
+    members = zip_members(root_dir, base_dir, sources=sources)
+    record = {arcname: stat for arcname, (_, stat) in members.items()}
+
+    old = None
+    if previous and zip_path.exists():
+        old = zipfile.ZipFile(zip_path)
+        if record == previous:
+            old.close()
+            return str(zip_path), record
+
+    tmp = zip_path.with_name(f".{zip_path.name}.tmp")
+    try:
+        with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=level) as zout, \
+             ThreadPoolExecutor(max_workers=jobs) as executor:
+            # Compressing runs ahead of writing, but only by so many bytes, as
+            # the files being compressed, and waiting to be written, are held
+            # in memory.
+            pending, held = collections.deque(), 0
+
+            def drain(limit):
+                nonlocal held
+                while pending and held > limit:
+                    arcname, path, job, size = pending.popleft()
+                    held -= size
+                    if job is None:
+                        zout.write(path, arcname, compress_type=compression_type(arcname, level))
+                    elif isinstance(job, zipfile.ZipInfo):
+                        copy_raw(old, zout, job)
+                    else:
+                        info, data = job.result()
+                        append_raw(zout, info, data=data)
+
+            for arcname, (path, stat) in members.items():
+                info = old.NameToInfo.get(arcname) if old else None
+                unchanged = (info is not None) and (previous.get(arcname) == stat)
+                if unchanged and info.compress_size < zipfile.ZIP64_LIMIT and info.file_size < zipfile.ZIP64_LIMIT:
+                    pending.append((arcname, path, info, 0))
+                elif arcname.endswith('/') or stat[0] > STREAM_SIZE:
+                    pending.append((arcname, path, None, 0))
+                else:
+                    pending.append((arcname, path, executor.submit(compress, path, arcname, level), stat[0]))
+                    held += stat[0]
+                drain(WINDOW)
+            drain(-1)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    finally:
+        if old is not None:
+            old.close()
+    os.replace(tmp, zip_path)
+
+    return str(zip_path), record
@@ -0,0 +1,106 @@
+"""
+Putting files into the build without copying their bytes, where the
+filesystem allows it: by reflinking, or, if asked to, by hardlinking or
+symlinking, and only copying as a last resort. Hardlinks and symlinks are
+never the default, because editing a file in the build in place would
+then change its source, or a cache entry that later builds reuse.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import os
+import pathlib
+import shutil
+
+
+FICLONE = 0x40049409  # From linux/fs.h.
+
+# Ways of placing files; 'auto' means reflink, else copy.
+METHODS = ['auto', 'hardlink', 'reflink', 'symlink', 'copy']
+
+
+def reflink(src, dst):
+    """
+    Make `dst` a copy-on-write clone of `src`, on filesystems that can do
+    it (e.g. Btrfs, XFS). Raises OSError if that isn't possible.
+    """
+    import fcntl  # Not on Windows, but then neither is FICLONE.
+
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dst)
+            raise
+    return
+
+
+def place(src, dst, method='auto'):
+    """
+    Put the file at `src` at `dst` too. Whatever the method, the file is
+    copied if the filesystem can't do it. Anything already at `dst` is
+    removed first, so that we never write through a hardlink into the
+    source.
+
+    Args:
+        src (path): The file.
+        dst (path): Where to put it.
+        method (str): One of `METHODS`. Default: 'auto'.
+
+    Returns:
+        str. How the file was placed: 'hardlink', 'reflink', 'symlink'
+            or 'copy'.
+    """
+    if method not in METHODS:
+        raise Exception(f"Cannot place files by {method!r}; use one of {', '.join(METHODS)}.")
+    dst = pathlib.Path(dst)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    if method == 'symlink':
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return 'symlink'
+        except OSError:
+            pass
+    if method == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    if method in ['auto', 'reflink']:
+        try:
+            reflink(src, dst)
+            return 'reflink'
+        except (OSError, ImportError):
+            pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def place_once(src, dst, placed, key, method='auto'):
+    """
+    Place a file in the build, but if a file with the same contents is
+    already in the build, place it from that instead. So even when the
+    source can't be linked to, for example because it is on another
+    filesystem, its bytes are only copied from there once.
+
+    Args:
+        src (path): The file.
+        dst (path): Where to put it.
+        placed (dict): Where each file has been placed already, by key.
+            This is updated.
+        key (str): What identifies the file's contents, such as its hash.
+        method (str): One of `METHODS`. Files are never placed from each
+            other if it is 'copy' or 'symlink'.
+
+    Returns:
+        str. How the file was placed.
+    """
+    first = placed.get(key)
+    if (first is not None) and (method not in ['copy', 'symlink']) and os.path.isfile(first):
+        return place(first, dst, method)
+    how = place(src, dst, method)
+    placed[key] = str(dst)
+    return how
@@ -0,0 +1,174 @@
+"""
+A content-addressed cache of processed notebooks, so that a notebook used
+by many courses, or built many times, is only processed once.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+from .assets import place
+from .customize import CELL_TRANSFORMS, process_notebook
+
+
+CACHE_DIR = pathlib.Path('build') / '.kosu-cache'
+CACHE_SIZE = 1000  # MB
+
+
+def cache_key(infile, **kwargs):
+    """
+    Make the key for a notebook from its bytes, the options that are passed
+    to `process_notebook()`, the cell transforms, and the kosu version
+    (since the processing itself might change between versions).
+
+    Returns:
+        str. A SHA-256 hex digest.
+    """
+    from . import __version__
+
+    h = hashlib.sha256()
+    with open(infile, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    h.update(' '.join(f'{t.__module__}.{t.__qualname__}' for t in CELL_TRANSFORMS).encode())
+    h.update(__version__.encode())
+    return h.hexdigest()
+
+
+def cached_process_notebook(infile, outfile, cache_dir=CACHE_DIR, master=None, **kwargs):
+    """
+    Same as `process_notebook()`, but the outputs and the references it
+    finds are stored in the cache. On a hit, the files are just reflinked
+    or copied from the cache; never hardlinked, since the notebooks in a
+    build are often edited in place.
+
+    Args:
+        infile (path): The notebook to process.
+        outfile (path): Where to write the processed notebook.
+        cache_dir (path): The cache directory.
+        master (path): Where to write the stripped master copy, if anywhere.
+        **kwargs: Passed on to `process_notebook()`.
+
+    Returns:
+        tuple. Lists of images, data URLs and data files.
+    """
+    if kwargs.get('clear_input'):
+        # This changes the input file, so it has to really happen.
+        return process_notebook(infile, outfile, master=master, **kwargs)
+
+    cache_dir = pathlib.Path(cache_dir)
+    entry = cache_dir / cache_key(infile, **kwargs)
+    if not entry.is_dir():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-'))
+        refs = process_notebook(infile, tmp / 'notebook.ipynb', master=tmp / 'master.ipynb', **kwargs)
+        with open(tmp / 'refs.json', 'w') as f:
+            json.dump(refs, f)
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # Another job got there first; its entry is just as good.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # Touching the entry is what makes the eviction least-recently-used.
+    os.utime(entry)
+    _ = place(entry / 'notebook.ipynb', outfile)
+    if master is not None:
+        _ = place(entry / 'master.ipynb', master)
+    with open(entry / 'refs.json') as f:
+        images, data_urls, data_files = json.load(f)
+
+    return images, data_urls, data_files
+
+
+def cached_refs(infile, cache_dir=CACHE_DIR, **kwargs):
+    """
+    Look up the references that `cached_process_notebook()` found in a
+    notebook, if it is in the cache, without using the entry.
+
+    Returns:
+        list. Lists of images, data URLs and data files, or None if the
+            notebook is not in the cache.
+    """
+    if kwargs.get('clear_input'):
+        return None
+    try:
+        with open(pathlib.Path(cache_dir) / cache_key(infile, **kwargs) / 'refs.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def cache_entries(cache_dir=CACHE_DIR):
+    """
+    List the cache entries with their size in bytes and their last use.
+
+    Returns:
+        list. Tuples of (path, bytes, time), least recently used first.
+    """
+    cache_dir = pathlib.Path(cache_dir)
+    if not cache_dir.is_dir():
+        return []
+    entries = []
+    for entry in cache_dir.iterdir():
+        if entry.name.startswith('.') or not entry.is_dir():
+            continue
+        try:
+            size = sum(f.stat().st_size for f in entry.iterdir())
+            entries.append((entry, size, entry.stat().st_mtime))
+        except FileNotFoundError:
+            pass  # Evicted by someone else while we looked.
+    return sorted(entries, key=lambda e: e[2])
+
+
+def evict(cache_dir=CACHE_DIR, max_size=CACHE_SIZE):
+    """
+    Remove the least recently used entries until the cache is no bigger
+    than `max_size` MB.
+
+    Returns:
+        int. The number of entries removed.
+    """
+    entries = cache_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for entry, size, _ in entries:
+        if total <= max_size * 1e6:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def cache_stats(cache_dir=CACHE_DIR):
+    """
+    Summarize the cache.
+
+    Returns:
+        dict. The number of entries, total bytes, and the times of the
+            oldest and newest use.
+    """
+    entries = cache_entries(cache_dir)
+    times = [t for *_, t in entries]
+    return {
+        'entries': len(entries),
+        'bytes': sum(size for _, size, _ in entries),
+        'oldest': time.ctime(min(times)) if times else None,
+        'newest': time.ctime(max(times)) if times else None,
+    }
+
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """
+    Remove the cache directory completely.
+    """
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return
@@ -0,0 +1,219 @@
+"""
+Reading the YAML control files. Each file is only parsed once, and again
+if it changes, and is checked against a schema before it is used, so a
+mistake in one stops the build before it has done anything.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import copy
+import os
+
+import click
+
+
+# Types for the schemas. A list of one type means a list of those, a dict
+# gives the type of each key, with '*' for any key, and a tuple means any
+# of the types in it.
+NUMBER = (int, float)
+SIZE = (int, str)  # E.g. 10000000 or '10M'.
+NAMES = [str]
+
+SETTINGS_SCHEMA = {
+    'notebooks-source': str,
+    'notebooks-target': str,
+    'master-target': str,
+    'demos-target': str,
+    'references-source': str,
+    'references-target': str,
+    'scripts-source': str,
+    'images-source': str,
+    'images-target': str,
+    'asset-links': str,
+    'cache-dir': str,
+    'cache-size': NUMBER,
+    'data-cache': (str, bool),
+    'data-connections': int,
+    'data-rate-limit': SIZE,
+    'data-max-unzipped': SIZE,
+    'data-max-ratio': NUMBER,
+    'data-url-stems': (str, NAMES),
+    'url-jobs': int,
+    'url-timeout': NUMBER,
+    'url-retries': int,
+    'url-cache-ttl': NUMBER,
+    'zip-compression': int,
+    'zip-jobs': int,
+    's3-bucket': str,
+    's3-path': str,
+    's3-endpoint': str,
+    's3-chunk-size': SIZE,
+    's3-concurrency': int,
+    'upload-jobs': int,
+    'all': NAMES,
+}
+
+COURSE_SCHEMA = {
+    'title': str,
+    'environment': str,
+    'data_url': str,
+    'curriculum': {'*': [(str, NUMBER)]},
+    'extras': NAMES,
+    'demos': NAMES,
+    'data': NAMES,
+    'scripts': NAMES,
+    'references': NAMES,
+    'conda': NAMES,
+    'pip': NAMES,
+}
+COURSE_REQUIRED = ['title', 'curriculum']
+
+# Parsed files, by path: the size and modification time, and the data.
+PARSED = {}
+
+# The warnings given so far, so each is only given once.
+WARNED = set()
+
+
+class ConfigError(click.ClickException):
+    """
+    A control file that can't be read, or has something wrong in it. The
+    command line shows the message, without a traceback.
+    """
+    pass
+
+
+def read_yaml(fname):
+    """
+    Parse a YAML file, with the C parser if PyYAML has it. The result is
+    remembered, and only parsed again if the file's size or modification
+    time changes.
+
+    Args:
+        fname (path): The file.
+
+    Returns:
+        The data in the file. It is a copy, so it can be changed.
+    """
+    import yaml
+
+    stat = os.stat(fname)
+    key = (stat.st_size, stat.st_mtime_ns)
+    path = os.path.abspath(fname)
+    if (entry := PARSED.get(path)) is None or entry[0] != key:
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        with open(fname, 'rt') as f:
+            try:
+                data = yaml.load(f, Loader=loader)
+            except yaml.YAMLError as e:
+                raise ConfigError(f"Could not read {os.path.basename(fname)}: {e}")
+        entry = PARSED[path] = (key, data)
+    return copy.deepcopy(entry[1])
+
+
+def describe(spec):
+    """
+    Say what a type from a schema is, for error messages.
+    """
+    if isinstance(spec, tuple):
+        return ' or '.join(describe(s) for s in spec)
+    if isinstance(spec, list):
+        return f"a list of {describe(spec[0])}"
+    if isinstance(spec, dict):
+        return "a mapping"
+    return spec.__name__
+
+
+def problems(value, spec, where, unknown=None):
+    """
+    Check a value against a type from a schema.
+
+    Args:
+        value: The value.
+        spec: Its type (see `SETTINGS_SCHEMA`).
+        where (str): Where the value is, for the messages.
+        unknown (list): Where to put the keys of mappings that aren't in
+            the schema. They aren't problems; they are just ignored.
+
+    Returns:
+        list. What is wrong with it, if anything.
+    """
+    if isinstance(spec, tuple):
+        if any(not problems(value, s, where) for s in spec):
+            return []
+        return [f"{where} should be {describe(spec)}, not {value!r}."]
+    if isinstance(spec, list):
+        if not isinstance(value, list):
+            return [f"{where} should be {describe(spec)}, not {value!r}."]
+        return [p for i, item in enumerate(value) for p in problems(item, spec[0], f"{where}[{i}]", unknown)]
+    if isinstance(spec, dict):
+        if not isinstance(value, dict):
+            return [f"{where} should be a mapping, not {value!r}."]
+        found = []
+        for key, item in value.items():
+            if key in spec or '*' in spec:
+                found += problems(item, spec.get(key, spec.get('*')), f"{where}.{key}" if where else str(key), unknown)
+            elif unknown is not None:
+                unknown.append(f"{where}.{key}" if where else str(key))
+        return found
+    if isinstance(value, bool) and spec is not bool:
+        return [f"{where} should be {describe(spec)}, not {value!r}."]
+    if not isinstance(value, spec):
+        return [f"{where} should be {describe(spec)}, not {value!r}."]
+    return []
+
+
+def validate(data, schema, fname, required=()):
+    """
+    Check some data against a schema. Empty lists can be left empty in the
+    YAML, so keys whose value is None are ignored, and left out. Keys that
+    aren't in the schema are warned about, once, and left out too, so that
+    a file written for a newer kosu still works.
+
+    Args:
+        data (dict): The data.
+        schema (dict): The type of each key (see `SETTINGS_SCHEMA`).
+        fname (str): Where the data is from, for the error message.
+        required (list): The keys that must be present.
+
+    Returns:
+        dict. The data, without the keys whose value is None.
+    """
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise ConfigError(f"{fname} should be a mapping of keys to values.")
+    data = {key: value for key, value in data.items() if value is not None}
+    found, unknown = [f"Missing key {key!r}." for key in required if key not in data], []
+    found += problems(data, schema, '', unknown)
+    if found:
+        raise ConfigError(f"Problem(s) in {fname}:\n  " + '\n  '.join(found))
+    for key in unknown:
+        if (fname, key) not in WARNED:
+            WARNED.add((fname, key))
+            click.secho(f"⚠️  Ignoring unknown key {key!r} in {fname}.", fg="yellow")
+    return {key: value for key, value in data.items() if key not in unknown}
+
+
+def read_settings(fname):
+    """
+    Read and check the settings in the control file, .kosu.yaml.
+
+    Returns:
+        dict. The settings.
+    """
+    return validate(read_yaml(fname), SETTINGS_SCHEMA, os.path.basename(fname))
+
+
+def read_course(fname):
+    """
+    Read and check a course's control file.
+
+    Returns:
+        dict. The course's config.
+    """
+    config = read_yaml(fname)
+    if isinstance(config, dict) and isinstance(config.get('curriculum'), dict):
+        # Days with nothing in them yet.
+        config['curriculum'] = {day: items or [] for day, items in config['curriculum'].items()}
+    return validate(config, COURSE_SCHEMA, os.path.basename(fname), required=COURSE_REQUIRED)
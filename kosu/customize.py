@@ -2,7 +2,169 @@ import json
 import os
 import re
 
-import requests
+from .references import find_references, reference_pattern, url_stems
+
+# Metadata that nbstripout removes by default, as well as the outputs.
+STRIP_KEYS = ['signature', 'widgets']
+STRIP_CELL_KEYS = ['collapsed', 'ExecuteTime', 'execution', 'heading_collapsed', 'hidden', 'scrolled']
+
+# How nbformat lays out the JSON.
+NBFORMAT_JSON = dict(indent=1, sort_keys=True, separators=(',', ': '), ensure_ascii=False)
+
+# Notebooks bigger than this are processed a cell at a time; see stream.py.
+STREAM_SIZE = 10 * 1024 * 1024
+
+
+STYLES = {
+    'exercise': "<div style=\"background: #e0ffe0; border: solid 2px #d0f0d0; border-radius:3px; padding: 1em; color: darkgreen\">\n\n",
+    'advanced': "<div style=\"background: #fff0e0; border: solid 2px #ffe7d0; border-radius:3px; padding: 1em; color: chocolate\">\n\n",
+    'info': "<div style=\"background: #e0f0ff; border: solid 2px #d0e0f0; border-radius:3px; padding: 1em; color: navy\">\n\n",
+}
+HEADING = re.compile(r"^#+? (.+)\n")
+
+
+# Cell transforms.
+# Each one takes a cell and the context, which holds the options passed to
+# process_notebook() and the references found so far, and returns the cell,
+# changed or not, or None to remove it. They are applied in order to each
+# cell in turn, in a single pass over the notebook.
+
+def drop_hidden(cell, context):
+    """
+    Removes the cell if it has any of the tags in context['hide'].
+    """
+    if set(context['hide']).intersection(cell['metadata'].get('tags', list())):
+        return None
+    return cell
+
+
+def style_cell(cell, context):
+    """
+    Applies the HTML template for each of the styles in context['styles']
+    ('exercise', 'advanced' or 'info') whose tag the cell has. Headings in
+    a styled cell become <h3> headings.
+    """
+    tags = cell['metadata'].get('tags')
+    if not tags:
+        return cell
+    styled = False
+    for style in context['styles']:
+        if True in [t.lower().startswith(style[:3]) for t in tags]:
+            src = cell['source']
+            if not styled:
+                if isinstance(src, str):
+                    src = src.splitlines(True)
+                src = [HEADING.sub(r"<h3>\1</h3>\n", s) if s.startswith('#') else s for s in src]
+                styled = True
+            cell['source'] = [STYLES[style]] + src + ["\n</div>"]
+    return cell
+
+
+def hide_code_cell(cell, context):
+    """
+    Removes the lines between '#!--' and '#--!' in the cell, if
+    context['hidecode'] is set.
+    """
+    if not context['hidecode']:
+        return cell
+    istart = 0
+    istop = -1
+    for idx, line in enumerate(cell['source']):
+        if '#!--' in line:
+            istart = idx
+        if '#--!' in line:
+            istop = idx
+    cell['source'] = cell['source'][:istart] + cell['source'][istop+1:]
+    return cell
+
+
+def collect_references(cell, context):
+    """
+    Finds the images, data files and data URLs mentioned in the cell's
+    source and textual outputs, and adds them to the lists in the context.
+    """
+    for text in _cell_texts(cell):
+        _ = find_references(text, reference_pattern(context['url_stems']), refs=context)
+    return cell
+
+
+def strip_cell(cell, context):
+    """
+    Strips the cell's outputs as nbstripout would, if context['strip'] is
+    set. The cell's id becomes its position in the new notebook.
+    """
+    if context['strip'] and strip_cell_output(cell, context['index']):
+        context['changed'] = True
+    return cell
+
+
+# The transforms every notebook goes through, in order.
+CELL_TRANSFORMS = [drop_hidden, style_cell, hide_code_cell, collect_references, strip_cell]
+
+
+def register_transform(func=None, before=strip_cell):
+    """
+    Adds a cell transform to the pipeline that every notebook goes
+    through, so it costs no extra pass over the notebook. By default it
+    goes just before the outputs are stripped. Can be used as a decorator.
+
+    Args:
+        func (callable): Takes a cell and the context, and returns the cell
+            or None to remove it.
+        before (callable): The transform to put it in front of; None puts
+            it at the end.
+
+    Returns:
+        The function.
+    """
+    if func is None:
+        return lambda f: register_transform(f, before=before)
+    position = len(CELL_TRANSFORMS) if before is None else CELL_TRANSFORMS.index(before)
+    CELL_TRANSFORMS.insert(position, func)
+    return func
+
+
+def use_transforms(transforms):
+    """
+    Replaces the registered transforms. Used to start the processes that
+    process notebooks in parallel, which don't run the code that
+    registered them.
+    """
+    CELL_TRANSFORMS[:] = transforms
+    return
+
+
+def transform_cells(notebook, context, transforms=None):
+    """
+    Applies the transforms to each cell, in one pass over the notebook.
+
+    Returns dict with the transformed cells.
+    """
+    context.setdefault('changed', False)
+    cells = []
+    for cell in notebook['cells']:
+        context['index'] = len(cells)
+        cell = transform_cell(cell, context, transforms)
+        if cell is not None:
+            cells.append(cell)
+    notebook['cells'] = cells
+    return notebook
+
+
+def transform_cell(cell, context, transforms=None):
+    """
+    Applies the transforms to one cell; context['index'] should be the
+    position the cell will have in the new notebook.
+
+    Returns the cell, or None if it was removed.
+    """
+    if transforms is None:
+        transforms = CELL_TRANSFORMS
+    for transform in transforms:
+        cell = transform(cell, context)
+        if cell is None:
+            break
+    return cell
 
 
 def hide_cells(notebook, tags=None):
@@ -13,15 +175,7 @@ def hide_cells(notebook, tags=None):
     """
     if tags is None:
         tags = ['hide']
-
-    clean = []
-    for cell in notebook['cells']:
-        if not set(tags).intersection(cell['metadata'].get('tags', list())):
-            clean.append(cell)
-
-    notebook['cells'] = clean
-
-    return notebook
+    return transform_cells(notebook, {'hide': tags}, [drop_hidden])
 
 
 def empty_cells(notebook):
@@ -53,29 +207,7 @@ def style_cells(notebook, style):
 
     Returns dict with template cells.
     """
-    styles = {
-        'exercise': "<div style=\"background: #e0ffe0; border: solid 2px #d0f0d0; border-radius:3px; padding: 1em; color: darkgreen\">\n\n",
-        'advanced': "<div style=\"background: #fff0e0; border: solid 2px #ffe7d0; border-radius:3px; padding: 1em; color: chocolate\">\n\n",
-        'info': "<div style=\"background: #e0f0ff; border: solid 2px #d0e0f0; border-radius:3px; padding: 1em; color: navy\">\n\n",
-    }
-
-    clean = []
-    wraphead = [styles[style], ]
-    wraptail = ["\n</div>", ]
-
-    for cell in notebook['cells']:
-        try:
-            tags = cell['metadata']['tags']
-            if True in [t.lower().startswith(style[:3]) for t in tags]:
-                src = cell['source']
-                src = [re.sub(r"^#+? (.+)\n", r"<h3>\1</h3>\n", s) for s in src]
-                cell['source'] = wraphead + src + wraptail
-        except KeyError:
-            pass
-        clean.append(cell)
-    notebook['cells'] = clean
-
-    return notebook
+    return transform_cells(notebook, {'styles': [style]}, [style_cell])
 
 
 def hide_code(notebook):
@@ -85,19 +217,7 @@ def hide_code(notebook):
 
     Returns dict
     """
-
-    for i, cell in enumerate(notebook['cells']):
-        istart = 0
-        istop = -1
-        for idx, line in enumerate(cell['source']):
-            if '#!--' in line:
-                istart = idx
-            if '#--!' in line:
-                istop = idx
-
-        notebook['cells'][i]['source'] = cell['source'][:istart] + cell['source'][istop+1:]
-
-    return notebook
+    return transform_cells(notebook, {'hidecode': True}, [hide_code_cell])
 
 
 def hide_toolbar(notebook):
@@ -123,6 +243,205 @@ def change_kernel(notebook, kernel):
     return notebook
 
 
+def keep_output(cell):
+    """
+    Decides whether a cell's outputs survive stripping, using the same
+    'init_cell' and 'keep_output' metadata and tags as nbstripout.
+
+    Returns bool
+    """
+    metadata = cell.get('metadata', {})
+    if 'init_cell' in metadata:
+        return bool(metadata['init_cell'])
+    return bool(metadata.get('keep_output')) or ('keep_output' in metadata.get('tags', []))
+
+
+def strip_cell_output(cell, index):
+    """
+    Removes a cell's outputs, execution counts and volatile metadata, and
+    makes its id its index in the notebook, as nbstripout does.
+
+    Returns whether anything was actually changed.
+    """
+    changed = False
+    if 'outputs' in cell:
+        if cell['outputs'] and not keep_output(cell):
+            cell['outputs'] = []
+            changed = True
+        for output in cell['outputs']:
+            if output.get('execution_count') is not None:
+                output['execution_count'] = None
+                changed = True
+    if cell.get('execution_count') is not None:
+        cell['execution_count'] = None
+        changed = True
+    if 'id' in cell and cell['id'] != str(index):
+        cell['id'] = str(index)
+        changed = True
+    for key in STRIP_CELL_KEYS:
+        if key in cell.get('metadata', {}):
+            del cell['metadata'][key]
+            changed = True
+    return changed
+
+
+def strip_metadata(notebook):
+    """
+    Removes the notebook metadata that nbstripout removes.
+
+    Returns whether anything was actually removed.
+    """
+    changed = False
+    for key in STRIP_KEYS:
+        if notebook['metadata'].pop(key, None) is not None:
+            changed = True
+    return changed
+
+
+def copy_for_stripping(notebook):
+    """
+    Copies just the parts of a notebook that `strip_output()` changes: the
+    cells, their metadata and their outputs, but not what is in them, so
+    the output data, usually most of a notebook, is shared.
+
+    Returns dict.
+    """
+    cells = []
+    for cell in notebook['cells']:
+        cell = dict(cell)
+        if 'metadata' in cell:
+            cell['metadata'] = dict(cell['metadata'])
+        if 'outputs' in cell:
+            cell['outputs'] = [dict(output) for output in cell['outputs']]
+        cells.append(cell)
+    return dict(notebook, cells=cells, metadata=dict(notebook['metadata']))
+
+
+def strip_output(notebook):
+    """
+    Removes outputs, execution counts and volatile metadata, the same way
+    nbstripout does, but on the dict in memory.
+
+    Returns dict, and whether anything was actually removed.
+    """
+    changed = strip_metadata(notebook)
+    for i, cell in enumerate(notebook['cells']):
+        changed = strip_cell_output(cell, i) or changed
+    return notebook, changed
+
+
+def _split_lines(text):
+    """Multi-line text is stored as a list of lines, as nbformat does."""
+    if isinstance(text, list):
+        text = ''.join(text)
+    return text.splitlines(True)
+
+
+def _cell_texts(cell):
+    """The source of a cell, and the text in its outputs (but not images)."""
+    yield ''.join(cell['source']) if isinstance(cell['source'], list) else cell['source']
+    for output in cell.get('outputs', []):
+        for key, value in output.items():
+            if key == 'data':
+                for mime, data in value.items():
+                    if mime == 'image/svg+xml' or not mime.startswith('image/'):
+                        yield from _texts(data)
+            elif key in ['text', 'traceback', 'evalue']:
+                yield from _texts(value)
+
+
+def _texts(value):
+    """All the strings in some JSON data."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, list):
+        for v in value:
+            yield from _texts(v)
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _texts(v)
+
+
+def _split_mimebundle(data):
+    """Rejoin then split the text fields of outputs and attachments."""
+    bundle = {}
+    for key, value in data.items():
+        is_json = (key == 'application/json') or (key.startswith('application/') and key.endswith('+json'))
+        if (not is_json) and isinstance(value, list) and all(isinstance(v, str) for v in value):
+            value = ''.join(value)
+        if isinstance(value, str) and (key.startswith('text/') or key in ['application/javascript', 'image/svg+xml']):
+            value = value.splitlines(True)
+        bundle[key] = value
+    return bundle
+
+
+def format_cell(cell):
+    """
+    Lays out a cell as nbformat does, splitting text into lines. Does not
+    change the cell.
+    """
+    cell = dict(cell)
+    if 'source' in cell:
+        cell['source'] = _split_lines(cell['source'])
+    if 'attachments' in cell:
+        cell['attachments'] = {k: _split_mimebundle(v) for k, v in cell['attachments'].items()}
+    if 'trusted' in cell.get('metadata', {}):
+        cell['metadata'] = {k: v for k, v in cell['metadata'].items() if k != 'trusted'}
+    if cell.get('cell_type') == 'code':
+        outputs = []
+        for output in cell.get('outputs', []):
+            output = dict(output)
+            if output.get('output_type') in ['execute_result', 'display_data']:
+                output['data'] = _split_mimebundle(output.get('data', {}))
+            elif output.get('output_type') == 'stream':
+                output['text'] = _split_lines(output['text'])
+            outputs.append(output)
+        cell['outputs'] = outputs
+    return cell
+
+
+def format_metadata(metadata):
+    """
+    Leaves out the notebook metadata that nbformat treats as transient.
+    """
+    transient = ['orig_nbformat', 'orig_nbformat_minor', 'signature']
+    return {k: v for k, v in metadata.items() if k not in transient}
+
+
+def write_notebook(notebook, outfile):
+    """
+    Writes the notebook with the same layout as nbformat, so the file is
+    identical to what nbstripout would have written. Does not change the
+    dict in memory.
+    """
+    cells = [format_cell(cell) for cell in notebook['cells']]
+    notebook = dict(notebook, cells=cells, metadata=format_metadata(notebook['metadata']))
+
+    text = json.dumps(notebook, **NBFORMAT_JSON)
+    with open(outfile, 'w', encoding='utf-8') as f:
+        _ = f.write(text + '\n')
+
+    return
+
+
+def write_stripped(notebook, outfile, text, changed=None):
+    """
+    Strips the notebook and writes it. If there was nothing to strip, the
+    given text is written instead, just as nbstripout leaves an already
+    clean file untouched. The text can be a function that makes it, so it
+    is only made if it is needed. If the notebook has already been
+    stripped, pass whether that changed anything as `changed`.
+    """
+    if changed is None:
+        notebook, changed = strip_output(notebook)
+    if changed:
+        write_notebook(notebook, outfile)
+    else:
+        with open(outfile, 'w', encoding='utf-8') as f:
+            _ = f.write(text() if callable(text) else text)
+    return
+
+
 def process_notebook(infile,
                      outfile,
                      clear_input=False,  # Don't touch the input file.
@@ -132,58 +451,64 @@ def process_notebook(infile,
                      info=True,
                      hidecode=True,
                      demo=False,  # If demo, remove exercises and enable demos.
-                     data_url_stem=None,
+                     data_url_stem=None,  # A regex; overrides data_url_stems.
+                     data_url_stems=None,  # URLs where the data lives.
                      kernel=None,
+                     master=None,  # Path for a stripped copy of the input.
+                     stream=None,  # Process a cell at a time; None for big files only.
                     ):
     """
     Loads an 'ipynb' file as a dict and performs cleaning tasks
 
-    Writes cleaned version
+    Writes cleaned version, and optionally a stripped copy of the original.
     """
-    if clear_input:
-        _ = os.system("nbstripout {}".format(infile))
+    # One pass over the cells does everything except the kernel and toolbar.
+    context = {
+        'hide': ['exercise', 'solution'] if demo else ['hide', 'demo'],
+        'styles': [style for style, on in [('exercise', exercise), ('advanced', advanced), ('info', info)] if on],
+        'hidecode': hidecode,
+        'strip': clear_output,
+        'url_stems': (data_url_stem,) if data_url_stem else url_stems(data_url_stems),
+        'images': [],
+        'data_files': [],
+        'data_urls': [],
+        'changed': False,
+    }
+
+    if stream is None:
+        stream = os.path.getsize(infile) > STREAM_SIZE
+    if stream and not clear_input:
+        from .stream import stream_notebook
+        stream_notebook(infile, outfile, context, kernel=kernel, master=master)
+        return context['images'], context['data_urls'], context['data_files']
 
     with open(infile, encoding='utf-8') as f:
-        notebook = json.loads(f.read())
+        source = f.read()
+    notebook = json.loads(source)
 
-    if demo:
-        notebook = hide_cells(notebook, tags=['exercise', 'solution'])
-    else:
-        notebook = hide_cells(notebook, tags=['hide', 'demo'])
+    if clear_input:
+        notebook, changed = strip_output(notebook)
+        if changed:
+            write_notebook(notebook, infile)
 
-    if exercise:
-        notebook = style_cells(notebook, 'exercise')
-    if advanced:
-        notebook = style_cells(notebook, 'advanced')
-    if info:
-        notebook = style_cells(notebook, 'info')
+    if master is not None:
+        write_stripped(copy_for_stripping(notebook), master, source)
 
-    if hidecode:
-        notebook = hide_code(notebook)
+    notebook = transform_cells(notebook, context)
 
     if kernel is not None:
         notebook = change_kernel(notebook, kernel)
 
     notebook = hide_toolbar(notebook)
 
-    text = json.dumps(notebook)
-    images = re.findall(r"\.\./images/([-_.a-zA-Z0-9]+)", text)
-    # print(infile, images)
-
-    data_files = re.findall(r"\.\./data/([-_.a-zA-Z0-9]+)", text)
-
-    if data_url_stem is None:
-        data_url_stem = r"https://geocomp\.s3\.amazonaws\.com/data/"
-    data_urls = re.findall(fr"({data_url_stem}[-_.a-zA-Z0-9]+)", text)
-    # print(infile, data_urls)
-
-    with open(outfile, 'w') as f:
-        _ = f.write(text)
-
     if clear_output:
-        _ = os.system("nbstripout {}".format(outfile))
+        changed = strip_metadata(notebook) or context['changed']
+        write_stripped(notebook, outfile, lambda: json.dumps(notebook), changed=changed)
+    else:
+        with open(outfile, 'w') as f:
+            _ = f.write(json.dumps(notebook))
 
-    return images, data_urls, data_files
+    return context['images'], context['data_urls'], context['data_files']
 
 if __name__ == "__main__":
     import argparse
@@ -0,0 +1,552 @@
+"""
+Downloading datasets into a cache shared by every course and build on the
+machine. Downloads can resume, run several at once, split large files into
+byte ranges fetched in parallel, and share a bandwidth limit. Zipped
+datasets are extracted in parallel, and only once per archive.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import contextlib
+import contextvars
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import requests
+
+from .assets import place
+
+
+SPLIT_SIZE = 64 * 1024 * 1024  # Files at least twice this big are split.
+BLOCK_SIZE = 1 << 16
+MAX_UNZIPPED = 50 * 1024 ** 3  # Bytes; more than this in one archive is suspicious.
+MAX_RATIO = 200  # Compression ratios above this are suspicious.
+
+
+def default_data_cache():
+    """
+    The machine-wide data cache, in the user's cache directory.
+
+    Returns:
+        pathlib.Path.
+    """
+    root = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(root) / 'kosu' / 'data'
+
+
+def parse_size(text):
+    """
+    Turn a size like '500k', '10M' or '1.5G' into bytes.
+
+    Returns:
+        int. The number of bytes, or None if `text` is None.
+    """
+    if text is None:
+        return None
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([kKmMgG]?)[bB]?\s*", str(text))
+    if match is None:
+        raise ValueError(f"Could not understand the size {text!r}; try something like 500k or 10M.")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmg'.index(unit.lower() or ' '))
+
+
+def human_size(n):
+    """
+    Format a number of bytes for people.
+    """
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if n < 1024 or unit == 'GB':
+            break
+        n /= 1024
+    return f"{n:.1f} {unit}" if unit != 'B' else f"{n} B"
+
+
+class Limiter:
+    """
+    Shares a number of connections and, optionally, a bandwidth limit in
+    bytes per second between all of the threads downloading.
+    """
+    def __init__(self, connections=8, rate=None):
+        self.connections = connections
+        self.slots = threading.BoundedSemaphore(connections)
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.allowance = 0
+        self.last = time.monotonic()
+
+    def throttle(self, n):
+        """
+        Wait until `n` more bytes are allowed by the bandwidth limit.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= n
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Progress:
+    """
+    Counts the bytes downloaded, and shows the total and the throughput at
+    the end of the current line, updating it while we wait if the output
+    is a terminal.
+    """
+    def __init__(self, fg='bright_cyan'):
+        self.fg = fg
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.shown = 0
+        self.last = 0
+        self.live = sys.stdout.isatty()
+
+    def status(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return f" {human_size(self.bytes)} at {human_size(self.bytes / elapsed)}/s"
+
+    def update(self, n):
+        with self.lock:
+            self.bytes += n
+            if self.live and (time.monotonic() - self.last > 0.25):
+                self.last = time.monotonic()
+                self.erase()
+                text = self.status()
+                click.secho(text, fg=self.fg, nl=False)
+                self.shown = len(text)
+
+    def erase(self):
+        if self.shown:
+            click.echo('\b' * self.shown + ' ' * self.shown + '\b' * self.shown, nl=False)
+            self.shown = 0
+
+    def item(self, fresh=False):
+        """
+        Mark one dataset as done.
+        """
+        with self.lock:
+            self.erase()
+            click.secho('□' if fresh else '■', fg=self.fg, nl=False)
+
+    def finish(self):
+        with self.lock:
+            self.erase()
+            if self.bytes:
+                click.secho(self.status(), fg=self.fg, nl=False)
+
+
+def _load_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _save_state(state_file, state):
+    fd, tmp = tempfile.mkstemp(dir=pathlib.Path(state_file).parent, prefix='.state.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, state_file)
+
+
+def _fetch_range(url, part, chunk, state, state_file, session, limiter, progress, lock, first=None, retries=3):
+    """
+    Download the rest of one chunk, [start, end), into the part file. Starts
+    from the response we already have, if given, and otherwise (or after a
+    dropped connection) with a Range request from where it got to.
+    """
+    start, end = chunk[0], chunk[1]
+    for attempt in range(retries + 1):
+        offset = start + chunk[2]
+        r, first = first, None
+        try:
+            with limiter.slots:
+                if r is None:
+                    stop = '' if end < 0 else end - 1
+                    headers = {'Range': f'bytes={offset}-{stop}', 'If-Range': state['validator']}
+                    r = session.get(url, headers=headers, stream=True)
+                    if r.status_code != 206:
+                        r.close()
+                        raise Exception(f"Could not resume {url}: HTTP {r.status_code}")
+                with r, open(part, 'r+b') as f:
+                    f.seek(offset)
+                    saved = chunk[2]
+                    for block in r.iter_content(chunk_size=BLOCK_SIZE):
+                        limiter.throttle(len(block))
+                        f.write(block)
+                        chunk[2] += len(block)
+                        progress.update(len(block))
+                        if state_file and chunk[2] - saved > 16 * BLOCK_SIZE:
+                            f.flush()
+                            with lock:
+                                _save_state(state_file, state)
+                            saved = chunk[2]
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            if (not state_file) or (attempt == retries):
+                raise
+        finally:
+            if state_file:
+                with lock:
+                    _save_state(state_file, state)
+        if (end < 0) or (start + chunk[2] >= end) or not state_file:
+            return
+    raise Exception(f"Download of {url} is incomplete.")
+
+
+def download(url, fname, session, headers=None, limiter=None, progress=None):
+    """
+    Download a URL to `fname`. The data goes into a part file next to
+    `fname`, which is only renamed into place when it is complete, so an
+    interrupted download never leaves a partial file at `fname`. If the
+    server supports byte ranges, the part file is kept with a record of how
+    far it got, so a later attempt (or this one, after a dropped connection)
+    resumes where it left off, as long as the file has not changed on the
+    server. Large files are split into ranges fetched at the same time.
+
+    Args:
+        url (str): The URL to get.
+        fname (path): Where to put the file.
+        session (requests.Session): The session to use.
+        headers (dict): Extra headers for the first request.
+        limiter (Limiter): Limits on connections and bandwidth.
+        progress (Progress): Where to count the bytes.
+
+    Returns:
+        requests.Response. The first response, which has the headers
+            describing the file.
+    """
+    fname = pathlib.Path(fname)
+    limiter = limiter or Limiter(connections=1)
+    progress = progress or Progress()
+    part = fname.with_name(f'.{fname.name}.part')
+    state_file = fname.with_name(f'.{fname.name}.part.json')
+
+    with limiter.slots:
+        r = session.get(url, headers=headers, stream=True)
+    if r.status_code == 304:
+        r.close()
+        return r
+    if r.status_code != 200:
+        r.close()
+        raise Exception(f"Could not retrieve {url}: HTTP {r.status_code}")
+
+    size = int(r.headers.get('Content-Length', -1))
+    validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+    resumable = (r.headers.get('Accept-Ranges') == 'bytes') and (size > 0) and bool(validator)
+
+    # Carry on from last time if we can, or split a large file up.
+    state = _load_state(state_file) if part.exists() else None
+    if resumable and state and (state['validator'], state['size']) == (validator, size):
+        r.close()
+        first = None
+        progress.update(sum(c[2] for c in state['chunks']))
+    elif resumable and (limiter.connections > 1) and (size >= 2 * SPLIT_SIZE):
+        r.close()
+        first = None
+        n = min(limiter.connections, size // SPLIT_SIZE)
+        bounds = [size * i // n for i in range(n + 1)]
+        state = {'validator': validator, 'size': size,
+                 'chunks': [[a, b, 0] for a, b in zip(bounds[:-1], bounds[1:])]}
+    else:
+        first = r
+        state = {'validator': validator, 'size': size, 'chunks': [[0, size, 0]]}
+    if not any(c[2] for c in state['chunks']):
+        with open(part, 'wb') as f:
+            if size > 0:
+                f.truncate(size)
+    if not resumable:
+        state_file = None
+    elif not state_file.exists():
+        _save_state(state_file, state)
+
+    lock = threading.Lock()
+    chunks = [c for c in state['chunks'] if (c[1] < 0) or (c[0] + c[2] < c[1])]
+    kwargs = dict(url=url, part=part, state=state, state_file=state_file, session=session,
+                  limiter=limiter, progress=progress, lock=lock)
+    try:
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, _fetch_range, chunk=c, **kwargs) for c in chunks]
+                for future in futures:
+                    future.result()
+        elif chunks:
+            _fetch_range(chunk=chunks[0], first=first, **kwargs)
+        else:
+            r.close()
+    except BaseException:
+        if state_file is None:
+            part.unlink()  # There's no resuming it.
+        raise
+
+    if (size > 0) and (part.stat().st_size != size or sum(c[2] for c in state['chunks']) != size):
+        raise Exception(f"Download of {url} is incomplete.")
+    os.replace(part, fname)
+    if state_file is not None and state_file.exists():
+        state_file.unlink()
+    return r
+
+
+@contextlib.contextmanager
+def locked(fname):
+    """
+    Hold an exclusive lock on a file, waiting for it if another process or
+    thread holds it. Where there are no file locks (on Windows), this does
+    nothing.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(fname, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def cache_entry(url, cache_dir):
+    """
+    The folder for a URL in the data cache. The file itself is in `data`
+    in the folder, once it has been downloaded.
+
+    Returns:
+        pathlib.Path.
+    """
+    return pathlib.Path(cache_dir) / hashlib.sha256(url.encode()).hexdigest()
+
+
+def fetch(url, cache_dir, session, limiter=None, progress=None):
+    """
+    Get a URL into the data cache, unless it's already there. A cached file
+    is revalidated with a conditional request, using the ETag and
+    Last-Modified headers from when it was downloaded, so it is only
+    downloaded again if it has changed. Builds running at the same time
+    share the cache, so the entry is locked while it is fetched; whoever
+    waited for the lock then only has to revalidate the file.
+
+    Args:
+        url (str): The URL to get.
+        cache_dir (path): The data cache.
+        session (requests.Session): The session to use.
+        limiter (Limiter): Limits on connections and bandwidth.
+        progress (Progress): Where to count the bytes.
+
+    Returns:
+        pathlib.Path. The cached file.
+    """
+    entry = cache_entry(url, cache_dir)
+    entry.mkdir(parents=True, exist_ok=True)
+    fname, meta_file = entry / 'data', entry / 'meta.json'
+
+    with locked(entry / 'lock'):
+        headers, meta = {}, {}
+        if fname.exists():
+            meta = _load_state(meta_file) or {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        r = download(url, fname, session, headers=headers or None, limiter=limiter, progress=progress)
+        if r.status_code != 304:
+            meta = {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+            _save_state(meta_file, meta)
+
+    return fname
+
+
+def get_data(url, fname, session, cache_dir=None, limiter=None, progress=None):
+    """
+    Put the file at a URL at `fname`, via the data cache if there is one.
+    From the cache, the file is reflinked if possible, and copied
+    otherwise, never hardlinked, so editing it can't change the cache.
+    """
+    if cache_dir:
+        _ = place(fetch(url, cache_dir, session, limiter=limiter, progress=progress), fname)
+    else:
+        _ = download(url, fname, session, limiter=limiter, progress=progress)
+    return
+
+
+def get_datasets(items, session, cache_dir=None, connections=8, rate=None):
+    """
+    Get several datasets at once, sharing a limit on connections and,
+    optionally, bandwidth. Prints a ■ as each dataset arrives, and the
+    amount and speed of the download at the end.
+
+    Args:
+        items (list): Tuples of (URL, path).
+        session (requests.Session): The session to use.
+        cache_dir (path): The data cache, if any.
+        connections (int): The most connections to have open at once.
+        rate (int): The most bytes per second to download, if limited.
+
+    Returns:
+        None.
+    """
+    if not items:
+        return
+    limiter = Limiter(connections=connections, rate=rate)
+    progress = Progress()
+
+    def get(url, fname):
+        get_data(url, fname, session, cache_dir=cache_dir, limiter=limiter, progress=progress)
+        progress.item()
+
+    with ThreadPoolExecutor(max_workers=min(connections, len(items))) as executor:
+        # In a copy of our context, so what they print goes where ours does.
+        futures = [executor.submit(contextvars.copy_context().run, get, url, fname) for url, fname in items]
+        for future in futures:
+            future.result()
+    progress.finish()
+    return
+
+
+def safe_path(dest, name):
+    """
+    The path a member of an archive should be extracted to, making sure it
+    is inside `dest`. Unlike `ZipFile.extractall()`, which quietly rewrites
+    dangerous names, this refuses them.
+
+    Returns:
+        pathlib.Path.
+    """
+    parts = name.replace('\\', '/').split('/')
+    if name.startswith(('/', '\\')) or ':' in parts[0] or '..' in parts:
+        raise Exception(f"Refusing to extract {name!r}, which is outside the data folder.")
+    return pathlib.Path(dest).joinpath(*[p for p in parts if p not in ('', '.')])
+
+
+def check_archive(infos, max_size=MAX_UNZIPPED, max_ratio=MAX_RATIO):
+    """
+    Check that an archive will not unpack into something enormous, from the
+    sizes in its directory. The sizes can be trusted, because `zipfile`
+    never reads more of a member than its stated size.
+
+    Args:
+        infos (list): The `ZipInfo` of each member.
+        max_size (int): The most bytes the members can add up to.
+        max_ratio (float): The most a member over 1 MB can be compressed.
+
+    Returns:
+        None.
+    """
+    total = sum(info.file_size for info in infos)
+    if max_size and total > max_size:
+        raise Exception(f"Refusing to extract {human_size(total)}, which is more than {human_size(max_size)}.")
+    for info in infos:
+        ratio = info.file_size / max(info.compress_size, 1)
+        if max_ratio and info.file_size > 1 << 20 and ratio > max_ratio:
+            raise Exception(f"Refusing to extract {info.filename!r}, which is compressed {ratio:.0f} times.")
+    return
+
+
+def unzip(fname, dest, jobs=None, max_size=MAX_UNZIPPED, max_ratio=MAX_RATIO):
+    """
+    Extract a ZIP file into `dest`, streaming the members to disk in
+    several threads, each with its own handle on the archive.
+
+    Returns:
+        list. The names of the members, like `ZipFile.namelist()`.
+    """
+    with zipfile.ZipFile(fname) as z:
+        infos = z.infolist()
+    check_archive(infos, max_size=max_size, max_ratio=max_ratio)
+    targets = [(info, safe_path(dest, info.filename)) for info in infos]
+    for info, target in targets:
+        (target if info.is_dir() else target.parent).mkdir(parents=True, exist_ok=True)
+
+    local, handles = threading.local(), []
+
+    def extract(info, target):
+        if not hasattr(local, 'zip'):
+            local.zip = zipfile.ZipFile(fname)
+            handles.append(local.zip)
+        with local.zip.open(info) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, BLOCK_SIZE)
+
+    files = [(info, target) for info, target in targets if not info.is_dir()]
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(extract, *item) for item in files]
+            for future in futures:
+                future.result()
+    finally:
+        for handle in handles:
+            handle.close()
+    return [info.filename for info in infos]
+
+
+def extract_zip(fname, dest, cache_dir=None, jobs=None, max_size=MAX_UNZIPPED, max_ratio=MAX_RATIO):
+    """
+    Extract a zipped dataset into `dest`. With a data cache, the extracted
+    files are kept in the cache, keyed by the archive's hash, so the same
+    archive is only ever extracted once; after that its files are just
+    reflinked (or copied) into place.
+
+    Args:
+        fname (path): The ZIP file.
+        dest (path): Where to put its contents.
+        cache_dir (path): The data cache, if any.
+        jobs (int): How many threads to extract with.
+        max_size (int): The most bytes the members can add up to.
+        max_ratio (float): The most a member over 1 MB can be compressed.
+
+    Returns:
+        list. The names of the members, like `ZipFile.namelist()`.
+    """
+    if not cache_dir:
+        return unzip(fname, dest, jobs=jobs, max_size=max_size, max_ratio=max_ratio)
+
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    root = pathlib.Path(cache_dir) / 'extracted'
+    entry = root / h.hexdigest()
+    if not entry.is_dir():
+        root.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(tempfile.mkdtemp(dir=root, prefix='.tmp-'))
+        try:
+            members = unzip(fname, tmp / 'files', jobs=jobs, max_size=max_size, max_ratio=max_ratio)
+            with open(tmp / 'members.json', 'w') as f:
+                json.dump(members, f)
+            try:
+                tmp.rename(entry)
+            except OSError:
+                if not entry.is_dir():
+                    raise
+                # Another build got there first; its entry is just as good.
+                shutil.rmtree(tmp, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    with open(entry / 'members.json') as f:
+        members = json.load(f)
+    for member in members:
+        target = safe_path(dest, member)
+        if member.endswith('/'):
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            _ = place(safe_path(entry / 'files', member), target)
+    return members
@@ -0,0 +1,189 @@
+"""
+An index of which courses use which notebooks, images, data files, scripts
+and references, so that we can tell which courses a change affects.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import json
+import os
+import pathlib
+import subprocess
+
+from .references import find_references, reference_pattern, url_stems
+
+
+INDEX_FILE = pathlib.Path('build') / '.kosu-index.json'
+
+# The kinds of file a course uses; all but data are in a source folder.
+KINDS = ['notebooks', 'images', 'data', 'scripts', 'references']
+
+# Files that every course depends on, besides the templates.
+SHARED_FILES = ['.kosu.yaml', 'environment.yaml']
+
+
+def course_notebooks(config):
+    """
+    The notebooks in a course: in the curriculum, extras and demos.
+
+    Returns:
+        list. The notebook file names.
+    """
+    items = [f for items in (config.get('curriculum') or {}).values() for f in items or []]
+    notebooks = [item for item in items if '.ipynb' in item]
+    notebooks += config.get('extras') or []
+    notebooks += config.get('demos') or []
+    return list(dict.fromkeys(notebooks))
+
+
+def scan_notebook(fname, scanned, stems=None):
+    """
+    Find the references in a notebook file, or remember them from before if
+    the file has the same size and modification time. The whole file is
+    scanned, so hidden cells and outputs that the build removes count too;
+    at worst this makes a course look affected when it isn't.
+
+    Args:
+        fname (path): The notebook.
+        scanned (dict): Notebooks scanned before, by path. This is updated.
+        stems (tuple): Data URL stems, as from `url_stems()`.
+
+    Returns:
+        dict. The references of each kind, or None if there's no such file.
+    """
+    try:
+        stat = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    entry = scanned.get(str(fname))
+    if entry and entry['stat'] == [stat.st_size, stat.st_mtime_ns]:
+        return entry['refs']
+    with open(fname, 'rb') as f:
+        refs = find_references(f.read(), reference_pattern(stems, binary=True))
+    scanned[str(fname)] = {'stat': [stat.st_size, stat.st_mtime_ns], 'refs': refs}
+    return refs
+
+
+def course_uses(config, folders, scanned, stems=None):
+    """
+    The files of each kind that a course uses.
+
+    Args:
+        config (dict): The course's config.
+        folders (dict): The source folder of each kind of file but data.
+        scanned (dict): Notebooks scanned before (see `scan_notebook()`).
+        stems (tuple): Data URL stems, as from `url_stems()`.
+
+    Returns:
+        dict. A sorted list of file names of each kind.
+    """
+    uses = {kind: set() for kind in KINDS}
+    for notebook in course_notebooks(config):
+        uses['notebooks'].add(notebook)
+        refs = scan_notebook(pathlib.Path(folders['notebooks']) / notebook, scanned, stems)
+        if refs:
+            uses['images'].update(refs['images'])
+            uses['data'].update(refs['data_files'])
+            uses['data'].update(url.rsplit('/', 1)[-1] for url in refs['data_urls'])
+    uses['data'].update(config.get('data') or [])
+    uses['scripts'].update(config.get('scripts') or [])
+    uses['references'].update(config.get('references') or [])
+    return {kind: sorted(names) for kind, names in uses.items()}
+
+
+def build_index(configs, folders, stems=None, fname=INDEX_FILE):
+    """
+    Make the index of the files each course uses, and the courses that use
+    each file, and save it. The references found in each notebook are kept
+    in the saved index too, so only notebooks that changed are scanned again.
+
+    Args:
+        configs (dict): The config of each course, by name; None for a
+            course whose config could not be read.
+        folders (dict): The source folder of each kind of file but data.
+        stems (list): Data URL stems. Default: `DATA_URL_STEMS`.
+        fname (path): Where to save the index.
+
+    Returns:
+        dict. With 'courses', the files of each kind each course uses, and
+            'files', the courses using each file, by kind and name.
+    """
+    stems = url_stems(stems)
+    try:
+        with open(fname) as f:
+            saved = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        saved = {}
+    scanned = saved.get('notebooks', {}) if saved.get('stems') == list(stems) else {}
+
+    courses, files = {}, {kind: {} for kind in KINDS}
+    for course, config in configs.items():
+        if config is None:
+            courses[course] = None
+            continue
+        courses[course] = course_uses(config, folders, scanned, stems)
+        for kind, names in courses[course].items():
+            for name in names:
+                files[kind].setdefault(name, []).append(course)
+
+    index = {'courses': courses, 'files': files}
+    pathlib.Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, 'w') as f:
+        json.dump(dict(index, stems=list(stems), notebooks=scanned), f)
+    return index
+
+
+def affected(paths, index, folders):
+    """
+    Find the courses that use any of some files. A course's own YAML file
+    affects it, and the shared files and templates affect every course, as
+    does any course whose config could not be read. Other paths are matched
+    by their folder, or, outside the source folders, as data files by name.
+
+    Args:
+        paths (list): The files, which need not exist any more.
+        index (dict): From `build_index()`.
+        folders (dict): The source folder of each kind of file but data,
+            plus 'templates'.
+
+    Returns:
+        list. The affected courses, in the order of the index.
+    """
+    courses = list(index['courses'])
+    here = pathlib.Path('.').resolve()
+    kinds = {pathlib.Path(folder).resolve(): kind for kind, folder in folders.items()}
+    hit = {course for course, uses in index['courses'].items() if uses is None}
+    for path in paths:
+        path = pathlib.Path(path).resolve()
+        kind = kinds.get(path.parent)
+        if kind == 'templates' or (path.parent == here and path.name in SHARED_FILES):
+            return courses
+        if path.parent == here and path.suffix == '.yaml' and path.stem in index['courses']:
+            hit.add(path.stem)
+        elif kind is not None:
+            hit.update(index['files'].get(kind, {}).get(path.name, []))
+        else:
+            hit.update(index['files']['data'].get(path.name, []))
+    return [course for course in courses if course in hit]
+
+
+def changed_files(ref):
+    """
+    The files that changed since a git commit, including new files that git
+    doesn't know about yet, relative to the current directory.
+
+    Args:
+        ref (str): The commit, branch or tag, e.g. 'origin/main'.
+
+    Returns:
+        list. The paths.
+    """
+    commands = [['git', 'diff', '--name-only', '--relative', ref, '--'],
+                ['git', 'ls-files', '--others', '--exclude-standard']]
+    paths = []
+    for command in commands:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode:
+            raise Exception(f"Could not find the files changed since {ref}: {result.stderr.strip()}")
+        paths.extend(result.stdout.splitlines())
+    return paths
@@ -4,30 +4,33 @@ Licence: Apache 2.0
 """
 import pathlib
 import shutil
-import zipfile
 import os
-import warnings
-from urllib.request import urlretrieve
-import urllib
 import inspect
 import sys
 import glob
+import io
+import contextlib
+import functools
+import time
+import traceback
 
-import requests
 import click
-import yaml
-from jinja2 import Environment, FileSystemLoader
-
-try:
-    import boto3
-    from botocore.exceptions import ClientError
-    AWS_AVAILABLE = True
-except:
-    AWS_AVAILABLE = False
 
 from .customize import process_notebook
-
-env = Environment(loader=FileSystemLoader('templates'))
+from .cache import CACHE_DIR, CACHE_SIZE, cached_process_notebook, cached_refs, evict, cache_stats, clear_cache
+from .manifest import MANIFEST_DIR, new_manifest, load_manifest, save_manifest, remove_manifest, file_hash, signature, record, fresh, remove_stale
+from .assets import place_once
+from .archive import write_zip
+from .config import read_course, read_settings, read_yaml
+from .index import INDEX_FILE, build_index, affected, changed_files, scan_notebook
+from .references import url_stems
+from .serve import SOCKET_FILE, available, run_server, send_request
+from .watch import DEBOUNCE, watcher, changes
+from .trees import temp_tree, swap_tree, leftovers, remove_trees
+from .timings import TIMINGS_FILE, PROFILE_FILE, instrument, stage, timed, timing, add_events, start_timing, stop_timing, tree_size
+
+# Requests, boto3, Jinja and PyYAML are slow to import, so they are only
+# imported by the functions that use them, and `kosu --help` stays quick.
 
 
 def removesuffix(s, suffix):
@@ -38,6 +41,18 @@ def removesuffix(s, suffix):
     return s[:-len(suffix)] if s.endswith(suffix) else s
 
 
+def size_option(ctx, param, value):
+    """
+    Turn a size option like 10M into bytes.
+    """
+    from .data import parse_size
+
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 def get_script_dir(follow_symlinks=True):
     if getattr(sys, 'frozen', False):
         path = os.path.abspath(sys.executable)
@@ -48,19 +63,31 @@ def get_script_dir(follow_symlinks=True):
     return pathlib.Path(os.path.dirname(path))
 
 
-# Read the YAML control file, if present.
+# The settings from the YAML control file, read by `load_settings()`.
 KOSU = {'path': get_script_dir()}
-kosu = pathlib.Path(".kosu.yaml")
-if kosu.is_file():
-    with open(kosu, 'rt') as f:
-        try:
-            KOSU.update(yaml.safe_load(f))
-        except yaml.YAMLError as e:
-            print(e)
+SETTINGS_FILE = '.kosu.yaml'
+
+# Whether this process is `kosu serve`, and the pools of processes it keeps,
+# by the number of processes and the cell transforms they were given.
+SERVING = False
+POOLS = {}
+
+
+def load_settings(fname=SETTINGS_FILE):
+    """
+    Read the YAML control file, if present, into `KOSU`. This is done when
+    a command runs, not when kosu is imported.
+    """
+    if pathlib.Path(fname).is_file():
+        KOSU.update(read_settings(fname))
+    return KOSU
+
 
 @click.group(context_settings=dict(help_option_names=['--help', '-h']))
-def cli():
-    pass
+@click.pass_context
+def cli(ctx):
+    if ctx.invoked_subcommand != 'init':
+        load_settings()
 
 
 @cli.command()
@@ -108,25 +135,37 @@ def clean(course, all):
     """
     Clean COURSE builds from local storage.
     """
+    forward()
     courses = get_courses(course, all)
 
     for i, course in enumerate(courses):
         click.secho(f"🧹 Cleaning {course} ({i+1} of {len(courses)}).", fg="cyan", bold=True)
-        try:
-            shutil.rmtree(pathlib.Path('build').joinpath(course))
-        except FileNotFoundError:
-            pass
+        remove_manifest(course)
         try:
             pathlib.Path(f'{course}.zip').unlink()
         except FileNotFoundError:
             pass
+
+    # All the courses' trees are removed at once, with what's left of any
+    # interrupted builds. With --all, so are the notebook cache, the
+    # manifests and the index, so that nothing is left in build.
+    build = pathlib.Path('build')
+    trees = [build.joinpath(course) for course in courses]
+    if build.is_dir():
+        trees += leftovers(build, courses)
+    if all:
+        trees += [CACHE_DIR, MANIFEST_DIR]
         try:
-            if not any(pathlib.Path('build').iterdir()):
-                click.secho(f"✨ Removing build directory.", fg="red")
-                shutil.rmtree(pathlib.Path('build'))
-                break
-        except:
+            INDEX_FILE.unlink()
+        except FileNotFoundError:
             pass
+    remove_trees(trees)
+    try:
+        if not any(build.iterdir()):
+            click.secho(f"✨ Removing build directory.", fg="red")
+            build.rmdir()
+    except FileNotFoundError:
+        pass
     click.secho(f"🚀 Finished.\n", fg="green")
 
     return
@@ -135,16 +174,27 @@ def clean(course, all):
 @cli.command()
 @click.argument('course', type=str, required=False)
 @click.option('--all', is_flag=True, help="Publishes all courses listed in control file.")
-def publish(course, all):
+@click.option('--changed-since', default=None, metavar='REF', help="Only the courses affected by changes since this git commit; implies --all without COURSE.")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help="Notebooks, or courses with --all, to process at once; 0 for one per CPU. Default: 1.")
+@click.option('--max-connections', default=None, type=click.IntRange(min=1), help="Most connections to use for downloading data. Default: 8.")
+@click.option('--rate-limit', default=None, callback=size_option, help="Most bandwidth to use for downloading data, e.g. 10M. Default: no limit.")
+@click.option('--compression', default=None, type=click.IntRange(0, 9), help="Deflate level for the ZIP, from 0 (none) to 9. Default: 6.")
+@click.option('--timings', is_flag=True, help=f"Time each stage of the build, and save the timings in {TIMINGS_FILE}.")
+@click.option('--profile', is_flag=True, help=f"Profile the build, and save the stats in {PROFILE_FILE}.")
+def publish(course, all, changed_since, jobs, max_connections, rate_limit, compression, timings, profile):
     """
     Publish COURSE to AWS.
     """
-    courses = get_courses(course, all)
-
-    for i, course in enumerate(courses):
-        click.secho(f"💥 Publishing {course} ({i+1}/{len(courses)}). Ctrl-C to abort.", fg="cyan", bold=True)
-        _ = build_course(course, clean=True, zip=True, upload=True, clobber=True)
+    courses = get_courses(course, all, changed_since)
+
+    # Build all the ZIPs, then upload them together.
+    with instrument(timings and TIMINGS_FILE, profile and PROFILE_FILE):
+        envs = build_courses(courses, "💥 Publishing", jobs, clean=True, zip=True, upload=False, clobber=True,
+                             connections=max_connections, rate_limit=rate_limit, compression=compression, zip_from_source=True)
+        built = [course for course, env in zip(courses, envs) if env is not None]
+        failed = upload_courses(built)
     click.secho(f"🚀 Finished.\n", fg="green")
+    check_failures(courses, [None if course in failed else env for course, env in zip(courses, envs)])
 
     return
 
@@ -153,24 +203,29 @@ def publish(course, all):
 @click.argument('course', type=str, required=False)
 @click.option('--all', is_flag=True, help="Tests all courses listed in control file.")
 @click.option('--environment', is_flag=True, help="Build a global environment file for testing.")
-def test(course, all, environment):
+@click.option('--changed-since', default=None, metavar='REF', help="Only the courses affected by changes since this git commit; implies --all without COURSE.")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help="Notebooks, or courses with --all, to process at once; 0 for one per CPU. Default: 1.")
+@click.option('--max-connections', default=None, type=click.IntRange(min=1), help="Most connections to use for downloading data. Default: 8.")
+@click.option('--rate-limit', default=None, callback=size_option, help="Most bandwidth to use for downloading data, e.g. 10M. Default: no limit.")
+@click.option('--timings', is_flag=True, help=f"Time each stage of the build, and save the timings in {TIMINGS_FILE}.")
+@click.option('--profile', is_flag=True, help=f"Profile the build, and save the stats in {PROFILE_FILE}.")
+def test(course, all, environment, changed_since, jobs, max_connections, rate_limit, timings, profile):
     """
     Test that COURSE builds without error.
     """
-    courses = get_courses(course, all)
+    forward()
+    courses = get_courses(course, all, changed_since)
 
-    envs = []
-    for i, course in enumerate(courses):
-        clean = 1 - environment  # Clean if we're not doing env.
-        click.secho(f"🧪 Testing {course} ({i+1}/{len(courses)}). Ctrl-C to abort.", fg="cyan", bold=True)
-        env = build_course(course, clean=clean, zip=False, upload=False, clobber=True)
-        envs.append(env)
+    clean = 1 - environment  # Clean if we're not doing env.
+    with instrument(timings and TIMINGS_FILE, profile and PROFILE_FILE):
+        envs = build_courses(courses, "🧪 Testing", jobs, clean=clean, zip=False, upload=False, clobber=True,
+                             connections=max_connections, rate_limit=rate_limit)
     click.secho(f"🚀 Finished.\n", fg="green")
 
     if environment:
-        # Build the combined environment.
+        # Build the combined environment, from the courses that built.
         channels, conda, pip = set(), set(), set()
-        for env in envs:
+        for env in filter(None, envs):
             channels.update(env['channels'])
             conda.update(env['dependencies'][:-1])  # All except pip.
             pip.update(env['dependencies'][-1]['pip'])
@@ -179,10 +234,13 @@ def test(course, all, environment):
             'channels': list(channels),
             'dependencies': list(conda) + [{'pip': list(pip)}],
         }
+        import yaml
         with open('environment-all.yml', 'w') as f:
             f.write(yaml.dump(env, default_flow_style=False, sort_keys=False))
         click.secho(f"✅ Global environment file written.\n", fg="green")
 
+    check_failures(courses, envs)
+
     return
 
 
@@ -193,24 +251,228 @@ def test(course, all, environment):
 @click.option('--upload/--no-upload', default=False, help="Upload the ZIP to S3? Default: no-upload.")
 @click.option('--clobber/--no-clobber', default=False, help="Clobber existing files? Default: no-clobber.")
 @click.option('--all', is_flag=True, help="Tests all courses listed in control file.")
-def build(course, clean, zip, upload, clobber, all):
+@click.option('--changed-since', default=None, metavar='REF', help="Only the courses affected by changes since this git commit; implies --all without COURSE.")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help="Notebooks, or courses with --all, to process at once; 0 for one per CPU. Default: 1.")
+@click.option('--max-connections', default=None, type=click.IntRange(min=1), help="Most connections to use for downloading data. Default: 8.")
+@click.option('--rate-limit', default=None, callback=size_option, help="Most bandwidth to use for downloading data, e.g. 10M. Default: no limit.")
+@click.option('--incremental', is_flag=True, help="Only rebuild what changed since the last build; implies --no-clean.")
+@click.option('--compression', default=None, type=click.IntRange(0, 9), help="Deflate level for the ZIP, from 0 (none) to 9. Default: 6.")
+@click.option('--zip-from-source', is_flag=True, help="Put images, scripts and references straight into the ZIP; needs --clean.")
+@click.option('--timings', is_flag=True, help=f"Time each stage of the build, and save the timings in {TIMINGS_FILE}.")
+@click.option('--profile', is_flag=True, help=f"Profile the build, and save the stats in {PROFILE_FILE}.")
+def build(course, clean, zip, upload, clobber, all, changed_since, jobs, incremental, max_connections, rate_limit, compression, zip_from_source,
+          timings, profile):
     """
     Build COURSE with various options.
     """
-    courses = get_courses(course, all)
-
-    for i, course in enumerate(courses):
-        click.secho(f"🔨 Building {course} ({i+1}/{len(courses)}). Ctrl-C to abort.", fg="cyan", bold=True)
-        _ = build_course(course, clean, zip, upload, clobber)
+    if clobber:
+        forward()  # Otherwise it might need to ask.
+    courses = get_courses(course, all, changed_since)
+
+    if incremental:
+        clean = False
+    if zip_from_source and not (clean and (zip or upload)):
+        message = "'--zip-from-source' needs '--clean' and '--zip' or '--upload', and cannot be used with '--incremental'."
+        raise click.BadOptionUsage('--zip-from-source', message)
+    with instrument(timings and TIMINGS_FILE, profile and PROFILE_FILE):
+        envs = build_courses(courses, "🔨 Building", jobs, clean=clean, zip=zip, upload=upload, clobber=clobber, incremental=incremental,
+                             connections=max_connections, rate_limit=rate_limit,
+                             compression=compression, zip_from_source=zip_from_source)
     click.secho(f"🚀 Finished.\n", fg="green")
+    check_failures(courses, envs)
+
+    return
+
+
+@cli.command(name='plan')
+@click.argument('course', type=str, required=False)
+@click.option('--all', is_flag=True, help="Plans all courses listed in control file.")
+@click.option('--changed-since', default=None, metavar='REF', help="Only the courses affected by changes since this git commit; implies --all without COURSE.")
+@click.option('--for', 'command', default='build', type=click.Choice(['build', 'test', 'publish']), help="The command to plan. Default: build.")
+@click.option('--incremental', is_flag=True, help="Plan an incremental build, from the last one; only with '--for build'.")
+@click.option('--json', 'as_json', is_flag=True, help="Print the plans as JSON.")
+def plan_command(course, all, changed_since, command, incremental, as_json):
+    """
+    Show what building COURSE would do, without doing it.
+    """
+    from .plan import describe_plan, print_plan
+
+    if incremental and command != 'build':
+        raise click.BadOptionUsage('--incremental', "'--incremental' can only be used with '--for build'.")
+    options = {
+        'build': dict(clean=not incremental, zip=True, upload=False, incremental=incremental),
+        'test': dict(clean=True, zip=False, upload=False),
+        'publish': dict(clean=True, zip=True, upload=True, zip_from_source=True),
+    }[command]
+
+    plans = []
+    for course in get_courses(course, all, changed_since):
+        config = load_course(course)
+        settings = manifest_settings()
+        manifest = load_manifest(course, settings) if incremental else new_manifest(settings)
+        path = pathlib.Path('build') / course
+        target = None if manifest['outputs'] else path
+        plan = plan_course(course, path, config, manifest, detail=True, target=target, **options)
+        plans.append(describe_plan(plan))
+
+    if as_json:
+        import json
+        click.echo(json.dumps(plans, indent=2))
+    else:
+        for plan in plans:
+            print_plan(plan)
+    return
+
+
+@cli.command(name='affected')
+@click.argument('paths', nargs=-1, type=click.Path())
+@click.option('--changed-since', default=None, metavar='REF', help="Also use the files changed since this git commit, branch or tag.")
+def affected_command(paths, changed_since):
+    """
+    List the courses that use any of PATHS.
+    """
+    paths = list(paths)
+    if changed_since:
+        paths += changed_files(changed_since)
+    courses = affected_courses(paths, get_courses(None, True))
+    click.secho(f"🔍 {len(courses)} course(s) affected.", fg="cyan", err=True)
+    for course in courses:
+        click.echo(course)
+    return
+
+
+@cli.command()
+@click.argument('course', type=str)
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help="Notebooks to process at once; 0 for one per CPU. Default: 1.")
+@click.option('--debounce', default=DEBOUNCE, type=click.FloatRange(min=0), help=f"Seconds to wait for changes to stop before rebuilding. Default: {DEBOUNCE}.")
+@click.option('--poll', is_flag=True, help="Look for changes every half second, instead of being told about them by the OS.")
+def watch(course, jobs, debounce, poll):
+    """
+    Build COURSE, then rebuild what changes as you edit it.
+    """
+    watch_course(course, jobs=jobs, debounce=debounce, poll=poll)
+    return
+
+
+@cli.command()
+@click.option('--stop', is_flag=True, help="Stop the server running here.")
+def serve(stop):
+    """
+    Keep kosu running, so that build, test and clean start right away.
+    """
+    global SERVING
+    if stop:
+        if send_request({'command': 'stop'}) is None:
+            raise click.ClickException("kosu is not being served here.")
+        click.secho(f"👋 Stopped serving.", fg="cyan")
+        return
+    if not available():
+        raise click.ClickException("kosu can only be served where there are Unix sockets.")
+
+    # Import the slow dependencies now, instead of for the first command.
+    from . import data, upload, urls
+
+    SERVING = True
+    click.secho(f"🛎️  Serving kosu at {SOCKET_FILE}; build, test and clean will use it. Ctrl-C to stop.", fg="cyan", bold=True)
+    try:
+        run_server(handle_request)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        SERVING = False
+        close_pools()
+    click.secho(f"\n👋 Stopped serving.", fg="cyan")
+    return
+
+
+@cli.group(name='cache')
+def cache_cli():
+    """
+    Inspect or clear the cache of processed notebooks.
+    """
+    pass
+
+
+@cache_cli.command(name='stats')
+def cache_stats_command():
+    """
+    Show what is in the notebook cache.
+    """
+    cache_dir = KOSU.get('cache-dir', CACHE_DIR)
+    stats = cache_stats(cache_dir)
+    size = KOSU.get('cache-size', CACHE_SIZE)
+    click.secho(f"📦 {stats['entries']} notebooks, {stats['bytes'] / 1e6:.1f} of {size} MB, in {cache_dir}", fg="cyan")
+    if stats['entries']:
+        click.secho(f"   Least recently used: {stats['oldest']}", fg="cyan")
+        click.secho(f"   Most recently used:  {stats['newest']}", fg="cyan")
+
+    return
+
+
+@cache_cli.command(name='clear')
+def cache_clear_command():
+    """
+    Empty the notebook cache.
+    """
+    cache_dir = KOSU.get('cache-dir', CACHE_DIR)
+    clear_cache(cache_dir)
+    click.secho(f"✨ Cleared {cache_dir}.", fg="red")
 
     return
 
 # =============================================================================
-def get_courses(course, all):
+def forward():
     """
-    Returns the list of courses to process.
+    Send the command being run to `kosu serve`, if it is running here, and
+    exit with its exit code. Otherwise do nothing, and it runs here.
+    """
+    if SERVING:
+        return
+    ctx = click.get_current_context()
+    message = {'command': ctx.command.name, 'params': ctx.params, 'cwd': os.getcwd(), 'color': sys.stdout.isatty()}
+    code = send_request(message, write=lambda text: click.echo(text, nl=False))
+    if code is not None:
+        ctx.exit(code)
+    return
+
+
+def handle_request(message):
     """
+    Run a command sent to `kosu serve` as if it had been run from the
+    command line, with the settings as they are now.
+
+    Returns:
+        int. The exit code.
+    """
+    KOSU.clear()
+    KOSU['path'] = get_script_dir()
+    command = cli.commands[message['command']]
+    try:
+        load_settings()
+        with click.Context(cli, info_name='kosu', color=message.get('color')) as ctx:
+            ctx.invoke(command, **message['params'])
+    except click.exceptions.Exit as e:
+        return e.exit_code
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        click.secho("Aborted!", fg="red")
+        return 1
+    except Exception:
+        click.secho(traceback.format_exc(), fg="red")
+        close_pools()  # In case one broke; they are made again if needed.
+        return 1
+    return 0
+
+
+def get_courses(course, all, changed_since=None):
+    """
+    Returns the list of courses to process. If `changed_since` is a git
+    commit, only the courses affected by the changes since then are kept.
+    """
+    if changed_since and (course is None):
+        all = True
     if (not all) and (course is None):
         message = "Missing argument 'COURSE', or use '--all'."
         raise click.UsageError(message)
@@ -224,13 +486,156 @@ def get_courses(course, all):
     else:
         courses = [removesuffix(course, '.yaml')]
 
+    if changed_since:
+        courses = affected_courses(changed_files(changed_since), courses)
+        click.secho(f"🔍 Changes since {changed_since} affect {len(courses)} course(s): {', '.join(courses) or 'none'}.", fg="cyan")
+
     return courses
 
 
-def build_course(course, clean, zip, upload, clobber):
+def affected_courses(paths, courses):
+    """
+    Find which of some courses use any of some files, with the index of
+    the files each course uses (see `kosu.index`).
+
+    Returns:
+        list. The affected courses, in the same order.
+    """
+    configs = {}
+    for course in courses:
+        try:
+            configs[course] = load_course(course)
+        except Exception:
+            configs[course] = None  # Could be anything; rebuild it to see.
+    folders = {kind: KOSU[f'{kind}-source'] for kind in ['notebooks', 'images', 'scripts', 'references']}
+    index = build_index(configs, folders, stems=KOSU.get('data-url-stems'))
+    folders['templates'] = 'templates'
+    return affected(paths, index, folders)
+
+
+def build_courses(courses, message, jobs=1, **kwargs):
+    """
+    Build the courses one after another or, given more than one job and
+    more than one course, several at once in a pool of processes. In that
+    case each course's notebooks are processed serially, and its output is
+    collected and printed when it finishes, followed by a summary.
+
+    Args:
+        courses (list): The courses to build.
+        message (str): The start of the message announcing each course.
+        jobs (int): How many courses (or, for one course, notebooks) to
+            process at once; 0 means one per CPU.
+        **kwargs: Passed on to `build_course()`.
+
+    Returns:
+        list. The environment dicts, in the same order as the courses; None
+            for any course that failed to build.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    serial = jobs == 1 or len(courses) < 2
+
+    # Read and check all the control files first, so that a mistake in one
+    # stops the build before anything is done. In parallel, each course
+    # reports its own mistakes instead, and the workers get the files
+    # already parsed.
+    for course in courses:
+        try:
+            _ = load_course(course)
+        except Exception:
+            if serial:
+                raise
+    if pathlib.Path('environment.yaml').is_file():
+        _ = read_yaml('environment.yaml')
+
+    if serial:
+        envs = []
+        for i, course in enumerate(courses):
+            click.secho(f"{message} {course} ({i+1}/{len(courses)}). Ctrl-C to abort.", fg="cyan", bold=True)
+            with stage('course', course=course):
+                envs.append(build_course(course, jobs=jobs, **kwargs))
+        return envs
+
+    # Workers can't prompt, so ask once up front.
+    if not kwargs.get('clobber'):
+        existing = [c for c in courses if pathlib.Path('build').joinpath(c).exists() or pathlib.Path(f"{c}.zip").exists()]
+        if existing:
+            prompt = f"❓ Build directories or ZIP files for {', '.join(existing)} exist and will be overwritten. Are you sure?"
+            text = click.style(prompt, fg="bright_yellow")
+            click.confirm(text, default=True, abort=True)
+        kwargs['clobber'] = True
+
+    jobs = min(jobs, len(courses))
+    click.secho(f"{message} {len(courses)} courses, {jobs} at a time. Ctrl-C to abort.", fg="cyan", bold=True)
+    results = {}
+    from concurrent.futures import as_completed
+    with process_pool(jobs) as executor:
+        futures = {executor.submit(build_course_quietly, course, timings=timing(), settings=dict(KOSU), **kwargs): course
+                   for course in courses}
+        with cancelling(futures):
+            for i, future in enumerate(as_completed(futures)):
+                course = futures[future]
+                env, output, error, events = future.result()
+                add_events(events)
+                click.secho(f"{message} {course} ({i+1}/{len(courses)}).", fg="cyan", bold=True)
+                click.echo(output, nl=not output.endswith('\n'))
+                if error is not None:
+                    click.secho(error, fg="red")
+                results[course] = env
+
+    passed = [c for c in courses if results[c] is not None]
+    failed = [c for c in courses if results[c] is None]
+    if passed:
+        click.secho(f"✅ Passed: {', '.join(passed)}", fg="green")
+    if failed:
+        click.secho(f"❌ Failed: {', '.join(failed)}", fg="red")
+
+    return [results[c] for c in courses]
+
+
+def build_course_quietly(course, timings=False, settings=None, **kwargs):
+    """
+    Build a course, collecting everything it prints instead of printing it.
+    Colours are kept; click removes them later if the terminal needs it.
+    If `timings` is set, the stages are timed, and the timings returned.
+    The `settings` from the control file are used, if given, since they are
+    not the ones this process has if it was spawned, or kept by `kosu serve`.
+
+    Returns:
+        tuple. The environment dict (None if the build failed), the output,
+            the traceback (None if the build succeeded), and the timings.
+    """
+    if settings is not None:
+        KOSU.clear()
+        KOSU.update(settings)
+    if timings:
+        start_timing()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), click.Context(cli, color=True):
+        try:
+            with stage('course', course=course):
+                env = build_course(course, **kwargs)
+        except Exception:
+            return None, output.getvalue(), traceback.format_exc(), stop_timing()
+    return env, output.getvalue(), None, stop_timing()
+
+
+def check_failures(courses, envs):
+    """
+    Raise an error naming any courses that failed to build.
+    """
+    failed = [course for course, env in zip(courses, envs) if env is None]
+    if failed:
+        raise click.ClickException(f"{len(failed)} of {len(courses)} courses failed: {', '.join(failed)}")
+    return
+
+
+def build_course(course, clean, zip, upload, clobber, jobs=1, incremental=False, connections=None, rate_limit=None,
+                 compression=None, zip_from_source=False):
     """
     Compiles the required files into a course repo, which
-    will be zipped by default.
+    will be zipped by default. The build runs the tasks that
+    `plan_course()` works out, in order.
 
     Args:
         course (str): The course to build.
@@ -238,174 +643,711 @@ def build_course(course, clean, zip, upload, clobber):
         zip (bool): Whether to create the zip file for the course repo (or to save it if uploading).
         upload (bool): Whether to attempt to upload the ZIP to AWS.
         clobber (bool): Whether to overwrite existing ZIP file and build directory.
+        jobs (int): How many notebooks to process at once; 0 means one per CPU.
+        incremental (bool): Whether to keep the parts of the last build whose
+            inputs have not changed, and update the ZIP file in place.
+        connections (int): The most connections to use for downloading data.
+        rate_limit (int): The most bytes per second to download, if limited.
+        compression (int): The deflate level for the ZIP, from 0 to 9.
+        zip_from_source (bool): Whether to put images, scripts and references
+            in the ZIP straight from where they are, instead of copying them
+            into the build first. Only used if the build is cleaned up.
 
     Returns:
         dict. Environment dictionary.
     """
-    # Read the YAML control file.
-    with open(f"{removesuffix(course, '.yaml')}.yaml", 'rt') as f:
-        try:
-            config = yaml.safe_load(f)
-        except yaml.YAMLError as e:
-            print(e)
-    config['course'] = course
+    from .plan import run_plan
 
-    # Make a path to store everything.
-    build_path = 'build'
-    path = pathlib.Path(build_path).joinpath(course)
-    if path.exists():
+    # Read the YAML control file.
+    config = load_course(course)
+
+    # The manifest records what went into each file we make. If anything in
+    # the control file or kosu itself changed, nothing is up to date.
+    settings = manifest_settings()
+    manifest = load_manifest(course, settings) if incremental else new_manifest(settings)
+
+    # Make a path to store everything. Unless we're keeping the last build,
+    # the course is built beside it, and only replaces it once it's done.
+    # If the last build has gone, there's nothing to keep.
+    target = pathlib.Path('build').joinpath(course)
+    if manifest['outputs'] and not target.is_dir():
+        manifest = new_manifest(settings)
+    keep = bool(manifest['outputs'])
+    if target.exists() and not keep and not clobber:
         message = "❓ The target directory exists and will be overwritten. Are you sure?"
-        text = click.style(message, fg="bright_yellow")
-        if clobber or click.confirm(text, default=True, abort=True):
-            shutil.rmtree(path)
-    if pathlib.Path(f"{course}.zip").exists():
-        message = "❓ The ZIP file exists and will be overwritten. Are you sure?"
-        text = click.style(message, fg="bright_yellow")
-        if clobber or click.confirm(text, default=True, abort=True):
-            pathlib.Path(f"{course}.zip").unlink()
-
-    _ = path.mkdir(parents=True, exist_ok=True)
-
-    # Build the notebooks; also deals with images.
-    *paths, _, data_urls_to_check, data_files_to_check = build_notebooks(path, config)
-
-    # Check the data files exist.
-    click.secho('🧐 Checking and downloading data ', fg="cyan", nl=False)
-    for url in data_urls_to_check:
-        click.secho('■', fg="cyan", nl=False)
-        if requests.head(url).status_code != 200:
-            raise Exception(f"Missing data URL: {url}")
-
-    # Make the data directory and check all local data files were requested in Yaml.
-    build_data(path, config)
-
-    # Check the data files exist.
-    # Removing this for now, see issue #25.
-    # for fname in data_files_to_check:
-    #     click.secho('■', fg="cyan", nl=False)
-    #     if not (path.joinpath('data') / fname).exists():
-    #         raise Exception(f"Data file appears in notebook but not listed in course YAML: {fname}")
-
-    # Check the requested data files are used.
-    not_used = []
-    for fname in glob.glob(f'{path.joinpath("data")}/*'):
-        fname = fname.split('/')[-1]
-        if fname not in data_files_to_check:
-            not_used.append(fname)
-    if not_used:
-        raise Exception(f"Data file(s) appear in course YAML but not used in notebooks: {', '.join(not_used)}")
-
-    click.secho()
+        click.confirm(click.style(message, fg="bright_yellow"), default=True, abort=True)
+    zip_file = pathlib.Path(f"{course}.zip")
+    if zip_file.exists() and not keep:
+        if not clobber:
+            message = "❓ The ZIP file exists and will be overwritten. Are you sure?"
+            click.confirm(click.style(message, fg="bright_yellow"), default=True, abort=True)
+        # A new ZIP replaces it once it's written; otherwise it goes now.
+        if not (zip or upload):
+            zip_file.unlink()
+
+    if keep:
+        path, target = target, None
+    else:
+        path = temp_tree(target)
 
-    # Deal with scripts.
-    if scripts := config.get('scripts'):
-        for script in scripts:
-            for p in paths:
-                shutil.copyfile(pathlib.Path(KOSU['scripts-source']) / script, p / script)
+    # Work out what to do, then do it.
+    plan = plan_course(course, path, config, manifest, clean=clean, zip=zip, upload=upload, jobs=jobs,
+                       incremental=incremental, connections=connections, rate_limit=rate_limit,
+                       compression=compression, zip_from_source=zip_from_source, target=target)
+    try:
+        results = run_plan(plan)
+    except BaseException:
+        if target is not None:
+            remove_trees([path.parent])
+        raise
 
-    # Make the references folder.
-    if refs := config.get('references'):
-        ref_path = path.joinpath(KOSU['references-target'])
-        ref_path.mkdir()
-        for fname in refs:
-            shutil.copyfile(pathlib.Path(KOSU['references-source']) / fname, ref_path / fname)
+    return results['environment']
 
-    # Make the environment.yaml file.
-    env = build_environment(path, config)
 
-    # Make the README.
-    _ = build_readme(path, config)
+def plan_course(course, path, config, manifest, clean=True, zip=True, upload=False, jobs=1, incremental=False,
+                connections=None, rate_limit=None, compression=None, zip_from_source=False, detail=False, target=None):
+    """
+    Work out the tasks that building a course takes, and what each one
+    depends on, without doing any of them. Each task lists the files it
+    will make, copy or download, and whether each one is up to date in the
+    build at `path`, according to the manifest. If the course is being
+    built somewhere else first (see `kosu.trees`), `target` is where it
+    goes when it's done, replacing the tree there, if it isn't cleaned up.
+    The other arguments are as for `build_course()`.
+
+    The images and data URLs are only really known once the notebooks have
+    been processed. Until then, they are taken from the manifest for the
+    notebooks that are up to date, and, with `detail`, from the cache of
+    processed notebooks or by scanning the notebook itself; these last
+    are estimates. With `detail`, the caches of notebooks, data and URLs
+    are looked in, to see what is in them.
 
-    # Zip it.
-    if zip or upload:
-        zipped = shutil.make_archive(course, 'zip', root_dir=build_path, base_dir=course)
+    Returns:
+        dict. The plan, with the course, its path and its tasks, in the
+            order they run (see `kosu.plan`).
+    """
+    from .data import cache_entry
+    from .plan import new_task, new_item, file_size
+
+    # Files that go straight into the ZIP, if the build isn't being kept.
+    direct = zip_from_source and clean and (zip or upload) and not incremental
+    sources = {} if direct else None
+    source = {kind: pathlib.Path(KOSU[f'{kind}-source']) for kind in ['images', 'scripts', 'references']}
+
+    def up_to_date(src, output):
+        # Without recording it; the task that copies it does that.
+        return sources is None and fresh(manifest, path, output, signature(manifest, [src]), keep=False)
+
+    # The notebooks, and what they refer to, as far as we can tell yet.
+    notebooks = plan_notebooks(path, config, manifest)
+    stems = url_stems(KOSU.get('data-url-stems'))
+    nb_items, refs = [], []
+    for i, task in enumerate(notebooks['tasks']):
+        known, cached, estimated = notebooks['results'][i], False, False
+        if known is None and detail:
+            if 'cache_dir' in task:
+                options = {k: v for k, v in task.items() if k not in ['infile', 'outfile', 'master', 'cache_dir']}
+                known = cached = cached_refs(task['infile'], task['cache_dir'], **options)
+            if known is None and (found := scan_notebook(task['infile'], {}, stems)):
+                known, estimated = (found['images'], found['data_urls'], found['data_files']), True
+        nb_items.append(new_item(task['outfile'].relative_to(path).as_posix(), size=file_size(task['infile']),
+                                 todo=i in notebooks['todo'], cached=bool(cached)))
+        if known:
+            refs.append((known, estimated))
+
+    img_items = {}
+    for (images, _, _), estimated in refs:
+        for image in images:
+            src, output = source['images'] / image, f"{KOSU['images-target']}/{image}"
+            size = file_size(src)
+            estimated = estimated and img_items.get(output, {}).get('estimated', True)
+            img_items[output] = new_item(output, size=size, todo=size is None or not up_to_date(src, output), estimated=estimated)
+
+    # URLs that were found recently are remembered, unless url-cache-ttl is 0.
+    ttl = KOSU.get('url-cache-ttl', 3600)
+    url_cache = pathlib.Path(KOSU.get('cache-dir', CACHE_DIR)) / 'urls.json' if ttl else None
+    checked = {}
+    if detail and url_cache:
+        from .urls import load_checked
+        checked = load_checked(url_cache, ttl)
+    url_items = {}
+    for (_, urls, _), estimated in refs:
+        for url in urls:
+            estimated = estimated and url_items.get(url, {}).get('estimated', True)
+            url_items[url] = new_item(url, cached=url in checked, estimated=estimated)
+
+    # Datasets come via the machine-wide data cache, unless data-cache is false.
+    data = plan_data(path, config, manifest)
+    data_cache = data_cache_dir()
+    todo = {output for *_, output, _ in data['todo']}
+    data_items = []
+    for fname in config.get('data') or []:
+        size = file_size(cache_entry(f"{data['data_url']}{fname}", data_cache) / 'data') if data_cache else None
+        data_items.append(new_item(f'data/{fname}', size=size, todo=f'data/{fname}' in todo, cached=size is not None))
+
+    # Scripts go into the master and notebook folders.
+    script_items = []
+    for script in config.get('scripts') or []:
+        for p in notebooks['paths'][:2]:
+            src, output = source['scripts'] / script, (p / script).relative_to(path).as_posix()
+            size = file_size(src)
+            script_items.append(new_item(output, size=size, todo=size is None or not up_to_date(src, output)))
+    ref_items = []
+    for fname in config.get('references') or []:
+        src, output = source['references'] / fname, f"{KOSU['references-target']}/{fname}"
+        size = file_size(src)
+        ref_items.append(new_item(output, size=size, todo=size is None or not up_to_date(src, output)))
+
+    def run_notebooks(results, event):
+        return process_notebooks(path, config, notebooks, manifest, event, jobs=jobs)
+
+    def run_images(results, event):
+        copy_images(path, results['notebooks'], manifest, event, sources=sources)
+
+    def run_urls(results, event):
+        from .urls import check_urls
+        urls = [url for _, urls, _ in results['notebooks'] for url in urls]
+        if not urls:
+            return
+        click.secho('🧐 Checking data URLs ', fg="cyan", nl=False)
+        event['items'] = len(set(urls))
+        missing = check_urls(urls,
+                             jobs=KOSU.get('url-jobs', 16),
+                             timeout=KOSU.get('url-timeout', 10),
+                             retries=KOSU.get('url-retries', 3),
+                             cache_file=url_cache,
+                             ttl=ttl,
+                             callback=lambda url: click.secho('■', fg="cyan", nl=False),
+                             )
+        click.secho()
+        if missing:
+            raise Exception(f"Missing data URL(s): {', '.join(missing)}")
+
+    def run_data(results, event):
+        click.secho('🧐 Checking and downloading data ', fg="cyan", nl=False)
+        fetch_data(path, config, data, manifest, connections=connections, rate_limit=rate_limit)
+        _ = remove_stale(manifest, path, prefix='data/')
+        event['items'], event['bytes'] = tree_size(path / 'data')
+        click.secho()
+
+    def run_check(results, event):
+        # Check the requested data files are used.
+        # Checking that the data files the notebooks use are listed is
+        # turned off for now, see issue #25.
+        data_files_to_check = [f for _, _, files in results['notebooks'] for f in files]
+        not_used = []
+        for fname in glob.glob(f'{path.joinpath("data")}/*'):
+            fname = fname.split('/')[-1]
+            if fname not in data_files_to_check:
+                not_used.append(fname)
+        if not_used:
+            raise Exception(f"Data file(s) appear in course YAML but not used in notebooks: {', '.join(not_used)}")
+
+    def run_scripts(results, event):
+        copy_scripts(path, config, notebooks['paths'][:2], manifest, event, sources=sources)
+
+    def run_references(results, event):
+        copy_references(path, config, manifest, event, sources=sources)
+
+    def run_environment(results, event):
+        return build_environment(path, config)
+
+    def run_readme(results, event):
+        build_readme(path, config)
+
+    def run_stale(results, event):
+        # Remove anything the last build made that this one didn't.
+        _ = remove_stale(manifest, path)
+
+    def run_zip(results, event):
+        zipped, manifest['zip'] = write_zip(course, path.parent, course,
+                                            previous=manifest['zip'] if incremental else None,
+                                            level=KOSU.get('zip-compression', 6) if compression is None else compression,
+                                            jobs=KOSU.get('zip-jobs'),
+                                            sources=sources,
+                                            )
+        event['items'], event['bytes'] = len(manifest['zip']), os.path.getsize(zipped)
         click.secho(f"📁 Created {zipped}", fg="green")
+        return zipped
 
-    # Upload to AWS.
-    if upload:
-        success = upload_zip(zipped)
-        if success:
-            click.secho(f"⬆️  Uploaded {zipped}", fg="green")
-            link  = f"https://{KOSU['s3-bucket']}.s3.amazonaws.com/"
-            link += f"{course}.zip"
-            click.secho(f"🔗 File link: {link}", fg="green")
+    def run_upload(results, event):
+        from .upload import upload_zip
+        zipped = results['zip']
+        event['items'], event['bytes'] = 1, os.path.getsize(zipped)
+        report_upload(zipped, upload_zip(zipped, KOSU['s3-bucket'], **upload_settings()))
         if not zip:
-            pathlib.Path(f'{course}.zip').unlink()
+            pathlib.Path(zipped).unlink()
+
+    def run_swap(results, event):
+        return swap_tree(path, target)
+
+    def run_remove(results, event):
+        # The old build, which has been replaced, or isn't wanted.
+        remove_trees([results['swap'] if 'swap' in results else target])
+
+    def run_clean(results, event):
+        # Remove build, or remember it for next time.
+        if clean:
+            remove_trees([path.parent if target is not None else path])
+            remove_manifest(course)
+            click.secho(f"✨ Removed build files.", fg="red")
+        else:
+            save_manifest(course, manifest)
+
+    tasks = [
+        new_task('notebooks', run_notebooks, items=nb_items),
+        new_task('images', run_images, after=['notebooks'], items=img_items.values()),
+        new_task('urls', run_urls, after=['notebooks'], items=url_items.values()),
+        new_task('data', run_data, items=data_items),
+        new_task('check', run_check, after=['notebooks', 'data']),
+        new_task('scripts', run_scripts, after=['notebooks'], items=script_items),
+        new_task('references', run_references, items=ref_items),
+        new_task('environment', run_environment),
+        new_task('readme', run_readme, stage='environment'),
+    ]
+    tasks.append(new_task('stale', run_stale, after=[task['name'] for task in tasks]))
+    if zip or upload:
+        tasks.append(new_task('zip', run_zip, after=['stale']))
+    if upload:
+        tasks.append(new_task('upload', run_upload, after=['zip'], items=[new_item(f'{course}.zip', size=None)]))
+    after = [tasks[-1]['name']]
+    if target is not None and not clean:
+        # The ZIP is made from the new build before it's moved into place.
+        tasks.append(new_task('swap', run_swap, after=['zip' if zip or upload else 'stale']))
+        tasks.append(new_task('remove', run_remove, after=['swap']))
+        after.append('swap')
+    elif target is not None:
+        # The old build isn't wanted, but it stays until the new one is done.
+        tasks.append(new_task('remove', run_remove, after=after))
+        after.append('remove')
+    tasks.append(new_task('clean', run_clean, after=after))
+
+    return {'course': course, 'path': path.as_posix(), 'tasks': tasks}
+
+
+def watch_course(course, jobs=1, debounce=DEBOUNCE, poll=False):
+    """
+    Build a course, keeping the build, then watch its files and rebuild
+    only what changed, until interrupted. A change to a notebook or image
+    reprocesses the notebooks that are out of date, a change to a script
+    or reference puts it in the build again, and a change to a template
+    remakes the README. A change to the course's YAML, environment.yaml or
+    .kosu.yaml starts an incremental build of the whole course, so the data
+    and data URLs are only checked again then.
 
-    # Remove build.
-    if clean:
-        shutil.rmtree(path)
-        click.secho(f"✨ Removed build files.", fg="red")
+    Args:
+        course (str): The course to build.
+        jobs (int): How many notebooks to process at once.
+        debounce (float): Seconds without changes that end a batch of them.
+        poll (bool): Whether to poll for changes instead of using inotify.
+    """
+    course = removesuffix(course, '.yaml')
+    options = dict(clean=False, zip=False, upload=False, clobber=True, jobs=jobs, incremental=True)
+    build_course(course, **options)
+    path = pathlib.Path('build') / course
+    folders = {kind: pathlib.Path(KOSU[f'{kind}-source']).resolve() for kind in ['notebooks', 'images', 'scripts', 'references']}
+    folders['templates'] = pathlib.Path('templates').resolve()
+    control = {pathlib.Path(f).resolve() for f in [f'{course}.yaml', 'environment.yaml', SETTINGS_FILE]}
+    # Everything build_notebooks() makes, which is remade from scratch.
+    made = [KOSU[f'{kind}-target'] + '/' for kind in ['notebooks', 'master', 'demos', 'images']]
+
+    watch = watcher(list(folders.values()) + [pathlib.Path('.').resolve()], poll=poll)
+    click.secho(f"👀 Watching {course} for changes; press Ctrl-C to stop.", fg="cyan", bold=True)
+    try:
+        for changed in changes(watch, debounce=debounce):
+            changed = {pathlib.Path(f).resolve() for f in changed}
+            kinds = {kind for kind, folder in folders.items() if any(f.parent == folder for f in changed)}
+            if not kinds and not (changed & control):
+                continue
+            start = time.time()
+            try:
+                if changed & control:
+                    if pathlib.Path(SETTINGS_FILE).resolve() in changed:
+                        load_settings()
+                    build_course(course, **options)
+                else:
+                    rebuild_course(course, path, kinds, made, jobs=jobs)
+            except Exception as e:
+                click.secho(f"❌ Rebuild failed: {e}", fg="red")
+                continue
+            click.secho(f"🔄 Rebuilt {', '.join(sorted(kinds)) or course} in {time.time() - start:.2f} s", fg="green")
+    except KeyboardInterrupt:
+        click.secho(f"\n👋 Stopped watching.", fg="cyan")
+    finally:
+        watch.close()
+    return
 
-    return env
+
+def rebuild_course(course, path, kinds, made, jobs=1):
+    """
+    Rebuild the parts of a kept build that depend on some kinds of file:
+    'notebooks', 'images', 'scripts', 'references' or 'templates'. The rest
+    of the build is carried over from the manifest as it is.
+    """
+    config = load_course(course)
+    manifest = load_manifest(course, manifest_settings())
+    rebuild = bool(kinds & {'notebooks', 'images'})
+    manifest['current'] = {o: e for o, e in manifest['outputs'].items()
+                           if not (rebuild and o.startswith(tuple(made)))}
+    paths = [path.joinpath(KOSU['master-target']), path.joinpath(KOSU['notebooks-target'])]
+    if rebuild:
+        *paths, _, _, _ = build_notebooks(path, config, jobs=jobs, manifest=manifest)
+    if rebuild or kinds & {'scripts', 'references'}:
+        # The scripts are in the notebook folders, so they have to be kept too.
+        build_assets(path, config, paths, manifest)
+    if rebuild:
+        for prefix in made:
+            _ = remove_stale(manifest, path, prefix=prefix)
+    if 'templates' in kinds:
+        build_readme(path, config)
+    save_manifest(course, manifest)
+    return
+
+
+def load_course(course):
+    """
+    Read and check a course's control file (see `kosu.config`).
+
+    Returns:
+        dict. The config, with the course's name in 'course'.
+    """
+    config = read_course(f"{removesuffix(course, '.yaml')}.yaml")
+    config['course'] = course
+    return config
+
+
+def data_cache_dir():
+    """
+    Where the data cache is, from `data-cache` in the control file: a path,
+    or true for the default place, or false for no cache.
+
+    Returns:
+        path. The folder, or None if there is no cache.
+    """
+    from .data import default_data_cache
+
+    cache_dir = KOSU.get('data-cache', True)
+    if cache_dir is True:
+        return default_data_cache()
+    return cache_dir or None
+
+
+def manifest_settings():
+    """
+    The settings that every output of a build depends on.
+    """
+    from . import __version__
+    return {'kosu': KOSU, 'version': __version__}
+
+
+def build_assets(path, config, paths, manifest, sources=None):
+    """
+    Put the scripts into each of the notebook folders in `paths`, and the
+    references into their own folder (see `copy_asset()`).
+    """
+    course = config['course']
+    with stage('scripts', course=course) as event:
+        copy_scripts(path, config, paths, manifest, event, sources=sources)
+    with stage('references', course=course) as event:
+        copy_references(path, config, manifest, event, sources=sources)
+    return
+
+
+def copy_scripts(path, config, paths, manifest, event, sources=None):
+    """
+    Put the scripts into each of the notebook folders in `paths`, counting
+    them in the timing `event`.
+    """
+    for script in config.get('scripts') or []:
+        for p in paths:
+            copy_asset(pathlib.Path(KOSU['scripts-source']) / script, p / script, path, manifest, sources)
+            event['items'] += 1
+            event['bytes'] += os.path.getsize(pathlib.Path(KOSU['scripts-source']) / script)
+    return
+
+
+def copy_references(path, config, manifest, event, sources=None):
+    """
+    Put the references into their own folder, counting them in the timing
+    `event`.
+    """
+    if refs := config.get('references'):
+        ref_path = path.joinpath(KOSU['references-target'])
+        ref_path.mkdir(exist_ok=True)
+        for fname in refs:
+            copy_asset(pathlib.Path(KOSU['references-source']) / fname, ref_path / fname, path, manifest, sources)
+            event['items'] += 1
+            event['bytes'] += os.path.getsize(pathlib.Path(KOSU['references-source']) / fname)
+    return
 
 
-def build_notebooks(path, config):
+def build_notebooks(path, config, jobs=1, manifest=None, sources=None):
     """
     Process the notebook files. We'll look at three sections of the
     config: curriculum (which contains non-notebook items too),
     extras (which are listed in the README), and demos (which are not).
+    With more than one job, the notebooks are processed in a pool of
+    processes; the results are still merged in the order of the config.
+    Notebooks (and images) that the manifest says are up to date are
+    left alone. If `sources` is given, images are listed there instead
+    of being copied (see `copy_asset()`).
+    """
+    if manifest is None:
+        manifest = new_manifest()
+
+    notebooks = plan_notebooks(path, config, manifest)
+    with stage('notebooks', course=config['course']) as event:
+        results = process_notebooks(path, config, notebooks, manifest, event, jobs=jobs)
+    with stage('images', course=config['course']) as event:
+        copy_images(path, results, manifest, event, sources=sources)
+
+    data_urls_to_check = [url for _, urls, _ in results for url in urls]
+    data_files_to_check = [fname for _, _, files in results for fname in files]
+    return (*notebooks['paths'], data_urls_to_check, data_files_to_check)
+
+
+def plan_notebooks(path, config, manifest):
+    """
+    Work out how to process the notebooks (see `build_notebooks()`), and
+    which of them are up to date, without making or processing anything.
+
+    Returns:
+        dict. The master, notebook and demo folders ('paths'), the keyword
+            arguments to process each notebook with ('tasks'), its outputs
+            and signature ('sigs'), its references if it is up to date
+            ('results'), and the indexes of those that aren't ('todo').
     """
-    # Make the various directories.
     m_path = path.joinpath(KOSU['master-target'])
-    m_path.mkdir()
     nb_path = path.joinpath(KOSU['notebooks-target'])
-    nb_path.mkdir()
-    if config.get('demos'):
-        demo_path = path.joinpath(KOSU['demos-target'])
-        demo_path.mkdir()
-    else:
-        demo_path = None
+    demo_path = path.joinpath(KOSU['demos-target']) if config.get('demos') else None
 
     all_items = [f for items in config['curriculum'].values() for f in items]
     notebooks = list(filter(lambda item: '.ipynb' in item, all_items))
     notebooks += config.get('extras', list())
     kernel = config.get('environment', config['course']).lower()
-    images_to_copy = []
-    data_urls_to_check = []
-    data_files_to_check = []
-    click.secho('📔 Processing notebooks ', fg="cyan", nl=False)
-    for notebook in notebooks:
-        infile = pathlib.Path(KOSU['notebooks-source']) / notebook
-        outfile = nb_path / notebook
-        images, data_urls, data_paths = process_notebook(infile, outfile, kernel=kernel)
-        images_to_copy.extend(images)
-        data_urls_to_check.extend(data_urls)
-        data_files_to_check.extend(data_paths)
-        shutil.copyfile(infile, m_path / notebook)
-        # Clear the outputs in the master file.
-        _ = os.system("nbstripout {}".format(m_path / notebook))
-        click.secho('■', fg='cyan', nl=False)
-    notebooks = config.get('demos', list())
+
+    # Each notebook is independent, so they can be processed in parallel.
+    # Each job also writes the master file, with its outputs cleared.
+    source = pathlib.Path(KOSU['notebooks-source'])
+    stems = KOSU.get('data-url-stems')
+    tasks = []
     for notebook in notebooks:
-        infile = pathlib.Path(KOSU['notebooks-source']) / notebook
-        outfile = demo_path / notebook
-        images, data_urls, data_paths = process_notebook(infile, outfile, demo=True, kernel=kernel)
-        images_to_copy.extend(images)
-        data_urls_to_check.extend(data_urls)
-        data_files_to_check.extend(data_paths)
-        shutil.copyfile(infile, m_path / notebook)
-        # Clear the outputs in the master file.
-        _ = os.system("nbstripout {}".format(m_path / notebook))
-        click.secho('■', fg='cyan', nl=False)
+        tasks.append(dict(infile=source / notebook, outfile=nb_path / notebook,
+                          kernel=kernel, master=m_path / notebook, data_url_stems=stems))
+    for notebook in config.get('demos', list()):
+        tasks.append(dict(infile=source / notebook, outfile=demo_path / notebook,
+                          demo=True, kernel=kernel, master=m_path / notebook, data_url_stems=stems))
+
+    # Use the cache of processed notebooks, unless its size is set to 0.
+    if KOSU.get('cache-size', CACHE_SIZE):
+        for task in tasks:
+            task['cache_dir'] = KOSU.get('cache-dir', CACHE_DIR)
+
+    # Skip the notebooks that are up to date, but keep their references.
+    results, todo, sigs = [None] * len(tasks), [], []
+    for i, task in enumerate(tasks):
+        outputs = [task['outfile'].relative_to(path).as_posix(), task['master'].relative_to(path).as_posix()]
+        sig = signature(manifest, [task['infile']], demo=task.get('demo', False), kernel=kernel, stems=stems)
+        sigs.append((outputs, sig))
+        entry = fresh(manifest, path, outputs[0], sig)
+        if entry and fresh(manifest, path, outputs[1], sig):
+            results[i] = entry['refs']
+        else:
+            todo.append(i)
+
+    return {'paths': (m_path, nb_path, demo_path), 'tasks': tasks, 'sigs': sigs, 'results': results, 'todo': todo}
+
+
+def process_notebooks(path, config, notebooks, manifest, event, jobs=1):
+    """
+    Process the notebooks that `plan_notebooks()` found were not up to
+    date, and record them all in the manifest, counting them in the timing
+    `event`.
+
+    Returns:
+        list. The images, data URLs and data files of each notebook.
+    """
+    for folder in filter(None, notebooks['paths']):
+        folder.mkdir(exist_ok=True)
+
+    cache_dir = KOSU.get('cache-dir', CACHE_DIR)
+    cache_size = KOSU.get('cache-size', CACHE_SIZE)
+    func = cached_process_notebook if cache_size else process_notebook
+    if timing():
+        # Each notebook is timed where it is processed.
+        func = functools.partial(timed, func)
+
+    tasks, todo, results = notebooks['tasks'], notebooks['todo'], list(notebooks['results'])
+    click.secho('📔 Processing notebooks ', fg="cyan", nl=False)
+    click.secho('□' * (len(tasks) - len(todo)), fg='cyan', nl=False)
+    event['items'] = len(todo)
+    for i, refs in zip(todo, map_jobs(func, [tasks[i] for i in todo], jobs=jobs)):
+        if timing():
+            refs, notebook = refs
+            add_events([dict(notebook, course=config['course'])])
+            event['bytes'] += notebook['bytes']
+        results[i] = refs
+    for (outputs, sig), refs in zip(notebooks['sigs'], results):
+        for output in outputs:
+            record(manifest, output, sig, refs=refs)
+    if cache_size:
+        _ = evict(cache_dir, cache_size)
     click.secho()
+    return results
+
+
+def copy_images(path, results, manifest, event, sources=None):
+    """
+    Put the images that the notebooks use into the build, counting them in
+    the timing `event`.
+
+    Args:
+        results (list): The references of each notebook, from
+            `process_notebooks()`.
+    """
+    images_to_copy = [image for images, _, _ in results for image in images]
     if images_to_copy:
         img_path = path.joinpath(KOSU['images-target'])
-        img_path.mkdir()
-        for image in images_to_copy:
-            shutil.copyfile(pathlib.Path(KOSU['images-source']) / image, img_path / image)
+        img_path.mkdir(exist_ok=True)
+        for image in dict.fromkeys(images_to_copy):
+            copy_asset(pathlib.Path(KOSU['images-source']) / image, img_path / image, path, manifest, sources)
+            event['items'] += 1
+            event['bytes'] += os.path.getsize(pathlib.Path(KOSU['images-source']) / image)
+    return
 
-    return m_path, nb_path, demo_path, data_urls_to_check, data_files_to_check
+
+def copy_asset(src, dst, path, manifest, sources=None):
+    """
+    Put a file into the build at `path`, unless the manifest says the one
+    there is already up to date. It is hardlinked, reflinked, symlinked or
+    copied, according to `asset-links` in the control file, and a file with
+    the same contents as one already in the build is placed from that one.
+    If `sources` is given, the file is not put in the build at all, but
+    listed there to go straight into the ZIP.
+    """
+    if sources is not None:
+        sources[dst.relative_to(path.parent).as_posix()] = src
+        return
+    output = dst.relative_to(path).as_posix()
+    sig = signature(manifest, [src])
+    if not fresh(manifest, path, output, sig):
+        placed = manifest.setdefault('placed', {})
+        _ = place_once(src, dst, placed, file_hash(manifest, src), method=KOSU.get('asset-links', 'auto'))
+        record(manifest, output, sig)
+    return
+
+
+def write_if_changed(fname, text):
+    """
+    Write text to a file, unless the file already has exactly that text in
+    it. This keeps its modification time, so an incremental build does not
+    think it has changed.
+    """
+    try:
+        with open(fname, 'r') as f:
+            if f.read() == text:
+                return
+    except FileNotFoundError:
+        pass
+    with open(fname, 'w') as f:
+        f.write(text)
+    return
+
+
+def map_jobs(func, tasks, jobs=1, fg='cyan'):
+    """
+    Call `func` with each dict of keyword arguments in `tasks`, using a pool
+    of processes if there is more than one job. Prints a ■ as each call
+    finishes, whatever order they finish in.
+
+    Returns:
+        list. The results, in the same order as `tasks`.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs == 1 or len(tasks) < 2:
+        results = []
+        for task in tasks:
+            results.append(func(**task))
+            click.secho('■', fg=fg, nl=False)
+        return results
+
+    from concurrent.futures import as_completed
+    with process_pool(min(jobs, len(tasks))) as executor:
+        futures = [executor.submit(func, **task) for task in tasks]
+        with cancelling(futures):
+            for future in as_completed(futures):
+                _ = future.result()  # Raise the first error as soon as we see it.
+                click.secho('■', fg=fg, nl=False)
+    return [future.result() for future in futures]
+
+
+def process_pool(jobs):
+    """
+    A pool of `jobs` processes, to use in a `with` block. It is shut down
+    at the end, unless this is `kosu serve`, which keeps its pools so that
+    the processes are ready for the next command.
+
+    The processes are started by a fork server, or spawned where there
+    isn't one, never forked from this process: the pool is made by one of
+    the threads running the build's tasks, and a process forked while
+    another thread holds a lock hangs as soon as it needs that lock. So
+    that they process notebooks the same way as this process, they are
+    given the cell transforms registered here.
+    """
+    import multiprocessing
+    import pickle
+    from concurrent.futures import ProcessPoolExecutor
+    from . import customize
+
+    transforms = tuple(customize.CELL_TRANSFORMS)
+    try:
+        _ = pickle.dumps(transforms)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        message = f"The cell transforms can't be sent to other processes ({e}). "
+        message += "Define them at the top level of a module, or use --jobs 1."
+        raise Exception(message)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    kwargs = dict(max_workers=jobs, mp_context=multiprocessing.get_context(method),
+                  initializer=customize.use_transforms, initargs=(list(transforms),))
+    if not SERVING:
+        return ProcessPoolExecutor(**kwargs)
+    if (jobs, transforms) not in POOLS:
+        POOLS[jobs, transforms] = ProcessPoolExecutor(**kwargs)
+    return contextlib.nullcontext(POOLS[jobs, transforms])
+
+
+@contextlib.contextmanager
+def cancelling(futures):
+    """
+    Cancel the futures that haven't started yet if the `with` block fails,
+    so that a pool that is kept, or is being shut down, doesn't run them.
+    """
+    try:
+        yield
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def close_pools():
+    """
+    Shut down the pools kept by `kosu serve`. Any work that was left in
+    them has been cancelled already (see `cancelling()`).
+    """
+    while POOLS:
+        _, pool = POOLS.popitem()
+        pool.shutdown(wait=True)
+    return
 
 
 def build_environment(path, config):
     """Construct the environment.yaml file for this course."""
+    import yaml
+
     # Get the base environment.
-    with open(f'environment.yaml', 'r') as f:
-        try:
-            deps = yaml.safe_load(f)
-        except yaml.YAMLError as e:
-            print(e)
+    deps = read_yaml('environment.yaml')
 
     # Now add the course-specific stuff from the config.
     name = config.get('environment', config['course']).lower()
@@ -421,8 +1363,7 @@ def build_environment(path, config):
 
     # Write the new environment file to the course directory.
     # Despite YAML recommended practice, we need to use .yml for conda.
-    with open(path / 'environment.yml', 'w') as f:
-        f.write(yaml.dump(conda, default_flow_style=False, sort_keys=False))
+    write_if_changed(path / 'environment.yml', yaml.dump(conda, default_flow_style=False, sort_keys=False))
     return conda
 
 
@@ -437,18 +1378,48 @@ def build_readme(path, config):
                    curriculum=config.get('curriculum'),
                    extras=config.get('extras'),
                   )
-    template = env.get_template('README.md')
-    with open(path / 'README.md', 'w') as f:
-        f.write(template.render(**content))
+    template = templates().get_template('README.md')
+    write_if_changed(path / 'README.md', template.render(**content))
     return
 
 
-def build_data(path, config):
+@functools.lru_cache(maxsize=None)
+def templates():
+    """
+    The Jinja environment for the templates folder, made when first used.
+    """
+    from jinja2 import Environment, FileSystemLoader
+    return Environment(loader=FileSystemLoader('templates'))
+
+
+def build_data(path, config, manifest=None, connections=None, rate_limit=None):
     """Build the data directory. Files must exist in the given path
-    of the bucket of AWS S3, per the control file.
+    of the bucket of AWS S3, per the control file. Datasets that the
+    manifest says are up to date are not downloaded again, and the
+    others are only downloaded if they are not in the data cache or
+    have changed since they were cached. Several datasets are
+    downloaded at once, sharing `connections` connections and at most
+    `rate_limit` bytes per second. Zipped datasets are extracted once
+    per archive into the data cache, and linked from there.
+    """
+    if manifest is None:
+        manifest = new_manifest()
+    data = plan_data(path, config, manifest)
+    fetch_data(path, config, data, manifest, connections=connections, rate_limit=rate_limit)
+    return
+
+
+def plan_data(path, config, manifest):
+    """
+    Work out where the datasets are, and which of them are up to date (see
+    `build_data()`), without downloading anything.
+
+    Returns:
+        dict. The URL of the datasets ('data_url'), how many are up to date
+            ('fresh'), and the others, as tuples of URL, path, output and
+            signature ('todo').
     """
     data_path = path.joinpath('data')
-    data_path.mkdir()
 
     s3path = KOSU.get('s3-path', '')
     s3bucket = KOSU.get('s3-bucket')
@@ -458,53 +1429,140 @@ def build_data(path, config):
             raise TypeError("No data_url or s3-bucket specified.")
         data_url = f"https://{s3bucket}.s3.amazonaws.com/{s3path}{'/' if s3path else ''}"
 
-    if datasets := config.get('data'):
-        for fname in datasets:
-            click.secho('■', fg='bright_cyan', nl=False)
-            fpath = data_path / fname
-            if not fpath.exists():
-                url = f"{data_url}{fname}"
-                try:
-                    urlretrieve(url, fpath)
-                except urllib.error.HTTPError as e:
-                    raise urllib.error.HTTPError(f"Could not retrieve {url}: {e}")
+    todo, up_to_date = [], 0
+    for fname in config.get('data') or []:
+        fpath = data_path / fname
+        url = f"{data_url}{fname}"
+        output, sig = f'data/{fname}', signature(manifest, url=url)
+
+        # A zip is up to date if everything that came out of it is.
+        entry = manifest['outputs'].get(output)
+        if fpath.suffix == '.zip' and entry and entry['sig'] == sig:
+            if all([fresh(manifest, path, f'data/{m}', sig) for m in entry['refs']]):
+                record(manifest, output, sig, refs=entry['refs'])
+                up_to_date += 1
+                continue
+        elif fresh(manifest, path, output, sig):
+            up_to_date += 1
+            continue
+        todo.append((url, fpath, output, sig))
 
+    return {'data_url': data_url, 'fresh': up_to_date, 'todo': todo}
+
+
+def fetch_data(path, config, data, manifest, connections=None, rate_limit=None):
+    """
+    Get the datasets that `plan_data()` found were not up to date, and
+    record them in the manifest (see `build_data()`).
+    """
+    from .data import MAX_UNZIPPED, MAX_RATIO, get_datasets, extract_zip, parse_size
+    from .urls import make_session
+
+    data_path = path.joinpath('data')
+    data_path.mkdir(exist_ok=True)
+
+    # Datasets come via the machine-wide data cache, unless data-cache is false.
+    cache_dir = data_cache_dir()
+    connections = connections or KOSU.get('data-connections', 8)
+    if rate_limit is None:
+        rate_limit = parse_size(KOSU.get('data-rate-limit'))
+    max_unzipped = parse_size(KOSU.get('data-max-unzipped', MAX_UNZIPPED))
+
+    if config.get('data'):
+        click.secho('□' * data['fresh'], fg='bright_cyan', nl=False)
+        todo = data['todo']
+        with make_session(connections=connections) as session:
+            get_datasets([(url, fpath) for url, fpath, *_ in todo], session,
+                         cache_dir=cache_dir, connections=connections, rate=rate_limit)
+
+        for url, fpath, output, sig in todo:
             if fpath.suffix == '.zip':
-                # Inflate and delete the zip.
-                with zipfile.ZipFile(fpath, 'r') as z:
-                    z.extractall(data_path)
+                # Inflate (or link from the cache) and delete the zip.
+                members = extract_zip(fpath, data_path, cache_dir=cache_dir,
+                                      max_size=max_unzipped, max_ratio=KOSU.get('data-max-ratio', MAX_RATIO))
                 fpath.unlink()
+                for member in members:
+                    record(manifest, f'data/{member}', sig)
+                record(manifest, output, sig, refs=members)
+            else:
+                record(manifest, output, sig)
     else:
         data_path.joinpath('folder_should_be_empty.txt').touch()
+        record(manifest, 'data/folder_should_be_empty.txt', 'empty')
     return
 
 
 def upload_zip(file_name, bucket=None, object_name=None):
-    """Upload a file to an S3 bucket
+    """
+    Upload a file to an S3 bucket, as `kosu.upload.upload_zip()` does, with
+    the settings from the control file. Kept for scripts that import it
+    from here.
+
+    Args:
+        file_name (path): File to upload.
+        bucket (str): Bucket to upload to. Default: the `s3-bucket` setting.
+        object_name (str): S3 object name. If not specified then the name
+            of the file is used.
 
-    :param file_name: File to upload
-    :param bucket: Bucket to upload to
-    :param object_name: S3 object name. If not specified then file_name is used
-    :return: True if file was uploaded, else False
+    Returns:
+        bool. True if the file was uploaded (or was already there), else
+            False.
     """
-    if not AWS_AVAILABLE:
-        m = "AWS upload is not available. You need to install boto3 and botocore, "
-        m += "and set up AWS credentials. See the documentation for more information."
-        raise Exception(m)
+    from . import upload
 
     if bucket is None:
         bucket = KOSU['s3-bucket']
+    return upload.upload_zip(file_name, bucket, object_name=object_name, **upload_settings()) is not None
 
-    # If S3 object_name was not specified, use file_name.
-    if object_name is None:
-        object_name = os.path.basename(file_name)
 
-    # Upload the file.
-    s3_client = boto3.client('s3')
-    try:
-        args = {'ACL':'public-read'}
-        _ = s3_client.upload_file(file_name, bucket, object_name, ExtraArgs=args)
-    except ClientError as e:
-        warnings.warn("Upload to S3 failed:", e)
-        return False
-    return True
+def upload_settings():
+    """
+    The S3 client and transfer settings from the control file.
+
+    Returns:
+        dict. Keyword arguments for `upload_zip()`.
+    """
+    from .data import parse_size
+    from .upload import CHUNK_SIZE, CONCURRENCY, get_client
+
+    concurrency = KOSU.get('s3-concurrency', CONCURRENCY)
+    connections = concurrency * KOSU.get('upload-jobs', 4)
+    return {
+        'client': get_client(KOSU.get('s3-endpoint'), connections=connections),
+        'chunk_size': parse_size(KOSU.get('s3-chunk-size', CHUNK_SIZE)),
+        'concurrency': concurrency,
+    }
+
+
+def report_upload(file_name, result):
+    """
+    Say how the upload of a ZIP file went.
+    """
+    name = pathlib.Path(file_name).name
+    if result is None:
+        click.secho(f"❌ Failed to upload {name}", fg="red")
+        return
+    if result == 'unchanged':
+        click.secho(f"⏭️  {name} is already up to date", fg="green")
+    else:
+        click.secho(f"⬆️  Uploaded {name}", fg="green")
+    click.secho(f"🔗 File link: https://{KOSU['s3-bucket']}.s3.amazonaws.com/{name}", fg="green")
+    return
+
+
+def upload_courses(courses):
+    """
+    Upload the ZIP files of several courses at once.
+
+    Returns:
+        list. The courses whose upload failed.
+    """
+    from .upload import upload_zips
+
+    if not courses:
+        return []
+    jobs = KOSU.get('upload-jobs', 4)
+    click.secho(f"⬆️  Uploading {len(courses)} ZIP file(s), {min(jobs, len(courses))} at a time.", fg="cyan", bold=True)
+    results = upload_zips([f'{course}.zip' for course in courses], KOSU['s3-bucket'],
+                          jobs=jobs, callback=report_upload, **upload_settings())
+    return [course for course, result in zip(courses, results) if result is None]
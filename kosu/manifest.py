@@ -0,0 +1,160 @@
+"""
+Manifests recording what went into each file of a course build, so that an
+incremental build only redoes the files whose inputs have changed.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import hashlib
+import json
+import pathlib
+import shutil
+
+
+MANIFEST_DIR = pathlib.Path('build') / '.kosu-manifests'
+
+
+def new_manifest(settings=None):
+    """
+    Make an empty manifest, which has nothing up to date in it.
+
+    Args:
+        settings (dict): Things that change every output if they change,
+            like the kosu version and the control file.
+
+    Returns:
+        dict. The manifest.
+    """
+    return {
+        'settings': json.loads(json.dumps(settings, default=str)),
+        'files': {},     # Hashes of input files, keyed by path.
+        'outputs': {},   # From the last build: output path -> record.
+        'current': {},   # From this build: output path -> record.
+        'zip': {},       # What was in the ZIP file last time.
+        'placed': {},    # From this build: file hash -> where it was put.
+    }
+
+
+def load_manifest(course, settings):
+    """
+    Load the manifest from the last build of a course. If there wasn't one,
+    or the settings have changed since, the manifest is empty.
+
+    Returns:
+        dict. The manifest.
+    """
+    settings = json.loads(json.dumps(settings, default=str))
+    fname = MANIFEST_DIR / f'{course}.json'
+    try:
+        with open(fname) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return new_manifest(settings)
+    if manifest.get('settings') != settings:
+        return new_manifest(settings)
+    manifest['current'] = {}
+    manifest['placed'] = {}
+    return manifest
+
+
+def save_manifest(course, manifest):
+    """
+    Save the manifest for the next build. What was built this time becomes
+    what was built last time.
+    """
+    manifest = dict(manifest, outputs=manifest['current'], current={}, placed={})
+    MANIFEST_DIR.mkdir(parents=True, exist_ok=True)
+    with open(MANIFEST_DIR / f'{course}.json', 'w') as f:
+        json.dump(manifest, f)
+    return
+
+
+def remove_manifest(course):
+    """
+    Forget the last build of a course.
+    """
+    try:
+        (MANIFEST_DIR / f'{course}.json').unlink()
+    except FileNotFoundError:
+        pass
+    return
+
+
+def file_hash(manifest, fname):
+    """
+    Hash a file's contents. The hash is only computed again if the file's
+    size or modification time has changed since the last build.
+
+    Returns:
+        str. A SHA-256 hex digest.
+    """
+    stat = pathlib.Path(fname).stat()
+    key = str(fname)
+    size, mtime, digest = manifest['files'].get(key, (None, None, None))
+    if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+        h = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        manifest['files'][key] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+
+def signature(manifest, inputs=(), **options):
+    """
+    Combine the hashes of some input files with some options into a single
+    signature for an output.
+
+    Returns:
+        str. A SHA-256 hex digest.
+    """
+    parts = [[str(fname), file_hash(manifest, fname)] for fname in inputs]
+    text = json.dumps([parts, options], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def record(manifest, output, sig, refs=None):
+    """
+    Record that an output was made with the given signature. Anything else
+    we need to remember about it, such as the references in a notebook, can
+    be kept in `refs`.
+    """
+    manifest['current'][str(output)] = {'sig': sig, 'refs': refs}
+    return
+
+
+def fresh(manifest, path, output, sig, keep=True):
+    """
+    Check whether an output exists and was made with this signature last
+    time. If it was, it's recorded as part of this build too, unless `keep`
+    is False.
+
+    Returns:
+        dict. The record, or None if the output needs to be made again.
+    """
+    entry = manifest['outputs'].get(str(output))
+    if (entry is None) or (entry['sig'] != sig) or not (path / output).exists():
+        return None
+    if keep:
+        manifest['current'][str(output)] = entry
+    return entry
+
+
+def remove_stale(manifest, path, prefix=''):
+    """
+    Delete the outputs (under `prefix`) that were made last time but
+    not this time.
+
+    Returns:
+        list. The outputs that were removed.
+    """
+    stale = [o for o in manifest['outputs'] if o.startswith(prefix) and o not in manifest['current']]
+    for output in stale:
+        target = path / output
+        if target.is_dir():
+            shutil.rmtree(target, ignore_errors=True)
+        elif target.exists():
+            target.unlink()
+        del manifest['outputs'][output]
+    return stale
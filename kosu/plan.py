@@ -0,0 +1,245 @@
+"""
+Build plans: the tasks that building a course takes, and what each one
+depends on, worked out before anything is done. `kosu plan` shows them,
+and the build runs them, each task as soon as the ones it depends on are
+done, so that downloading data, checking URLs and processing notebooks
+happen at the same time.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import click
+
+from .timings import profiling, stage
+
+
+THREADS = 8  # The most tasks to run at once.
+
+# The name of the task that is running, so we know whose output is whose.
+TASK = contextvars.ContextVar('task', default=None)
+
+
+def new_task(name, run, stage=None, after=(), items=()):
+    """
+    Make a task.
+
+    Args:
+        name (str): What the task is called; unique in the plan.
+        run (callable): Does the task. It is called with the results of
+            the tasks so far, by name, and the timing event for the task,
+            whose 'items' and 'bytes' it can set; it returns the result.
+        stage (str): The stage of the build it is timed as. Default: the
+            name.
+        after (list): The names of the tasks it depends on.
+        items (list): The things it will deal with (see `new_item()`).
+
+    Returns:
+        dict. The task.
+    """
+    return {'name': name, 'stage': stage or name, 'after': list(after), 'items': list(items), 'run': run}
+
+
+def new_item(name, size=0, todo=True, cached=False, estimated=False):
+    """
+    Make an item for a task: a file to make, copy or download.
+
+    Args:
+        name (str): The file.
+        size (int): Its size in bytes, if known, otherwise None.
+        todo (bool): Whether there is anything to do; False if the build
+            already has it up to date.
+        cached (bool): Whether it is in a cache, so will be linked, not
+            made or downloaded.
+        estimated (bool): Whether it might turn out not to be needed.
+
+    Returns:
+        dict. The item.
+    """
+    return {'name': name, 'bytes': size, 'todo': todo, 'cached': cached, 'estimated': estimated}
+
+
+def file_size(fname):
+    """
+    The size of a file in bytes, or None if it doesn't exist.
+    """
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return None
+
+
+def check_plan(tasks):
+    """
+    Check that every task comes after the tasks it depends on.
+    """
+    seen = set()
+    for task in tasks:
+        if missing := [name for name in task['after'] if name not in seen]:
+            raise Exception(f"Task {task['name']} comes before {', '.join(missing)}, which it depends on.")
+        seen.add(task['name'])
+    return
+
+
+class Console:
+    """
+    Stands in for stdout while tasks run at once, so that what they print
+    doesn't get mixed up. The first task to print something prints as it
+    goes; what the others print is held back, and printed all together
+    once they have finished and the first one has too.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.encoding = getattr(stream, 'encoding', 'utf-8')
+        self.lock = threading.Lock()
+        self.owner = None
+        self.held = {}
+        self.done = []
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode(self.encoding, errors='replace')
+        task = TASK.get()
+        with self.lock:
+            if task is not None and self.owner is None:
+                self.owner = task
+                self.stream.write(''.join(self.held.pop(task, [])))
+            if task is None or task == self.owner:
+                return self.stream.write(text)
+            self.held.setdefault(task, []).append(text)
+            return len(text)
+
+    def finish(self, task):
+        """
+        Print what a task held back, if nothing else is printing.
+        """
+        with self.lock:
+            if self.owner == task:
+                self.owner = None
+            self.done.extend(self.held.pop(task, []))
+            if self.owner is None and self.done:
+                self.stream.write(''.join(self.done))
+                self.done = []
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return self.stream.isatty()
+
+
+def run_task(course, task, results, console=None):
+    """
+    Run a task, timing it as a stage of the build.
+
+    Returns:
+        The task's result.
+    """
+    token = TASK.set(task['name'])
+    try:
+        with stage(task['stage'], course=course) as event:
+            return task['run'](results, event)
+    finally:
+        TASK.reset(token)
+        if console is not None:
+            console.finish(task['name'])
+
+
+def run_plan(plan, threads=THREADS):
+    """
+    Run the tasks of a plan. Each task starts as soon as the tasks it
+    depends on are done, in a pool of threads; a task that has its own
+    pool of processes, like processing the notebooks, uses that too. If a
+    task fails, no more are started, so nothing that depends on it runs;
+    the tasks already running are left to finish, then the error is
+    raised. With one thread, or while profiling (which only sees this
+    thread), the tasks run one at a time, in order.
+
+    Args:
+        plan (dict): The plan, as from `kosu.kosu.plan_course()`.
+        threads (int): The most tasks to run at once.
+
+    Returns:
+        dict. The result of each task, by name.
+    """
+    check_plan(plan['tasks'])
+    results = {}
+    if threads == 1 or profiling():
+        for task in plan['tasks']:
+            results[task['name']] = run_task(plan['course'], task, results)
+        return results
+
+    waiting, running, errors = list(plan['tasks']), {}, []
+    console = Console(sys.stdout)
+    with contextlib.redirect_stdout(console), ThreadPoolExecutor(max_workers=threads) as executor:
+        while running or (waiting and not errors):
+            ready = [] if errors else [t for t in waiting if all(name in results for name in t['after'])]
+            for task in ready:
+                waiting.remove(task)
+                future = executor.submit(run_task, plan['course'], task, results, console)
+                running[future] = task
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    results[task['name']] = future.result()
+                except Exception as e:
+                    errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def summarize_task(task):
+    """
+    Add up the items of a task.
+
+    Returns:
+        dict. The number of items ('files'), how many need doing, how many
+            of those are cached, their size, how many are of unknown size,
+            and whether any of the items are estimates.
+    """
+    items = task['items']
+    todo = [item for item in items if item['todo']]
+    return {
+        'files': len(items),
+        'todo': len(todo),
+        'cached': sum(item['cached'] for item in todo),
+        'bytes': sum(item['bytes'] or 0 for item in todo),
+        'unknown': sum(item['bytes'] is None for item in todo),
+        'estimated': any(item['estimated'] for item in items),
+    }
+
+
+def describe_plan(plan):
+    """
+    The plan without its functions, with totals, ready to save as JSON.
+
+    Returns:
+        dict. The plan.
+    """
+    tasks = [dict({k: v for k, v in task.items() if k != 'run'}, **summarize_task(task)) for task in plan['tasks']]
+    totals = {key: sum(task[key] for task in tasks) for key in ['files', 'todo', 'cached', 'bytes', 'unknown']}
+    return dict({k: v for k, v in plan.items() if k != 'tasks'}, tasks=tasks, totals=totals)
+
+
+def print_plan(plan):
+    """
+    Print a table of the tasks of a plan (from `describe_plan()`).
+    """
+    from .data import human_size
+
+    click.secho(f"🗺️  {plan['course']}: {plan['totals']['todo']} of {plan['totals']['files']} files to do, "
+                f"{plan['totals']['cached']} from caches, {human_size(plan['totals']['bytes'])}", fg="cyan", bold=True)
+    for task in plan['tasks']:
+        size = human_size(task['bytes']) + (f" + {task['unknown']} unknown" if task['unknown'] else '')
+        after = f"after {', '.join(task['after'])}" if task['after'] else ''
+        note = '~' if task['estimated'] else ' '
+        click.secho(f"   {task['name']:<12}{note}{task['todo']:>5} of {task['files']:<5}{task['cached']:>5} cached{size:>16}   {after}", fg="cyan")
+    return
@@ -0,0 +1,97 @@
+"""
+Finding the images, data files and data URLs that notebooks refer to, with
+one precompiled pattern that finds all three kinds in a single scan.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import functools
+import re
+
+
+# What the name of an image or data file can look like.
+NAME = r"[-_.a-zA-Z0-9]+"
+
+# Where the data in the notebooks is, unless .kosu.yaml says otherwise.
+DATA_URL_STEMS = ['https://geocomp.s3.amazonaws.com/data/']
+
+# The kinds of reference, in the order process_notebook() returns them.
+KINDS = ['images', 'data_urls', 'data_files']
+
+
+def url_stems(urls=None):
+    """
+    Make the patterns for some data URL stems, which are just the start of
+    the URLs, like 'https://geocomp.s3.amazonaws.com/data/'.
+
+    Args:
+        urls (list): The stems. Default: `DATA_URL_STEMS`.
+
+    Returns:
+        tuple. Regular expressions matching the stems.
+    """
+    if isinstance(urls, str):
+        urls = [urls]
+    return tuple(re.escape(url) for url in (urls or DATA_URL_STEMS))
+
+
+@functools.lru_cache(maxsize=None)
+def reference_pattern(stems=None, binary=False):
+    """
+    Compile the pattern for all three kinds of reference, once for each set
+    of data URL stems. Each kind is a named group.
+
+    Args:
+        stems (tuple): Regular expressions for the start of data URLs.
+            Default: the patterns for `DATA_URL_STEMS`.
+        binary (bool): Whether to make a pattern for bytes instead of str.
+
+    Returns:
+        re.Pattern.
+    """
+    stems = stems or url_stems()
+    pattern = (fr"\.\./images/(?P<images>{NAME})"
+               fr"|\.\./data/(?P<data_files>{NAME})"
+               fr"|(?P<data_urls>(?:{'|'.join(stems)}){NAME})"
+               )
+    return re.compile(pattern.encode() if binary else pattern)
+
+
+def new_references():
+    """
+    Make an empty set of references.
+
+    Returns:
+        dict. An empty list for each kind of reference.
+    """
+    return {kind: [] for kind in KINDS}
+
+
+def find_references(text, pattern=None, refs=None, pos=0, endpos=None):
+    """
+    Find the images, data files and data URLs in some text, in one pass.
+
+    Args:
+        text (str or bytes): The text to search; if bytes, the pattern must
+            be a binary one.
+        pattern (re.Pattern): From `reference_pattern()`. Default: the
+            pattern for the default data URL stems.
+        refs (dict): References found already, which will be added to.
+        pos (int): Where in the text to start looking.
+        endpos (int): Where in the text to stop looking. Default: the end.
+
+    Returns:
+        dict. A list of references of each kind, in the order they were
+            found.
+    """
+    if pattern is None:
+        pattern = reference_pattern()
+    if refs is None:
+        refs = new_references()
+    if endpos is None:
+        endpos = len(text)
+    for match in pattern.finditer(text, pos, endpos):
+        kind = match.lastgroup
+        ref = match.group(kind)
+        refs[kind].append(ref if isinstance(ref, str) else ref.decode())
+    return refs
@@ -0,0 +1,144 @@
+"""
+A server that keeps kosu running between commands, and the client that
+sends commands to it, over a Unix socket in the build folder. Each message
+is a line of JSON.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import contextlib
+import json
+import os
+import pathlib
+import socket
+import sys
+
+
+SOCKET_FILE = pathlib.Path('build') / '.kosu.sock'
+
+
+class Output:
+    """
+    A text stream that sends whatever is written to it to the client.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode(self.encoding, errors='replace')
+        if text:
+            self.conn.sendall(json.dumps({'out': text}).encode() + b'\n')
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def available():
+    """
+    Whether this platform has Unix sockets.
+    """
+    return hasattr(socket, 'AF_UNIX')
+
+
+def connect(fname=SOCKET_FILE):
+    """
+    Connect to the server, if there is one.
+
+    Returns:
+        socket.socket, or None if no server is listening at `fname`.
+    """
+    if not (available() and os.path.exists(fname)):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(fname))
+    except OSError:  # E.g. a socket left behind by a server that crashed.
+        sock.close()
+        return None
+    return sock
+
+
+def send_request(message, fname=SOCKET_FILE, write=None):
+    """
+    Send a command to the server, and pass on what it prints as it prints
+    it.
+
+    Args:
+        message (dict): The command, with 'command' and 'cwd'.
+        fname (path): The server's socket.
+        write (callable): What to do with the output. Default: write it to
+            stdout.
+
+    Returns:
+        int. The command's exit code, or None if there is no server here,
+            or it won't run the command; then it should run here instead.
+            If the server goes away after starting the command, it is 1.
+    """
+    sock = connect(fname)
+    if sock is None:
+        return None
+    write = write or sys.stdout.write
+    started = False
+    with sock, sock.makefile('rb') as f:
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        for line in f:
+            reply = json.loads(line)
+            if 'out' in reply:
+                started = True
+                write(reply['out'])
+            else:
+                return reply.get('exit')
+    return 1 if started else None  # The server went away.
+
+
+def run_server(handler, fname=SOCKET_FILE):
+    """
+    Run commands sent by clients, one at a time, until asked to stop with
+    the 'stop' command. Whatever is printed while a command runs goes back
+    to its client.
+
+    Args:
+        handler (callable): Runs a command. Called with the message, it
+            returns the exit code.
+        fname (path): Where to put the socket.
+    """
+    if (sock := connect(fname)) is not None:
+        sock.close()
+        raise Exception(f"kosu is already being served at {fname}.")
+    pathlib.Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(fname)
+    cwd = os.getcwd()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(str(fname))
+        server.listen()
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile('rb') as f:
+                try:
+                    message = json.loads(f.readline())
+                    if message.get('command') == 'stop':
+                        conn.sendall(json.dumps({'exit': 0}).encode() + b'\n')
+                        return
+                    if message.get('cwd') != cwd:
+                        # The client is somewhere else; it can do it itself.
+                        conn.sendall(json.dumps({'exit': None}).encode() + b'\n')
+                        continue
+                    output = Output(conn)
+                    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                        code = handler(message)
+                    conn.sendall(json.dumps({'exit': code}).encode() + b'\n')
+                except (OSError, ValueError):
+                    pass  # The client went away, or didn't make sense.
+    finally:
+        server.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(fname)
@@ -0,0 +1,340 @@
+"""
+Processing very large notebooks a cell at a time. The notebook file is
+mapped into memory and indexed rather than parsed, and each cell is decoded
+only when its turn comes, without the outputs that are going to be stripped
+anyway, then written straight out. So peak memory is about the size of the
+biggest cell, instead of several times the size of the file.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import json
+import mmap
+import re
+import shutil
+
+from .references import find_references, reference_pattern
+from .customize import (NBFORMAT_JSON,
+                        keep_output, strip_cell_output, strip_metadata, transform_cell,
+                        format_cell, format_metadata, change_kernel, hide_toolbar)
+
+
+WHITESPACE = re.compile(rb'[ \t\n\r]*')
+SPECIAL = re.compile(rb'["\[\]{}]')  # A string or a bracket.
+SCALAR = re.compile(rb'[^,\]}\s]+')
+
+
+def _skip_space(buf, pos):
+    return WHITESPACE.match(buf, pos).end()
+
+
+def _expect(buf, pos, char):
+    if buf[pos:pos + 1] != char:
+        raise json.JSONDecodeError(f"Expecting {char.decode()!r}", '', pos)
+    return pos + 1
+
+
+def skip_string(buf, pos):
+    """
+    Find the end of the JSON string that starts at `pos`. Looking for the
+    closing quote with `find()` is much faster than a regex, which matters
+    for long strings like images.
+
+    Returns:
+        int. The position just after the string.
+    """
+    end = pos
+    while True:
+        end = buf.find(b'"', end + 1)
+        if end == -1:
+            raise json.JSONDecodeError("Unterminated string", '', pos)
+        # The quote is escaped if there are an odd number of backslashes before it.
+        start = end
+        while buf[start - 1] == ord('\\'):
+            start -= 1
+        if (end - start) % 2 == 0:
+            return end + 1
+
+
+def skip_value(buf, pos):
+    """
+    Find the end of the JSON value that starts at `pos`, without decoding
+    it or copying any of it.
+
+    Returns:
+        int. The position just after the value.
+    """
+    char = buf[pos:pos + 1]
+    if char == b'"':
+        return skip_string(buf, pos)
+    if char in (b'[', b'{'):
+        depth = 0
+        while True:
+            match = SPECIAL.search(buf, pos)
+            if match is None:
+                raise json.JSONDecodeError("Unterminated value", '', pos)
+            pos = match.start()
+            char = buf[pos:pos + 1]
+            if char == b'"':
+                pos = skip_string(buf, pos)
+                continue
+            depth += 1 if char in (b'[', b'{') else -1
+            pos += 1
+            if depth == 0:
+                return pos
+    match = SCALAR.match(buf, pos)
+    if match is None:
+        raise json.JSONDecodeError("Expecting value", '', pos)
+    return match.end()
+
+
+def index_object(buf, pos):
+    """
+    Index the JSON object that starts at `pos`.
+
+    Returns:
+        tuple. A dict mapping each key to the (start, end) of its value, and
+            the position just after the object.
+    """
+    pos = _expect(buf, _skip_space(buf, pos), b'{')
+    spans = {}
+    pos = _skip_space(buf, pos)
+    if buf[pos:pos + 1] == b'}':
+        return spans, pos + 1
+    while True:
+        if buf[pos:pos + 1] != b'"':
+            raise json.JSONDecodeError("Expecting property name", '', pos)
+        end = skip_string(buf, pos)
+        key = json.loads(buf[pos:end])
+        pos = _expect(buf, _skip_space(buf, end), b':')
+        start = _skip_space(buf, pos)
+        end = skip_value(buf, start)
+        spans[key] = (start, end)
+        pos = _skip_space(buf, end)
+        if buf[pos:pos + 1] == b'}':
+            return spans, pos + 1
+        pos = _skip_space(buf, _expect(buf, pos, b','))
+
+
+def index_array(buf, pos):
+    """
+    Index the JSON array that starts at `pos`.
+
+    Returns:
+        list. The (start, end) of each item.
+    """
+    pos = _expect(buf, _skip_space(buf, pos), b'[')
+    spans = []
+    pos = _skip_space(buf, pos)
+    if buf[pos:pos + 1] == b']':
+        return spans
+    while True:
+        end = skip_value(buf, pos)
+        spans.append((pos, end))
+        pos = _skip_space(buf, end)
+        if buf[pos:pos + 1] == b']':
+            return spans
+        pos = _skip_space(buf, _expect(buf, pos, b','))
+
+
+def decode(buf, span):
+    """
+    Decode the JSON value at `span` in the buffer.
+    """
+    return json.loads(buf[span[0]:span[1]])
+
+
+def is_empty(buf, span):
+    """
+    Whether the JSON array or object at `span` has nothing in it.
+    """
+    return _skip_space(buf, span[0] + 1) == span[1] - 1
+
+
+def load_cell(buf, span, strip):
+    """
+    Decode a cell. If it is going to be stripped, and its outputs are not to
+    be kept, they are not decoded at all but replaced by an empty list.
+
+    Returns:
+        tuple. The cell, and the span of the outputs that were left out, if
+            they were not empty.
+    """
+    spans, _ = index_object(buf, span[0])
+    metadata = decode(buf, spans['metadata']) if 'metadata' in spans else {}
+    skipped = None
+    cell = {}
+    for key, value in spans.items():
+        if key == 'outputs' and strip and not keep_output({'metadata': metadata}):
+            cell[key] = []
+            if not is_empty(buf, value):
+                skipped = value
+        elif key == 'metadata':
+            cell[key] = metadata
+        else:
+            cell[key] = decode(buf, value)
+    return cell, skipped
+
+
+def write_json(f, top, cells, nbformat):
+    """
+    Write a notebook whose cells come one at a time, already serialised,
+    exactly as `json.dumps()` would have written the whole thing, with
+    either the nbformat layout or the default one.
+    """
+    if nbformat:
+        keys, item_sep, cell_sep, start, end = sorted(top), ',\n ', ',\n  ', '[\n  ', '\n ]'
+        f.write('{\n ')
+    else:
+        keys, item_sep, cell_sep, start, end = list(top), ', ', ', ', '[', ']'
+        f.write('{')
+    for i, key in enumerate(keys):
+        f.write((item_sep if i else '') + json.dumps(key, ensure_ascii=not nbformat) + ': ')
+        if key == 'cells':
+            first = True
+            for cell in cells:
+                f.write((start if first else cell_sep) + cell)
+                first = False
+            f.write('[]' if first else end)
+        elif nbformat:
+            f.write(json.dumps(top[key], **NBFORMAT_JSON).replace('\n', '\n '))
+        else:
+            f.write(json.dumps(top[key]))
+    f.write('\n}\n' if nbformat else '}')
+    return
+
+
+def dump_cell(cell):
+    """
+    Serialise a cell as it appears in a notebook with the nbformat layout.
+    """
+    return json.dumps(format_cell(cell), **NBFORMAT_JSON).replace('\n', '\n  ')
+
+
+def _notebook_top(buf):
+    """
+    Index the notebook, and decode everything but the cells.
+    """
+    spans, _ = index_object(buf, 0)
+    top = {key: (None if key == 'cells' else decode(buf, span)) for key, span in spans.items()}
+    cells = index_array(buf, spans['cells'][0]) if 'cells' in spans else []
+    return top, cells
+
+
+def output_texts(buf, span):
+    """
+    Find the text in some outputs that might mention files, without
+    decoding them; that is, everything but the images, as `_cell_texts()`
+    does.
+
+    Returns:
+        list. The (start, end) of each piece of text.
+    """
+    texts = []
+    for output in index_array(buf, span[0]):
+        spans, _ = index_object(buf, output[0])
+        for key, value in spans.items():
+            if key == 'data':
+                data, _ = index_object(buf, value[0])
+                for mime, text in data.items():
+                    if mime == 'image/svg+xml' or not mime.startswith('image/'):
+                        texts.append(text)
+            elif key in ['text', 'traceback', 'evalue']:
+                texts.append(value)
+    return texts
+
+
+def stream_master(buf, infile, master):
+    """
+    Write a stripped copy of the notebook, a cell at a time. As with
+    `write_stripped()`, the file is copied as it is if there was nothing
+    to strip.
+    """
+    top, cell_spans = _notebook_top(buf)
+    changed = strip_metadata(top)
+    top['metadata'] = format_metadata(top['metadata'])
+
+    def cells():
+        nonlocal changed
+        for i, span in enumerate(cell_spans):
+            cell, skipped = load_cell(buf, span, strip=True)
+            changed = strip_cell_output(cell, i) or changed or (skipped is not None)
+            yield dump_cell(cell)
+
+    with open(master, 'w', encoding='utf-8') as f:
+        write_json(f, top, cells(), nbformat=True)
+    if not changed:
+        shutil.copyfile(infile, master)
+    return
+
+
+def stream_notebook(infile, outfile, context, kernel=None, master=None):
+    """
+    Does what `process_notebook()` does, but a cell at a time: each cell
+    is decoded, put through the cell transforms and written out before the
+    next one is looked at.
+
+    Args:
+        infile (path): The notebook.
+        outfile (path): Where to write the processed notebook.
+        context (dict): The options and collected references, as made by
+            `process_notebook()`.
+        kernel (str): The kernel to change to, if any.
+        master (path): Where to write a stripped copy of the input, if at all.
+
+    Returns:
+        None.
+    """
+    with open(infile, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if master is not None:
+            stream_master(buf, infile, master)
+        _stream_notebook(buf, outfile, context, kernel)
+    return
+
+
+def _stream_notebook(buf, outfile, context, kernel):
+    top, cell_spans = _notebook_top(buf)
+    if kernel is not None:
+        top = change_kernel(top, kernel)
+    top = hide_toolbar(top)
+    strip = context['strip']
+    if strip:
+        context['changed'] = strip_metadata(top) or context.get('changed', False)
+
+    # If nothing gets stripped, the notebook is written with the default
+    # layout instead, so we keep that version until something is.
+    plain = []
+
+    def cells():
+        kept = 0
+        for span in cell_spans:
+            context['index'] = kept
+            cell, skipped = load_cell(buf, span, strip)
+            cell = transform_cell(cell, context)
+            if cell is None:
+                continue
+            kept += 1
+            if skipped is not None:
+                # The outputs weren't decoded, but their text might mention files.
+                context['changed'] = True
+                pattern = reference_pattern(context['url_stems'], binary=True)
+                for start, end in output_texts(buf, skipped):
+                    _ = find_references(buf, pattern, refs=context, pos=start, endpos=end)
+            if not strip:
+                yield json.dumps(cell)
+                continue
+            if context['changed']:
+                plain.clear()
+            else:
+                plain.append(json.dumps(cell))
+            yield dump_cell(cell)
+
+    with open(outfile, 'w', encoding='utf-8') as f:
+        if strip:
+            write_json(f, dict(top, metadata=format_metadata(top['metadata'])), cells(), nbformat=True)
+        else:
+            write_json(f, top, cells(), nbformat=False)
+    if strip and not context['changed']:
+        with open(outfile, 'w', encoding='utf-8') as f:
+            write_json(f, top, plain, nbformat=False)
+    return
@@ -0,0 +1,232 @@
+"""
+Timing the stages of a build, and each notebook, to find out where the time
+goes. The timings can be printed as a table, and saved as a trace that
+chrome://tracing or https://ui.perfetto.dev can show.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+import click
+
+
+# Where --timings and --profile write their results.
+TIMINGS_FILE = 'kosu-timings.json'
+PROFILE_FILE = 'kosu.prof'
+
+# The events recorded in this process, or None if timing is off.
+EVENTS = None
+
+# Whether this process is being profiled.
+PROFILING = False
+
+
+def start_timing():
+    """
+    Start recording events in this process, forgetting any from before.
+    """
+    global EVENTS
+    EVENTS = []
+    return
+
+
+def stop_timing():
+    """
+    Stop recording events.
+
+    Returns:
+        list. The events recorded since timing started.
+    """
+    global EVENTS
+    events, EVENTS = EVENTS or [], None
+    return events
+
+
+def timing():
+    """
+    Whether timing is on in this process.
+    """
+    return EVENTS is not None
+
+
+def profiling():
+    """
+    Whether this process is being profiled. `cProfile` only sees the thread
+    it was started in, so the build runs its tasks one at a time if so.
+    """
+    return PROFILING
+
+
+def add_events(events):
+    """
+    Add events recorded elsewhere, such as in another process.
+    """
+    if EVENTS is not None:
+        EVENTS.extend(events)
+    return
+
+
+def new_event(name, **info):
+    """
+    Make an event starting now. It is finished by `end_event()`.
+
+    Returns:
+        dict. The event.
+    """
+    event = {'name': name, 'bytes': 0, 'items': 0, 'pid': os.getpid(), 'tid': threading.get_ident()}
+    event.update(info)
+    event['start'] = time.time()
+    return event
+
+
+def end_event(event):
+    """
+    Finish an event, and record it if timing is on.
+    """
+    event['end'] = time.time()
+    if EVENTS is not None:
+        EVENTS.append(event)
+    return event
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """
+    Time a stage of the build. Set 'bytes' and 'items' in the event that
+    is yielded to record how much the stage handled.
+
+    Example:
+        with stage('data', course='geocomp') as event:
+            event['items'] = len(datasets)
+    """
+    event = new_event(name, **info)
+    try:
+        yield event
+    finally:
+        end_event(event)
+
+
+def timed(func, **kwargs):
+    """
+    Call `func`, timing it as a notebook. Used in place of the function
+    itself in a pool of processes, since the timings can't be recorded
+    there; they come back with the result.
+
+    Returns:
+        tuple. The result, and the event.
+    """
+    event = new_event('notebook', file=str(kwargs['infile']), items=1)
+    event['bytes'] = os.path.getsize(kwargs['infile'])
+    result = func(**kwargs)
+    event['end'] = time.time()
+    return result, event
+
+
+def tree_size(path):
+    """
+    The number of files under a path, and their total size.
+
+    Returns:
+        tuple. The number of files and bytes.
+    """
+    files, size = 0, 0
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, fname))
+    return files, size
+
+
+def summarize(events):
+    """
+    Add up the events for each stage, in the order the stages first started.
+
+    Returns:
+        list. A dict for each stage, with the number of times it ran, the
+            items and bytes it handled, and the time it took in seconds.
+    """
+    stages = {}
+    for event in sorted(events, key=lambda e: e['start']):
+        row = stages.setdefault(event['name'], {'stage': event['name'], 'count': 0, 'items': 0, 'bytes': 0, 'seconds': 0})
+        row['count'] += 1
+        row['items'] += event['items']
+        row['bytes'] += event['bytes']
+        row['seconds'] += event['end'] - event['start']
+    return list(stages.values())
+
+
+def print_timings(events, slowest=5):
+    """
+    Print a table of the time taken by each stage, followed by the slowest
+    notebooks. The times are added up, so stages that ran at the same time,
+    like notebooks in parallel, can add up to more than the wall time.
+    """
+    rows = summarize(events)
+    if not rows:
+        return
+    click.secho(f"⏱  {'Stage':<16}{'Runs':>6}{'Items':>8}{'MB':>10}{'Seconds':>10}{'MB/s':>10}", fg="cyan", bold=True)
+    for row in rows:
+        rate = f"{row['bytes'] / 1e6 / row['seconds']:.1f}" if row['bytes'] and row['seconds'] else ''
+        click.secho(f"   {row['stage']:<16}{row['count']:>6}{row['items']:>8}{row['bytes'] / 1e6:>10.1f}{row['seconds']:>10.2f}{rate:>10}", fg="cyan")
+    notebooks = sorted([e for e in events if e['name'] == 'notebook'], key=lambda e: e['start'] - e['end'])
+    if notebooks:
+        click.secho(f"🐢 Slowest notebooks:", fg="cyan", bold=True)
+        for event in notebooks[:slowest]:
+            click.secho(f"   {event['end'] - event['start']:6.2f} s  {event.get('course', '')} {event['file']}", fg="cyan")
+    return
+
+
+def write_trace(events, fname):
+    """
+    Save the events in the Chrome trace format: a JSON file with a complete
+    ('X') event for each, in microseconds. Everything else about an event is
+    kept in its 'args'. The summary by stage is kept too.
+    """
+    origin = min([e['start'] for e in events], default=0)
+    trace = []
+    for event in events:
+        args = {k: v for k, v in event.items() if k not in ['name', 'start', 'end', 'pid', 'tid']}
+        trace.append({'name': event['name'], 'cat': 'kosu', 'ph': 'X',
+                      'ts': round(1e6 * (event['start'] - origin)),
+                      'dur': round(1e6 * (event['end'] - event['start'])),
+                      'pid': event['pid'], 'tid': event['tid'], 'args': args})
+    with open(fname, 'w') as f:
+        json.dump({'traceEvents': trace, 'stages': summarize(events)}, f, indent=1)
+    return
+
+
+@contextlib.contextmanager
+def instrument(timings=None, profile=None):
+    """
+    Time the stages of whatever runs inside, and/or profile it.
+
+    Args:
+        timings (path): Where to write the trace, if timing.
+        profile (path): Where to write the cProfile stats, if profiling.
+    """
+    global PROFILING
+    profiler = cProfile.Profile() if profile else None
+    if timings:
+        start_timing()
+    if profiler is not None:
+        PROFILING = True
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            PROFILING = False
+            profiler.dump_stats(profile)
+            click.secho(f"🔬 Profile written to {profile}; see it with `python -m pstats {profile}`.", fg="green")
+        if timings:
+            events = stop_timing()
+            print_timings(events)
+            write_trace(events, timings)
+            click.secho(f"⏱  Timings written to {timings}; open it in chrome://tracing or ui.perfetto.dev.", fg="green")
@@ -0,0 +1,129 @@
+"""
+Making and removing the trees of files in the build folder. A course is
+built in a temporary folder beside its old build, which it replaces only
+once it is complete, so an interrupted build never leaves a half-made
+course behind. Trees are removed by first moving them out of the way,
+which is instant, then deleting their files in parallel.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import contextlib
+import os
+import pathlib
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+TEMP_PREFIX = '.kosu-tmp-'
+TRASH_PREFIX = '.kosu-trash-'
+BATCH = 256  # Files to delete in each job.
+
+
+def temp_tree(target):
+    """
+    Make an empty folder to build `target` in. It has the same name as
+    `target`, inside a new temporary folder beside it, so paths relative to
+    its parent, like the names in the ZIP, are the same as they will be.
+
+    Returns:
+        pathlib.Path. The new folder.
+    """
+    target = pathlib.Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    path = pathlib.Path(tempfile.mkdtemp(dir=target.parent, prefix=TEMP_PREFIX)) / target.name
+    path.mkdir()
+    return path
+
+
+def move_aside(path):
+    """
+    Move a tree out of the way, to be removed, by renaming it within its
+    folder.
+
+    Returns:
+        pathlib.Path. Where it is now, or None if there was no such tree.
+    """
+    path = pathlib.Path(path)
+    aside = path.with_name(f'{TRASH_PREFIX}{path.name}-{uuid.uuid4().hex[:8]}')
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return None
+    return aside
+
+
+def swap_tree(path, target):
+    """
+    Put a tree made by `temp_tree()` in place of `target`. The old tree is
+    moved aside first, so `target` is only missing between two renames.
+
+    Returns:
+        pathlib.Path. Where the old tree is now, for `remove_trees()`, or
+            None if there wasn't one.
+    """
+    path = pathlib.Path(path)
+    old = move_aside(target)
+    os.rename(path, target)
+    path.parent.rmdir()
+    return old
+
+
+def leftovers(folder, names):
+    """
+    Find the temporary and moved-aside trees of some courses, left behind
+    by builds that were interrupted.
+
+    Args:
+        folder (path): The build folder.
+        names (list): The courses.
+
+    Returns:
+        list. The trees.
+    """
+    found = []
+    for path in pathlib.Path(folder).glob(f'{TEMP_PREFIX}*'):
+        if any((path / name).exists() for name in names) or not any(path.iterdir()):
+            found.append(path)
+    for name in names:
+        found.extend(pathlib.Path(folder).glob(f'{TRASH_PREFIX}{name}-*'))
+    return found
+
+
+def unlink_all(fnames):
+    """
+    Delete some files, ignoring those that have gone already.
+    """
+    for fname in fnames:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(fname)
+    return
+
+
+def remove_trees(paths, jobs=None):
+    """
+    Remove some trees, quickly. Each is moved aside at once, so it seems
+    to be gone straight away, then the files in all of them are deleted by
+    several threads at once, and finally the empty folders.
+
+    Args:
+        paths (list): The trees. They need not exist, and can be None.
+        jobs (int): How many threads to delete with. Default: the number
+            of CPUs plus 4, up to 32.
+    """
+    jobs = jobs or min(32, (os.cpu_count() or 1) + 4)
+    trees = [path for path in map(move_aside, filter(None, paths)) if path is not None]
+    files = []
+    for tree in trees:
+        for root, dirnames, fnames in os.walk(tree):
+            files.extend(os.path.join(root, f) for f in fnames)
+            # Links to folders are listed as folders, but aren't walked into.
+            files.extend(os.path.join(root, d) for d in dirnames if os.path.islink(os.path.join(root, d)))
+    if files:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(unlink_all, [files[i:i + BATCH] for i in range(0, len(files), BATCH)]))
+    for tree in trees:
+        shutil.rmtree(tree, ignore_errors=True)
+    return
@@ -0,0 +1,164 @@
+"""
+Uploading course ZIP files to AWS S3, sharing one client between all the
+uploads, and skipping files that are already there.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import functools
+import hashlib
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+    AWS_AVAILABLE = True
+except:
+    AWS_AVAILABLE = False
+
+
+CHUNK_SIZE = 8 * 1024 * 1024  # The same as boto3's default.
+CONCURRENCY = 10
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(endpoint_url=None, connections=CONCURRENCY):
+    """
+    Make an S3 client, or reuse the one we made before. Clients are safe to
+    share between threads, and sharing one means sharing its connections.
+
+    Args:
+        endpoint_url (str): Where to find S3, if not at AWS.
+        connections (int): The most connections to keep open.
+
+    Returns:
+        botocore.client.S3.
+    """
+    if not AWS_AVAILABLE:
+        m = "AWS upload is not available. You need to install boto3 and botocore, "
+        m += "and set up AWS credentials. See the documentation for more information."
+        raise Exception(m)
+    config = Config(max_pool_connections=connections)
+    return boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+
+def transfer_config(chunk_size=CHUNK_SIZE, concurrency=CONCURRENCY):
+    """
+    Files bigger than `chunk_size` are uploaded in parts of that size,
+    `concurrency` parts at a time.
+
+    Returns:
+        boto3.s3.transfer.TransferConfig.
+    """
+    return TransferConfig(multipart_threshold=chunk_size,
+                          multipart_chunksize=chunk_size,
+                          max_concurrency=concurrency,
+                          )
+
+
+def local_etag(file_name, chunk_size=CHUNK_SIZE):
+    """
+    Work out the ETag that S3 will give a file uploaded in parts of
+    `chunk_size`: its MD5 if it fits in one part, otherwise the MD5 of the
+    parts' MD5s, followed by the number of parts.
+
+    Returns:
+        tuple. The MD5 of the whole file, and the ETag, both as hex.
+    """
+    md5, parts = hashlib.md5(), []
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+            parts.append(hashlib.md5(chunk).digest())
+    if os.path.getsize(file_name) < chunk_size:
+        return md5.hexdigest(), f'"{md5.hexdigest()}"'
+    etag = hashlib.md5(b''.join(parts)).hexdigest()
+    return md5.hexdigest(), f'"{etag}-{len(parts)}"'
+
+
+def is_unchanged(client, bucket, key, md5, etag):
+    """
+    Check whether the object at `key` already has the contents we would
+    upload, from its ETag, or from the MD5 we store with each upload (in
+    case the parts were a different size last time).
+
+    Returns:
+        bool.
+    """
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return (head.get('ETag') == etag) or (head.get('Metadata', {}).get('md5') == md5)
+
+
+def upload_zip(file_name, bucket, object_name=None, client=None, chunk_size=CHUNK_SIZE, concurrency=CONCURRENCY, force=False):
+    """
+    Upload a file to an S3 bucket, unless an identical file is already there.
+
+    Args:
+        file_name (path): File to upload.
+        bucket (str): Bucket to upload to.
+        object_name (str): S3 object name. If not specified then the name
+            of the file is used.
+        client (botocore.client.S3): The client to use. Default: the
+            shared client.
+        chunk_size (int): Files bigger than this go up in parts this size.
+        concurrency (int): How many parts to upload at once.
+        force (bool): Whether to upload even if the file is unchanged.
+
+    Returns:
+        str. 'uploaded' or 'unchanged' if it worked, otherwise None.
+    """
+    # If S3 object_name was not specified, use file_name.
+    if object_name is None:
+        object_name = os.path.basename(file_name)
+    if client is None:
+        client = get_client()
+
+    try:
+        md5, etag = local_etag(file_name, chunk_size)
+        if not force and is_unchanged(client, bucket, object_name, md5, etag):
+            return 'unchanged'
+        args = {'ACL': 'public-read', 'Metadata': {'md5': md5}}
+        config = transfer_config(chunk_size=chunk_size, concurrency=concurrency)
+        client.upload_file(str(file_name), bucket, object_name, ExtraArgs=args, Config=config)
+    except ClientError as e:
+        warnings.warn(f"Upload to S3 failed: {e}")
+        return None
+    return 'uploaded'
+
+
+def upload_zips(file_names, bucket, jobs=4, callback=None, **kwargs):
+    """
+    Upload several files at once, over one shared client.
+
+    Args:
+        file_names (list): The files to upload.
+        bucket (str): Bucket to upload to.
+        jobs (int): How many files to upload at once.
+        callback (callable): Called with each file and its result as it
+            finishes.
+        **kwargs: Passed on to `upload_zip()`.
+
+    Returns:
+        list. The result of `upload_zip()` for each file, in order.
+    """
+    if not file_names:
+        return []
+    concurrency = kwargs.get('concurrency', CONCURRENCY)
+    client = kwargs.pop('client', None) or get_client(connections=jobs * concurrency)
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(jobs, len(file_names))) as executor:
+        futures = {executor.submit(upload_zip, f, bucket, client=client, **kwargs): f for f in file_names}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            if callback is not None:
+                callback(futures[future], results[futures[future]])
+    return [results[f] for f in file_names]
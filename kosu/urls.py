@@ -0,0 +1,120 @@
+"""
+Checking that the data URLs mentioned in notebooks exist.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import json
+import os
+import pathlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def make_session(connections=16, retries=3, backoff=0.5):
+    """
+    Make a session that reuses up to `connections` connections per host, and
+    retries failed connections and server errors with exponential backoff.
+
+    Returns:
+        requests.Session.
+    """
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'],
+                  raise_on_status=False,
+                  )
+    adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def load_checked(cache_file, ttl):
+    """
+    Load the URLs that were found to exist less than `ttl` seconds ago.
+
+    Returns:
+        dict. Maps URL to the time it was checked.
+    """
+    try:
+        with open(cache_file) as f:
+            checked = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    now = time.time()
+    return {url: t for url, t in checked.items() if now - t < ttl}
+
+
+def save_checked(cache_file, checked):
+    """
+    Save the URLs that were found to exist, replacing the file in one go so
+    that other builds never see half of it.
+    """
+    cache_file = pathlib.Path(cache_file)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_file.parent, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(checked, f)
+    os.replace(tmp, cache_file)
+    return
+
+
+def check_urls(urls, jobs=16, timeout=10, retries=3, cache_file=None, ttl=3600, callback=None):
+    """
+    Check that URLs exist with HEAD requests. Each URL is only checked once,
+    several are checked at once over a shared pool of connections, and any
+    URL that was found to exist in the last `ttl` seconds is not checked
+    again.
+
+    Args:
+        urls (list): The URLs to check. They can be repeated.
+        jobs (int): How many requests to make at once.
+        timeout (float): Seconds to wait for each request.
+        retries (int): How many times to retry each request.
+        cache_file (path): Where to remember the URLs that exist, if at all.
+        ttl (float): How many seconds to trust the remembered URLs for.
+        callback (callable): Called with each URL once it has been checked.
+
+    Returns:
+        list. The URLs that do not exist, in the order they were given.
+    """
+    urls = list(dict.fromkeys(urls))
+    checked = load_checked(cache_file, ttl) if cache_file else {}
+    todo = [url for url in urls if url not in checked]
+    for url in urls:
+        if url in checked and callback is not None:
+            callback(url)
+
+    missing = set()
+    if todo:
+        session = make_session(connections=jobs, retries=retries)
+
+        def head(url):
+            try:
+                return session.head(url, timeout=timeout).status_code
+            except requests.RequestException:
+                return None
+
+        with session, ThreadPoolExecutor(max_workers=min(jobs, len(todo))) as executor:
+            futures = {executor.submit(head, url): url for url in todo}
+            for future in as_completed(futures):
+                url = futures[future]
+                if future.result() == 200:
+                    checked[url] = time.time()
+                else:
+                    missing.add(url)
+                if callback is not None:
+                    callback(url)
+
+    if cache_file and todo:
+        save_checked(cache_file, {**load_checked(cache_file, ttl), **checked})
+
+    return [url for url in urls if url in missing]
@@ -0,0 +1,177 @@
+"""
+Watching folders for changes to files, with inotify on Linux, or by
+polling anywhere else.
+
+Author: Agile Scientific
+Licence: Apache 2.0
+"""
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import time
+
+try:
+    LIBC = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    INOTIFY_AVAILABLE = hasattr(LIBC, 'inotify_init1')
+except (OSError, TypeError):
+    INOTIFY_AVAILABLE = False
+
+
+# From linux/inotify.h.
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then the name.
+
+DEBOUNCE = 0.2  # Seconds.
+INTERVAL = 0.5  # Seconds between polls.
+
+
+class Inotify:
+    """
+    Watch some folders (not their subfolders) with inotify.
+
+    Args:
+        folders (list): The folders to watch. Those that don't exist are
+            ignored.
+    """
+    def __init__(self, folders):
+        self.fd = LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not start inotify.")
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MODIFY
+        self.folders = {}
+        for folder in folders:
+            if not os.path.isdir(folder):
+                continue
+            wd = LIBC.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"Could not watch {folder}.")
+            self.folders[wd] = pathlib.Path(folder)
+
+    def wait(self, timeout=None):
+        """
+        Wait for some changes.
+
+        Returns:
+            set. The paths that changed, which might be empty if nothing
+                did before `timeout` seconds.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, pos)
+                name = data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0')
+                pos += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # Too much happened at once; call it all changed.
+                    changed.update(self.folders.values())
+                elif wd in self.folders and name:
+                    changed.add(self.folders[wd] / os.fsdecode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """
+    Watch some folders (not their subfolders) by looking at the size and
+    modification time of their files every `interval` seconds.
+
+    Args:
+        folders (list): The folders to watch.
+        interval (float): Seconds between looks.
+    """
+    def __init__(self, folders, interval=INTERVAL):
+        self.folders = [pathlib.Path(folder) for folder in folders]
+        self.interval = interval
+        self.files = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+        for folder in self.folders:
+            try:
+                entries = list(os.scandir(folder))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files[folder / entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def wait(self, timeout=None):
+        """
+        Wait for some changes.
+
+        Returns:
+            set. The paths that changed, which might be empty if nothing
+                did before `timeout` seconds.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            files = self.snapshot()
+            changed = {f for f in files.keys() | self.files.keys() if files.get(f) != self.files.get(f)}
+            self.files = files
+            if changed:
+                return changed
+            if end is not None and time.monotonic() >= end:
+                return set()
+            time.sleep(self.interval if end is None else max(0, min(self.interval, end - time.monotonic())))
+
+    def close(self):
+        pass
+
+
+def watcher(folders, poll=False, interval=INTERVAL):
+    """
+    Make an inotify watcher if we can, otherwise a poller.
+
+    Returns:
+        Inotify or Poller.
+    """
+    if INOTIFY_AVAILABLE and not poll:
+        try:
+            return Inotify(folders)
+        except OSError:
+            pass  # E.g. too many watches; polling still works.
+    return Poller(folders, interval=interval)
+
+
+def changes(watch, debounce=DEBOUNCE):
+    """
+    Yield the paths that change, in batches. A batch ends when nothing has
+    changed for `debounce` seconds, so a burst of changes, like an editor
+    saving a file, or a `git checkout`, comes as one batch.
+
+    Args:
+        watch (Inotify or Poller): What to watch with.
+        debounce (float): Seconds of quiet that end a batch.
+
+    Yields:
+        set. The paths that changed.
+    """
+    while True:
+        changed = watch.wait()
+        while more := watch.wait(timeout=debounce):
+            changed |= more
+        yield changed
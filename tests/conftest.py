@@ -0,0 +1,109 @@
+import hashlib
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+from click.testing import CliRunner
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves the server's `files`, with ETags, failing with a 503 while `fail`
+    says so, and sending only half of the paths in `truncate`. Byte ranges
+    are served if `ranges` is set, and the Range headers are kept.
+    """
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        server = self.server
+        server.requests.append((self.command, self.path))
+        if server.fail.get(self.path):
+            server.fail[self.path] -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if server.ranges is not None and match and self.headers.get('If-Range') in (None, etag):
+            server.ranges.append(self.headers['Range'])
+            start, stop = int(match[1]), int(match[2] or len(data) - 1)
+            data = data[start:stop + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{stop}/{len(server.files[self.path])}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        if server.ranges is not None:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if body:
+            if self.path in server.truncate:
+                data = data[:len(data) // 2]
+            self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    """
+    A local HTTP server. Put bytes in `server.files` by path, see what was
+    asked for in `server.requests`, make paths fail with `server.fail`, and
+    cut downloads short with `server.truncate`. Set `server.ranges` to a
+    list to serve byte ranges, and see the ranges that were asked for.
+    """
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.files, httpd.requests, httpd.fail, httpd.truncate = {}, [], {}, set()
+    httpd.ranges = None
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch, server):
+    """
+    Work in the example project that `kosu init` makes, with its dataset
+    served by `server`, and with its settings loaded. The settings kosu
+    had before are put back afterwards.
+    """
+    from kosu.kosu import KOSU, cli, load_settings
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    saved = dict(KOSU)
+    CliRunner().invoke(cli, ['init', '--yes'])
+    server.files['/data/tops.txt'] = (KOSU['path'] / 'include' / 'tops.txt').read_bytes()
+    notebook = tmp_path / 'notebooks' / 'Intro_to_Python.ipynb'
+    notebook.write_text(notebook.read_text().replace('https://kosu-demo.s3.amazonaws.com/data/', '../data/'))
+    with open('example_course.yaml') as f:
+        config = yaml.safe_load(f)
+    config['data_url'] = f'{server.url}/data/'
+    with open('example_course.yaml', 'w') as f:
+        yaml.safe_dump(config, f)
+    load_settings()
+    yield tmp_path
+    KOSU.clear()
+    KOSU.update(saved)
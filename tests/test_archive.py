@@ -0,0 +1,104 @@
+import os
+import zipfile
+
+import pytest
+
+from kosu import archive
+from kosu.archive import append_raw, write_zip
+
+
+def test_write_zip(tmp_path, monkeypatch):
+    """
+    Test that updating a ZIP keeps unchanged members and replaces the rest.
+    """
+    monkeypatch.chdir(tmp_path)
+    course = tmp_path / 'build' / 'course'
+    (course / 'sub').mkdir(parents=True)
+    (course / 'same.txt').write_text('same ' * 1000)
+    (course / 'sub' / 'changes.txt').write_text('before')
+    (course / 'gone.txt').write_text('gone')
+
+    zipped, record = write_zip('course', 'build', 'course')
+    with zipfile.ZipFile(zipped) as z:
+        assert sorted(z.namelist()) == ['course/', 'course/gone.txt', 'course/same.txt',
+                                        'course/sub/', 'course/sub/changes.txt']
+
+    (course / 'sub' / 'changes.txt').write_text('after!')
+    mtime = record['course/sub/changes.txt'][1] + 2_000_000_000
+    os.utime(course / 'sub' / 'changes.txt', ns=(mtime, mtime))
+    (course / 'gone.txt').unlink()
+    copied = []
+    copy_raw = archive.copy_raw
+    monkeypatch.setattr(archive, 'copy_raw', lambda zin, zout, info: copied.append(info.filename) or copy_raw(zin, zout, info))
+    zipped, _ = write_zip('course', 'build', 'course', previous=record)
+    assert 'course/sub/changes.txt' not in copied
+    assert 'course/same.txt' in copied  # Copied without recompressing.
+    with zipfile.ZipFile(zipped) as z:
+        assert z.testzip() is None
+        assert 'course/gone.txt' not in z.namelist()
+        assert z.read('course/sub/changes.txt') == b'after!'
+        assert z.read('course/same.txt') == b'same ' * 1000
+
+
+def test_write_zip_compression(tmp_path, monkeypatch):
+    """
+    Test that compressed types are stored, big files are streamed, and files
+    can come straight from their sources.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(archive, 'STREAM_SIZE', 50_000)
+    course = tmp_path / 'build' / 'course'
+    (course / 'images').mkdir(parents=True)
+    (course / 'notes.txt').write_text('notes ' * 1000)
+    (course / 'big.txt').write_text('big ' * 100_000)
+    (tmp_path / 'image.png').write_bytes(b'png ' * 1000)
+    files = [f'f{i}.txt' for i in range(20)]
+    for fname in files:
+        (course / fname).write_text(fname * 100)
+
+    sources = {'course/images/image.png': tmp_path / 'image.png'}
+    zipped, _ = write_zip('course', 'build', 'course', level=9, jobs=3, sources=sources)
+    with zipfile.ZipFile(zipped) as z:
+        assert z.testzip() is None
+        assert z.getinfo('course/images/image.png').compress_type == zipfile.ZIP_STORED
+        assert z.getinfo('course/notes.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert z.read('course/big.txt') == b'big ' * 100_000
+        assert z.namelist() == ['course/', 'course/big.txt'] + [f'course/{f}' for f in sorted(files)] + \
+                               ['course/notes.txt', 'course/images/', 'course/images/image.png']
+
+    zipped, _ = write_zip('course', 'build', 'course', level=0)
+    with zipfile.ZipFile(zipped) as z:
+        assert {i.compress_type for i in z.infolist()} == {zipfile.ZIP_STORED}
+
+
+def test_write_zip_limits(tmp_path, monkeypatch):
+    """
+    Test that members on either side of the limits on streaming and reading
+    ahead are written, and copied, into ZIPs that read back correctly, and
+    that members too big to write without ZIP64 are refused.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(archive, 'STREAM_SIZE', 10_000)
+    monkeypatch.setattr(archive, 'WINDOW', 20_000)
+    course = tmp_path / 'build' / 'course'
+    course.mkdir(parents=True)
+    sizes = {'empty.txt': 0, 'under.txt': 9_999, 'at.txt': 10_000, 'over.txt': 10_001,
+             'stored.png': 20_000, 'window.bin': 20_001, 'naïve.txt': 100}
+    for fname, size in sizes.items():
+        (course / fname).write_bytes(os.urandom(size // 2) * 2 + os.urandom(size % 2))
+
+    zipped, record = write_zip('course', 'build', 'course', jobs=2)
+    copied = []
+    copy_raw = archive.copy_raw
+    monkeypatch.setattr(archive, 'copy_raw', lambda zin, zout, info: copied.append(info.filename) or copy_raw(zin, zout, info))
+    zipped, _ = write_zip('course', 'build', 'course', previous=dict(record, **{'course/': None}), jobs=2)
+    assert len(copied) == len(sizes)
+    with zipfile.ZipFile(zipped) as z:
+        assert z.testzip() is None
+        for fname in sizes:
+            assert z.read(f'course/{fname}') == (course / fname).read_bytes()
+
+    info = zipfile.ZipInfo('huge.bin')
+    info.file_size = zipfile.ZIP64_LIMIT
+    with zipfile.ZipFile(tmp_path / 'huge.zip', 'w') as z, pytest.raises(ValueError, match='ZIP64'):
+        append_raw(z, info, data=b'')
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from kosu import assets
+from kosu.assets import place, place_once
+
+
+@pytest.mark.parametrize('method', ['auto', 'hardlink', 'symlink', 'copy'])
+def test_place(tmp_path, method):
+    """
+    Test that files are placed the way we asked, over anything already there.
+    """
+    src, dst = tmp_path / 'src.png', tmp_path / 'dst.png'
+    src.write_bytes(b'png')
+    dst.write_bytes(b'old')
+    how = place(src, dst, method)
+    assert how in (['reflink', 'copy'] if method == 'auto' else [method])
+    assert dst.read_bytes() == b'png'
+    assert os.path.samefile(src, dst) == (method in ['hardlink', 'symlink'])
+    assert dst.is_symlink() == (method == 'symlink')
+
+    with pytest.raises(Exception, match="Cannot place files by 'teleport'"):
+        place(src, dst, 'teleport')
+
+
+def test_place_once(tmp_path, monkeypatch):
+    """
+    Test that a source that can't be linked to is only copied once, and
+    then linked to from inside the build.
+    """
+    src = tmp_path / 'elsewhere' / 'script.py'
+    src.parent.mkdir()
+    src.write_text('print("hi")')
+    build = tmp_path / 'build'
+    build.mkdir()
+
+    link = os.link
+    def no_links_out(a, b):
+        if 'elsewhere' in str(a):
+            raise OSError("Invalid cross-device link")
+        return link(a, b)
+    monkeypatch.setattr(assets.os, 'link', no_links_out)
+    monkeypatch.setattr(assets, 'reflink', lambda a, b: no_links_out(a, b))
+
+    placed = {}
+    hows = [place_once(src, build / name, placed, 'abc', method='hardlink') for name in ['a.py', 'b.py', 'c.py']]
+    assert hows == ['copy', 'hardlink', 'hardlink']
+    assert os.path.samefile(build / 'a.py', build / 'c.py')
+    assert place_once(src, build / 'd.py', placed, 'abc', method='copy') == 'copy'
+    assert not os.path.samefile(build / 'a.py', build / 'd.py')
+
+    # By default, nothing in the build is linked to anything else.
+    assert place_once(src, build / 'e.py', placed, 'abc') in ['reflink', 'copy']
+    (build / 'e.py').write_text('edited')
+    assert (build / 'a.py').read_text() == src.read_text() == 'print("hi")'
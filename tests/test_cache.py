@@ -0,0 +1,62 @@
+import os
+import shutil
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from kosu import cli
+from kosu.cache import cached_process_notebook, cache_entries, cache_stats, evict
+
+
+INCLUDE = Path(__file__).parent.parent / 'kosu' / 'include'
+
+
+def test_cache_hit(tmp_path):
+    """
+    Test that a cache hit writes the same files and finds the same references.
+    """
+    infile = tmp_path / 'Intro_to_Python.ipynb'
+    shutil.copyfile(INCLUDE / 'Intro_to_Python.ipynb', infile)
+    cache_dir = tmp_path / 'cache'
+
+    first = cached_process_notebook(infile, tmp_path / 'a.ipynb', cache_dir, master=tmp_path / 'ma.ipynb', kernel='k')
+    second = cached_process_notebook(infile, tmp_path / 'b.ipynb', cache_dir, master=tmp_path / 'mb.ipynb', kernel='k')
+    assert first == second
+    assert first[0] == ['example.png']
+    assert (tmp_path / 'a.ipynb').read_text() == (tmp_path / 'b.ipynb').read_text()
+    assert (tmp_path / 'ma.ipynb').read_text() == (tmp_path / 'mb.ipynb').read_text()
+    assert cache_stats(cache_dir)['entries'] == 1
+
+    # Different options are a different entry.
+    _ = cached_process_notebook(infile, tmp_path / 'c.ipynb', cache_dir, kernel='k', demo=True)
+    assert cache_stats(cache_dir)['entries'] == 2
+
+
+def test_evict(tmp_path):
+    """
+    Test that the least recently used entries are evicted first.
+    """
+    cache_dir = tmp_path / 'cache'
+    for i, name in enumerate(['old', 'mid', 'new']):
+        entry = cache_dir / name
+        entry.mkdir(parents=True)
+        (entry / 'notebook.ipynb').write_bytes(b'x' * 400_000)
+        os.utime(entry, (1000 + i, 1000 + i))
+
+    assert evict(cache_dir, max_size=1) == 1
+    assert [e.name for e, *_ in cache_entries(cache_dir)] == ['mid', 'new']
+
+
+def test_cache_cli():
+    """
+    Test the cache stats and clear commands.
+    """
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        _ = Path('build/.kosu-cache/abc').mkdir(parents=True)
+        result = runner.invoke(cli, ['cache', 'stats'])
+        assert result.exit_code == 0
+        assert '1 notebooks' in result.output
+        result = runner.invoke(cli, ['cache', 'clear'])
+        assert result.exit_code == 0
+        assert not Path('build/.kosu-cache').exists()
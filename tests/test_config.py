@@ -0,0 +1,80 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from kosu.config import ConfigError, read_course, read_settings, read_yaml
+from kosu.kosu import cli
+
+
+def test_read_yaml(tmp_path):
+    """
+    Test that a file is parsed once, until it changes, and that changing
+    what it gives doesn't change what it gives next time.
+    """
+    fname = tmp_path / 'environment.yaml'
+    fname.write_text('dependencies:\n- python\n')
+    deps = read_yaml(fname)
+    deps['dependencies'].append('numpy')
+    assert read_yaml(fname) == {'dependencies': ['python']}
+
+    fname.write_text('dependencies:\n- python=3.10\n')
+    os.utime(fname, ns=(0, 1))
+    assert read_yaml(fname) == {'dependencies': ['python=3.10']}
+
+    fname.write_text('dependencies: [python\n')
+    with pytest.raises(Exception, match="Could not read environment.yaml"):
+        read_yaml(fname)
+
+
+def test_read_course(tmp_path):
+    """
+    Test that courses and settings are checked, and empty lists allowed.
+    """
+    fname = tmp_path / 'course.yaml'
+    fname.write_text('title: Python\ncurriculum:\n  1:\n  - Intro.ipynb\n  2:\nextras:\n')
+    assert read_course(fname) == {'title': 'Python', 'curriculum': {1: ['Intro.ipynb'], 2: []}}
+
+    fname.write_text('title: 3\ndata: tops.txt\nscripts: [a.py, 1]\nnotes: []\n')
+    with pytest.raises(ConfigError) as e:
+        read_course(fname)
+    assert e.value.message.splitlines() == [
+        "Problem(s) in course.yaml:",
+        "  Missing key 'curriculum'.",
+        "  title should be str, not 3.",
+        "  data should be a list of str, not 'tops.txt'.",
+        "  scripts[1] should be str, not 1.",
+    ]
+
+    fname = tmp_path / '.kosu.yaml'
+    fname.write_text('cache-size: true\ndata-cache: false\ndata-url-stems: https://example.com/\n')
+    with pytest.raises(Exception, match="cache-size should be int or float, not True"):
+        read_settings(fname)
+
+
+def test_unknown_keys(tmp_path, monkeypatch, capsys):
+    """
+    Test that unknown keys are warned about, once, and ignored.
+    """
+    monkeypatch.setattr('kosu.config.WARNED', set())
+    fname = tmp_path / 'course.yaml'
+    fname.write_text('title: Python\ncurriculum:\n  1: [Intro.ipynb]\nnotes: []\n')
+    assert read_course(fname) == {'title': 'Python', 'curriculum': {1: ['Intro.ipynb']}}
+    assert read_course(fname) == {'title': 'Python', 'curriculum': {1: ['Intro.ipynb']}}
+    assert capsys.readouterr().out == "⚠️  Ignoring unknown key 'notes' in course.yaml.\n"
+
+
+def test_config_error(tmp_path, monkeypatch):
+    """
+    Test that a mistake in .kosu.yaml is shown as a message, not a
+    traceback, and doesn't stop `init` from saying what is wrong.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / '.kosu.yaml').write_text('cache-size: lots\n')
+    result = CliRunner().invoke(cli, ['clean', '--all'])
+    assert result.exit_code == 1
+    assert result.output == "Error: Problem(s) in .kosu.yaml:\n  cache-size should be int or float, not 'lots'.\n"
+
+    result = CliRunner().invoke(cli, ['init', '--yes'])
+    assert result.exit_code == 1
+    assert "There's already a .kosu.yml file" in result.output
@@ -0,0 +1,191 @@
+import json
+import shutil
+import tracemalloc
+import subprocess
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from kosu.kosu import cli
+from kosu.customize import CELL_TRANSFORMS, copy_for_stripping, process_notebook, register_transform, strip_output, style_cells
+
+
+INCLUDE = Path(__file__).parent.parent / 'kosu' / 'include'
+
+
+def messy_notebook():
+    """
+    A notebook with the kinds of things nbstripout cares about.
+    """
+    return {
+        'cells': [
+            {'cell_type': 'markdown', 'id': 'abc123', 'metadata': {'collapsed': True},
+             'source': ['# Title\n', 'See ../images/example.png'],
+             'attachments': {'a.png': {'image/png': ['iVBORw0', 'KGgo']}}},
+            {'cell_type': 'code', 'execution_count': 4, 'id': 'def456', 'metadata': {'scrolled': True, 'trusted': True},
+             'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': ['hi\n', 'there\n']}],
+             'source': 'print("hi")\nprint("there")'},
+            {'cell_type': 'code', 'execution_count': 5, 'id': 'ghi789', 'metadata': {'tags': ['keep_output']},
+             'outputs': [{'output_type': 'execute_result', 'execution_count': 5, 'metadata': {},
+                          'data': {'text/plain': ['1\n', '2'], 'image/png': ['iVBORw0', 'KGgo']}}],
+             'source': ['x']},
+        ],
+        'metadata': {'kernelspec': {'display_name': 'py', 'language': 'python', 'name': 'py'},
+                     'widgets': {'state': {}}, 'celltoolbar': 'Tags'},
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+
+
+@pytest.mark.skipif(shutil.which('nbstripout') is None, reason="nbstripout is not installed")
+@pytest.mark.parametrize('name', ['messy', 'Intro_to_Python.ipynb', 'Interesting_notebook.ipynb'])
+def test_strip_matches_nbstripout(tmp_path, name):
+    """
+    Test that in-process stripping writes the same files as nbstripout.
+    """
+    infile = tmp_path / 'in.ipynb'
+    if name == 'messy':
+        infile.write_text(json.dumps(messy_notebook()))
+    else:
+        shutil.copyfile(INCLUDE / name, infile)
+    outfile, master = tmp_path / 'out.ipynb', tmp_path / 'master.ipynb'
+    expected_out, expected_master = tmp_path / 'expected_out.ipynb', tmp_path / 'expected_master.ipynb'
+
+    _ = process_notebook(infile, outfile, clear_output=True, kernel='kosu', master=master)
+    _ = process_notebook(infile, expected_out, clear_output=False, kernel='kosu')
+    shutil.copyfile(infile, expected_master)
+    _ = subprocess.run(['nbstripout', str(expected_out), str(expected_master)], check=True)
+
+    assert outfile.read_text(encoding='utf-8') == expected_out.read_text(encoding='utf-8')
+    assert master.read_text(encoding='utf-8') == expected_master.read_text(encoding='utf-8')
+
+
+def test_strip_output():
+    """
+    Test that outputs are only kept when a cell asks for it.
+    """
+    notebook, changed = strip_output(messy_notebook())
+    assert changed
+    code, kept = notebook['cells'][1], notebook['cells'][2]
+    assert code['outputs'] == [] and code['execution_count'] is None
+    assert kept['outputs'][0]['execution_count'] is None
+    assert 'data' in kept['outputs'][0]
+    assert [c['id'] for c in notebook['cells']] == ['0', '1', '2']
+    assert 'widgets' not in notebook['metadata']
+
+    _, changed = strip_output(notebook)
+    assert not changed
+
+    # Stripping a copy leaves the original as it was.
+    original = messy_notebook()
+    stripped, _ = strip_output(copy_for_stripping(original))
+    assert original == messy_notebook()
+    assert stripped == notebook
+
+
+def test_register_transform(tmp_path, monkeypatch):
+    """
+    Test that a registered transform sees each cell once, in the same pass
+    as the built-in ones, and can remove cells.
+    """
+    monkeypatch.setattr('kosu.customize.CELL_TRANSFORMS', list(CELL_TRANSFORMS))
+    seen = []
+
+    @register_transform
+    def drop_drafts(cell, context):
+        seen.append(context['index'])
+        return None if 'draft' in cell['metadata'].get('tags', []) else cell
+
+    notebook = messy_notebook()
+    notebook['cells'][1]['metadata']['tags'] = ['draft']
+    infile, outfile = tmp_path / 'in.ipynb', tmp_path / 'out.ipynb'
+    infile.write_text(json.dumps(notebook))
+    images, _, _ = process_notebook(infile, outfile)
+    assert seen == [0, 1, 1]
+    assert [c['id'] for c in json.loads(outfile.read_text())['cells']] == ['0', '1']
+    assert images == ['example.png']
+
+
+def shout(cell, context):
+    """
+    A transform for the tests, at the top level so other processes can use it.
+    """
+    if cell['cell_type'] == 'markdown':
+        cell['source'] = [line.upper() for line in cell['source']]
+    return cell
+
+
+def test_register_transform_jobs(project):
+    """
+    Test that notebooks processed in other processes go through the
+    transforms registered in this one.
+    """
+    saved = list(CELL_TRANSFORMS)
+    register_transform(shout)
+    try:
+        result = CliRunner().invoke(cli, ['build', 'example_course', '--jobs', '2', '--no-clean', '--no-zip', '--clobber'])
+    finally:
+        CELL_TRANSFORMS[:] = saved
+    assert result.exit_code == 0, result.output
+    cells = json.loads((project / 'build' / 'example_course' / 'notebooks' / 'Intro_to_Python.ipynb').read_text())['cells']
+    markdown = ''.join(line for cell in cells if cell['cell_type'] == 'markdown' for line in cell['source'])
+    assert markdown and markdown == markdown.upper()
+
+    register_transform(lambda cell, context: cell)
+    try:
+        result = CliRunner().invoke(cli, ['build', 'example_course', '--jobs', '2', '--no-clean', '--no-zip', '--clobber'])
+    finally:
+        CELL_TRANSFORMS[:] = saved
+    assert "can't be sent to other processes" in str(result.exception)
+
+
+def test_style_cells():
+    """
+    Test that a cell with two style tags is wrapped in both, with headings
+    converted once.
+    """
+    notebook = {'cells': [{'cell_type': 'markdown', 'metadata': {'tags': ['exercise', 'info']},
+                           'source': ['## Try it\n', 'Now.']}]}
+    cell = style_cells(style_cells(notebook, 'exercise'), 'info')['cells'][0]
+    assert cell['source'][0].startswith('<div style="background: #e0f0ff')
+    assert cell['source'][1].startswith('<div style="background: #e0ffe0')
+    assert cell['source'][2:4] == ['<h3>Try it</h3>\n', 'Now.']
+
+
+@pytest.mark.parametrize('name', ['messy', 'Intro_to_Python.ipynb', 'Interesting_notebook.ipynb'])
+@pytest.mark.parametrize('clear_output', [True, False])
+def test_stream_notebook(tmp_path, name, clear_output):
+    """
+    Test that processing a notebook a cell at a time writes the same files,
+    and finds the same references, as processing it all at once.
+    """
+    infile = tmp_path / 'in.ipynb'
+    if name == 'messy':
+        infile.write_text(json.dumps(messy_notebook()))
+    else:
+        shutil.copyfile(INCLUDE / name, infile)
+    results = []
+    for stream in [False, True]:
+        outfile, master = tmp_path / f'out{stream}.ipynb', tmp_path / f'master{stream}.ipynb'
+        refs = process_notebook(infile, outfile, clear_output=clear_output, kernel='kosu', master=master, stream=stream)
+        results.append((refs, outfile.read_bytes(), master.read_bytes()))
+    assert results[0] == results[1]
+
+
+def test_stream_notebook_memory(tmp_path):
+    """
+    Test that the outputs of a big notebook are never loaded into memory.
+    """
+    notebook = messy_notebook()
+    output = {'output_type': 'stream', 'name': 'stdout', 'text': ['x' * 1000 + '\n'] * 1000}
+    notebook['cells'][1]['outputs'] = [output] * 10
+    infile, outfile = tmp_path / 'in.ipynb', tmp_path / 'out.ipynb'
+    infile.write_text(json.dumps(notebook))
+
+    tracemalloc.start()
+    _ = process_notebook(infile, outfile, master=tmp_path / 'master.ipynb', stream=True)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert peak < infile.stat().st_size / 10
+    assert json.loads(outfile.read_text())['cells'][1]['outputs'] == []
@@ -0,0 +1,166 @@
+import errno
+import os
+import threading
+import zipfile
+
+import pytest
+import requests
+
+from kosu.data import Limiter, Progress, download, extract_zip, fetch, get_data, parse_size, unzip
+from kosu.urls import make_session
+
+
+def test_data_cache(server, tmp_path):
+    """
+    Test that cached data is revalidated, not downloaded again, and that
+    the copies in builds are not linked to the cache.
+    """
+    server.files['/data/big.bin'] = b'x' * 100_000
+    url = f'{server.url}/data/big.bin'
+    cache_dir, session = tmp_path / 'cache', make_session()
+
+    get_data(url, tmp_path / 'one.bin', session, cache_dir=cache_dir)
+    get_data(url, tmp_path / 'two.bin', session, cache_dir=cache_dir)
+    assert (tmp_path / 'two.bin').read_bytes() == b'x' * 100_000
+    assert (tmp_path / 'two.bin').stat().st_nlink == 1
+    assert [m for m, _ in server.requests] == ['GET', 'GET']
+
+    # The second request was conditional, and got a 304.
+    server.files['/data/big.bin'] = b'y'
+    assert fetch(url, cache_dir, session).read_bytes() == b'y'
+
+
+def test_concurrent_fetch(server, tmp_path):
+    """
+    Test that two builds fetching the same URL at once don't share a part
+    file: one downloads it, and the other waits, then revalidates it.
+    """
+    server.files['/data/big.bin'] = bytes(range(256)) * 4000
+    server.ranges = []
+    url, cache_dir = f'{server.url}/data/big.bin', tmp_path / 'cache'
+    barrier, progresses, fnames = threading.Barrier(2, timeout=5), [Progress(), Progress()], []
+
+    def get(progress):
+        barrier.wait()
+        fnames.append(fetch(url, cache_dir, make_session(), progress=progress))
+
+    threads = [threading.Thread(target=get, args=(progress,)) for progress in progresses]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fnames[0] == fnames[1]
+    assert fnames[0].read_bytes() == server.files['/data/big.bin']
+    assert sorted(p.bytes for p in progresses) == [0, 1_024_000]
+    assert not list(fnames[0].parent.glob('.data.part*'))
+
+
+def test_interrupted_download(server, tmp_path):
+    """
+    Test that a download cut short leaves no file behind.
+    """
+    server.files['/data/big.bin'] = b'x' * 100_000
+    server.truncate.add('/data/big.bin')
+    with pytest.raises(requests.RequestException):
+        get_data(f'{server.url}/data/big.bin', tmp_path / 'big.bin', make_session(retries=0))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_resumed_download(server, tmp_path):
+    """
+    Test that a download cut short is resumed with a Range request.
+    """
+    server.files['/data/big.bin'] = bytes(range(256)) * 4000
+    server.truncate.add('/data/big.bin')
+    server.ranges = []
+    url, fname = f'{server.url}/data/big.bin', tmp_path / 'big.bin'
+    with pytest.raises(requests.RequestException):
+        download(url, fname, make_session(retries=0))
+    assert not fname.exists()
+    assert server.ranges[0].endswith('-1023999')
+    assert not server.ranges[0].startswith('bytes=0-')
+
+    server.truncate.clear()
+    download(url, fname, make_session(retries=0))
+    assert fname.read_bytes() == server.files['/data/big.bin']
+    assert server.ranges[-1] != server.ranges[0]
+    assert list(tmp_path.iterdir()) == [fname]
+
+
+def test_split_download(server, tmp_path, monkeypatch):
+    """
+    Test that a large file is fetched in parallel ranges, within the limits.
+    """
+    monkeypatch.setattr('kosu.data.SPLIT_SIZE', 10_000)
+    server.files['/data/big.bin'] = bytes(range(256)) * 400
+    server.ranges = []
+    limiter, progress = Limiter(connections=4, rate=500_000), Progress()
+    download(f'{server.url}/data/big.bin', tmp_path / 'big.bin', make_session(), limiter=limiter, progress=progress)
+    assert (tmp_path / 'big.bin').read_bytes() == server.files['/data/big.bin']
+    assert len(server.ranges) == 4
+    assert progress.bytes == 102_400
+
+
+def test_parse_size():
+    assert parse_size('10M') == 10 * 1024 ** 2
+    assert parse_size('1.5k') == 1536
+    assert parse_size(None) is None
+    with pytest.raises(ValueError):
+        parse_size('fast')
+
+
+def make_zip(fname, members, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(fname, 'w', compression=compression) as z:
+        for name, data in members.items():
+            z.writestr(name, data)
+    return fname
+
+
+def test_extract_zip(tmp_path):
+    """
+    Test that an archive is extracted once into the cache, then placed
+    from there.
+    """
+    members = {'a.txt': b'a' * 1000, 'sub/': b'', 'sub/b.txt': b'b' * 1000}
+    fname, cache_dir = make_zip(tmp_path / 'data.zip', members), tmp_path / 'cache'
+    assert extract_zip(fname, tmp_path / 'one', cache_dir=cache_dir, jobs=2) == list(members)
+    assert extract_zip(fname, tmp_path / 'two', cache_dir=cache_dir, jobs=2) == list(members)
+    assert (tmp_path / 'two' / 'sub' / 'b.txt').read_bytes() == b'b' * 1000
+    assert (tmp_path / 'two' / 'a.txt').stat().st_nlink == 1
+    assert len(list((cache_dir / 'extracted').iterdir())) == 1
+
+    assert unzip(fname, tmp_path / 'three') == list(members)
+    assert (tmp_path / 'three' / 'a.txt').read_bytes() == b'a' * 1000
+
+
+def test_extract_zip_error(tmp_path, monkeypatch):
+    """
+    Test that an error while extracting into the cache is raised as it is,
+    not mistaken for another build having got there first.
+    """
+    def full(fname, dest, **kwargs):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr('kosu.data.unzip', full)
+    fname = make_zip(tmp_path / 'data.zip', {'a.txt': b'a'})
+    with pytest.raises(OSError, match='No space'):
+        extract_zip(fname, tmp_path / 'out', cache_dir=tmp_path / 'cache')
+    assert list((tmp_path / 'cache' / 'extracted').iterdir()) == []
+
+
+@pytest.mark.parametrize('name', ['../evil.txt', '/etc/evil.txt', 'sub/../../evil.txt', 'C:/evil.txt'])
+def test_extract_zip_traversal(tmp_path, name):
+    fname = make_zip(tmp_path / 'evil.zip', {name: b'evil'})
+    with pytest.raises(Exception, match='outside the data folder'):
+        extract_zip(fname, tmp_path / 'out', cache_dir=tmp_path / 'cache')
+    assert not (tmp_path / 'evil.txt').exists()
+    assert list((tmp_path / 'cache' / 'extracted').iterdir()) == []
+
+
+def test_extract_zip_bomb(tmp_path):
+    fname = make_zip(tmp_path / 'bomb.zip', {'zeros': bytes(10 << 20)})
+    with pytest.raises(Exception, match='compressed'):
+        unzip(fname, tmp_path / 'out')
+    with pytest.raises(Exception, match='more than'):
+        unzip(fname, tmp_path / 'out', max_size=1 << 20, max_ratio=None)
+    assert unzip(fname, tmp_path / 'out', max_ratio=None) == ['zeros']
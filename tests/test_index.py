@@ -0,0 +1,67 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from kosu.index import affected, build_index, changed_files
+
+
+FOLDERS = {'notebooks': 'notebooks', 'images': 'images', 'scripts': 'scripts', 'references': 'references'}
+
+
+def make_notebook(path, *sources):
+    cells = [{'cell_type': 'markdown', 'metadata': {}, 'source': [source]} for source in sources]
+    path.write_text(json.dumps({'cells': cells, 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 5}))
+
+
+def test_affected(tmp_path, monkeypatch):
+    """
+    Test that the index finds the courses using each kind of file, and only
+    scans notebooks again when they change.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'notebooks').mkdir()
+    make_notebook(tmp_path / 'notebooks' / 'a.ipynb', '![](../images/a.png)', "load('../data/a.csv')")
+    make_notebook(tmp_path / 'notebooks' / 'b.ipynb', '![](../images/b.png)')
+    configs = {
+        'one': {'curriculum': {1: ['Intro', 'a.ipynb']}, 'scripts': ['utils.py']},
+        'two': {'curriculum': {1: ['b.ipynb']}, 'demos': ['a.ipynb'], 'data': ['b.csv']},
+        'three': {'curriculum': {1: ['b.ipynb']}, 'references': ['paper.pdf']},
+    }
+    index = build_index(configs, FOLDERS)
+    assert index['courses']['one']['images'] == ['a.png']
+    assert index['files']['notebooks']['a.ipynb'] == ['one', 'two']
+
+    folders = dict(FOLDERS, templates='templates')
+    assert affected(['notebooks/a.ipynb'], index, folders) == ['one', 'two']
+    assert affected(['images/b.png', 'scripts/utils.py'], index, folders) == ['one', 'two', 'three']
+    assert affected(['a.csv'], index, folders) == ['one', 'two']
+    assert affected(['references/paper.pdf', 'three.yaml'], index, folders) == ['three']
+    assert affected(['environment.yaml'], index, folders) == ['one', 'two', 'three']
+    assert affected(['templates/README.md'], index, folders) == ['one', 'two', 'three']
+    assert affected(['images/unused.png'], index, folders) == []
+    assert affected([], build_index(dict(configs, four=None), FOLDERS), folders) == ['four']
+
+    # The references are kept; a changed notebook is scanned again.
+    make_notebook(tmp_path / 'notebooks' / 'b.ipynb', '![](../images/b.png)', '![](../images/c.png)')
+    assert affected(['images/c.png'], build_index(configs, FOLDERS), folders) == ['two', 'three']
+
+
+@pytest.mark.skipif(shutil.which('git') is None, reason="Needs git.")
+def test_changed_files(tmp_path, monkeypatch):
+    """
+    Test that changed and new files since a commit are found.
+    """
+    monkeypatch.chdir(tmp_path)
+    git = ['git', '-c', 'user.name=kosu', '-c', 'user.email=kosu@example.com']
+    subprocess.run(['git', 'init', '-q'], check=True)
+    (tmp_path / 'one.yaml').write_text('title: One')
+    (tmp_path / 'two.yaml').write_text('title: Two')
+    subprocess.run(['git', 'add', '.'], check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'Start.'], check=True)
+    (tmp_path / 'two.yaml').write_text('title: Second')
+    (tmp_path / 'three.yaml').write_text('title: Three')
+    assert sorted(changed_files('HEAD')) == ['three.yaml', 'two.yaml']
+    with pytest.raises(Exception, match="Could not find the files changed since nope"):
+        changed_files('nope')
@@ -1,8 +1,16 @@
+import json
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import pytest
 from click.testing import CliRunner
 
-from kosu import cli
+from kosu import cli, map_jobs, build_courses
+from kosu.kosu import KOSU, build_course, cancelling, data_cache_dir
+from kosu.manifest import MANIFEST_DIR
 
 
 def test_help():
@@ -35,7 +43,29 @@ def test_clean():
         result = runner.invoke(cli, ['clean', '--all'])
         assert result.exit_code == 0
         assert "Finished." in result.output
-        assert not Path('build').is_file()
+        assert not Path('build').exists()
+
+
+def test_clean_built(project):
+    """
+    Test that cleaning a course leaves kosu's own files, and that cleaning
+    them all removes the build folder, with the cache, manifests and index.
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, ['build', 'example_course', '--clobber', '--no-clean', '--no-zip'])
+    assert result.exit_code == 0, result.output
+    Path('build/.kosu-trash-example_course-1').mkdir()
+    Path('build/.kosu-index.json').write_text('{}')
+    assert Path('build/.kosu-cache').is_dir()
+
+    result = runner.invoke(cli, ['clean', 'example_course'])
+    assert result.exit_code == 0, result.output
+    assert sorted(p.name for p in Path('build').iterdir()) == ['.kosu-cache', '.kosu-index.json', '.kosu-manifests']
+
+    result = runner.invoke(cli, ['clean', '--all'])
+    assert result.exit_code == 0, result.output
+    assert "Removing build directory." in result.output
+    assert not Path('build').exists()
 
 
 def test_init():
@@ -49,3 +79,153 @@ def test_init():
         # assert result.exit_code == 0
         # assert 'Created example course' in result.output
         assert Path('example_course.yaml').is_file()
+
+
+def test_map_jobs():
+    """
+    Test that parallel jobs give the same results, in the same order.
+    """
+    tasks = [dict(n=i) for i in range(8)]
+    assert map_jobs(dict, tasks, jobs=3) == tasks
+    assert map_jobs(dict, tasks, jobs=1) == tasks
+
+
+def test_cancelling():
+    """
+    Test that work that hasn't started is cancelled when something fails,
+    and work that has is left to finish.
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        futures = [executor.submit(work) for _ in range(4)]
+        started.wait(5)
+        with pytest.raises(ValueError), cancelling(futures):
+            raise ValueError('failed')
+        release.set()
+    assert [f.cancelled() for f in futures] == [False, True, True, True]
+
+
+def test_build_courses_parallel(tmp_path, monkeypatch, capsys):
+    """
+    Test that parallel course builds report failures instead of stopping.
+    """
+    monkeypatch.chdir(tmp_path)
+    envs = build_courses(['nope', 'nada'], "🔨 Building", jobs=2, clean=True, zip=False, upload=False, clobber=True)
+    assert envs == [None, None]
+    output = capsys.readouterr().out
+    assert "Failed: nope, nada" in output
+    assert "FileNotFoundError" in output
+
+
+def test_startup(tmp_path):
+    """
+    Test that importing kosu, as `kosu --help` does, stays quick: the slow
+    dependencies are only imported by the commands that need them.
+    """
+    slow = ['yaml', 'jinja2', 'requests', 'boto3', 'pkg_resources', 'multiprocessing']
+    code = f"import sys, kosu; print([m for m in {slow} if m in sys.modules])"
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
+
+
+def snapshot(folder):
+    """
+    The modification time and contents of each notebook in a build.
+    """
+    return {p.relative_to(folder).as_posix(): (p.stat().st_mtime_ns, p.read_bytes()) for p in Path(folder).rglob('*.ipynb')}
+
+
+def test_incremental_build(project):
+    """
+    Test that a kept build saves its manifest, that an incremental build
+    leaves unchanged notebooks alone, and that editing one notebook only
+    rebuilds that one.
+    """
+    options = dict(clean=False, zip=False, upload=False, clobber=True)
+    build_course('example_course', **options)
+    assert (MANIFEST_DIR / 'example_course.json').is_file()
+    before = snapshot('build/example_course')
+    assert 'notebooks/Intro_to_NumPy.ipynb' in before
+
+    build_course('example_course', incremental=True, **options)
+    assert snapshot('build/example_course') == before
+
+    notebook = Path('notebooks/Intro_to_NumPy.ipynb')
+    nb = json.loads(notebook.read_text())
+    nb['cells'].append({'cell_type': 'markdown', 'metadata': {}, 'source': ['More about NumPy.']})
+    notebook.write_text(json.dumps(nb))
+    build_course('example_course', incremental=True, **options)
+    after = snapshot('build/example_course')
+    changed = {name for name in before if after[name] != before[name]}
+    assert changed == {'notebooks/Intro_to_NumPy.ipynb', 'master/Intro_to_NumPy.ipynb'}
+
+
+def test_incremental_after_clean(project):
+    """
+    Test that cleaning a kept build forgets it, so that an incremental build
+    afterwards builds the course from scratch.
+    """
+    runner = CliRunner()
+    result = runner.invoke(cli, ['build', 'example_course', '--clobber', '--no-clean', '--no-zip'])
+    assert result.exit_code == 0, result.output
+    assert (MANIFEST_DIR / 'example_course.json').is_file()
+
+    result = runner.invoke(cli, ['clean', 'example_course'])
+    assert result.exit_code == 0, result.output
+    assert not Path('build/example_course').exists()
+    assert not (MANIFEST_DIR / 'example_course.json').exists()
+
+    result = runner.invoke(cli, ['build', 'example_course', '--incremental', '--no-zip'])
+    assert result.exit_code == 0, result.output
+    assert Path('build/example_course/notebooks/Intro_to_NumPy.ipynb').is_file()
+    assert Path('build/example_course/master/Intro_to_NumPy.ipynb').is_file()
+
+
+def test_failed_build(project):
+    """
+    Test that a build that fails part way leaves the last build, or its
+    ZIP, as it was, whether or not it would be cleaned up, and tidies up
+    the tree it was building.
+    """
+    notebook = Path('notebooks/Intro_to_NumPy.ipynb')
+    good = notebook.read_text()
+    for options in [dict(clean=False, zip=False), dict(clean=True, zip=True)]:
+        notebook.write_text(good)
+        build_course('example_course', upload=False, clobber=True, **options)
+        before = snapshot('build/example_course')
+        zipped = Path('example_course.zip').read_bytes() if options['zip'] else None
+        assert before or zipped
+
+        notebook.write_text('{"cells": [')  # Can't be processed.
+        with pytest.raises(Exception):
+            build_course('example_course', upload=False, clobber=True, **options)
+        assert snapshot('build/example_course') == before
+        if zipped:
+            assert Path('example_course.zip').read_bytes() == zipped
+        assert not list(Path('build').glob('.kosu-tmp-*'))
+
+    # A build that would clean up after itself still leaves the last one.
+    notebook.write_text(good)
+    build_course('example_course', clean=False, zip=False, upload=False, clobber=True)
+    before = snapshot('build/example_course')
+    notebook.write_text('{"cells": [')
+    with pytest.raises(Exception):
+        build_course('example_course', clean=True, zip=True, upload=False, clobber=True)
+    assert snapshot('build/example_course') == before
+
+
+def test_data_cache_dir(tmp_path, monkeypatch):
+    """
+    Test that data-cache can be a folder, true for the default, or false.
+    """
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    for value, expected in [(True, tmp_path / 'kosu' / 'data'), (False, None), ('elsewhere', 'elsewhere')]:
+        monkeypatch.setitem(KOSU, 'data-cache', value)
+        assert data_cache_dir() == expected
+    monkeypatch.delitem(KOSU, 'data-cache')
+    assert data_cache_dir() == tmp_path / 'kosu' / 'data'
@@ -0,0 +1,31 @@
+from kosu.manifest import new_manifest, load_manifest, save_manifest, signature, record, fresh, remove_stale
+
+
+def test_manifest(tmp_path, monkeypatch):
+    """
+    Test that outputs are fresh until their inputs change, and stale outputs go.
+    """
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / 'build' / 'course'
+    path.mkdir(parents=True)
+    src = tmp_path / 'in.txt'
+    src.write_text('one')
+
+    manifest = new_manifest({'version': 1})
+    for name in ['out.txt', 'old.txt']:
+        (path / name).write_text('made')
+        record(manifest, name, signature(manifest, [src], option=1))
+    save_manifest('course', manifest)
+
+    manifest = load_manifest('course', {'version': 1})
+    assert fresh(manifest, path, 'out.txt', signature(manifest, [src], option=1))
+    assert not fresh(manifest, path, 'out.txt', signature(manifest, [src], option=2))
+    assert remove_stale(manifest, path) == ['old.txt']
+    assert not (path / 'old.txt').exists()
+
+    src.write_text('two')
+    manifest = load_manifest('course', {'version': 1})
+    assert not fresh(manifest, path, 'out.txt', signature(manifest, [src], option=1))
+
+    # Different settings mean nothing is up to date.
+    assert load_manifest('course', {'version': 2})['outputs'] == {}
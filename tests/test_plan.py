@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from kosu.kosu import cli
+from kosu.plan import new_task, new_item, check_plan, run_plan, describe_plan
+
+
+def test_run_plan():
+    """
+    Test that tasks run in order, each seeing the results before it, and
+    that a task can't come before one it depends on.
+    """
+    tasks = [
+        new_task('one', lambda results, event: 1, items=[new_item('a', size=10), new_item('b', size=5, todo=False)]),
+        new_task('two', lambda results, event: results['one'] + 1, after=['one'], items=[new_item('c', size=None, cached=True)]),
+    ]
+    plan = {'course': 'course', 'tasks': tasks}
+    assert run_plan(plan) == {'one': 1, 'two': 2}
+
+    described = describe_plan(plan)
+    assert 'run' not in described['tasks'][0]
+    assert described['totals'] == {'files': 3, 'todo': 2, 'cached': 1, 'bytes': 10, 'unknown': 1}
+
+    with pytest.raises(Exception, match="comes before one"):
+        check_plan(tasks[::-1])
+
+
+def test_run_plan_threads(capsys):
+    """
+    Test that independent tasks run at the same time without mixing up
+    their output, and that a failure stops the tasks that depend on it.
+    """
+    barrier, ran = threading.Barrier(2, timeout=5), []
+
+    def first(results, event):
+        click.echo('a1', nl=False)
+        barrier.wait()
+        time.sleep(0.05)
+        click.echo('a2')
+
+    def second(results, event):
+        barrier.wait()
+        click.echo('b1', nl=False)
+        click.echo('b2')
+        raise ValueError('b failed')
+
+    tasks = [
+        new_task('a', first),
+        new_task('b', second),
+        new_task('c', lambda results, event: ran.append('c'), after=['b']),
+        new_task('d', lambda results, event: ran.append('d'), after=['a']),
+    ]
+    with pytest.raises(ValueError, match='b failed'):
+        run_plan({'course': 'course', 'tasks': tasks}, threads=4)
+    assert capsys.readouterr().out == 'a1a2\nb1b2\n'
+    assert ran == []
+
+
+def test_plan_command(tmp_path, monkeypatch):
+    """
+    Test that planning a build of the example course finds its files
+    without writing or downloading anything.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    runner = CliRunner()
+    runner.invoke(cli, ['init', '--yes'])
+    result = runner.invoke(cli, ['plan', 'example_course', '--for', 'publish', '--json'])
+    assert result.exit_code == 0, result.output
+
+    plan, = json.loads(result.output)
+    tasks = {task['name']: task for task in plan['tasks']}
+    assert list(tasks)[-4:] == ['zip', 'upload', 'remove', 'clean']
+    assert tasks['remove']['after'] == ['upload']  # The old build stays until the new one is done.
+    assert tasks['notebooks']['todo'] == 4
+    assert tasks['images']['after'] == ['notebooks']
+    assert tasks['data']['unknown'] == 1  # Not downloaded yet, so its size is unknown.
+    assert not Path('build').exists()
+    assert not Path('cache').exists()
@@ -0,0 +1,27 @@
+from kosu.references import find_references, reference_pattern, url_stems
+
+
+def test_find_references():
+    """
+    Test that one scan finds every kind of reference, in order.
+    """
+    text = ("![](../images/a.png) and ../data/b.csv, then "
+            "https://geocomp.s3.amazonaws.com/data/c.las and ../images/d.jpg")
+    refs = find_references(text)
+    assert refs == {'images': ['a.png', 'd.jpg'], 'data_urls': ['https://geocomp.s3.amazonaws.com/data/c.las'], 'data_files': ['b.csv']}
+
+    # Bytes work too, and the references are added to the ones we had.
+    pattern = reference_pattern(binary=True)
+    refs = find_references(text.encode(), pattern, refs=refs, pos=20)
+    assert refs['images'] == ['a.png', 'd.jpg', 'd.jpg']
+    assert refs['data_files'] == ['b.csv', 'b.csv']
+
+
+def test_url_stems():
+    """
+    Test that data URLs can start with other stems, which are not regexes.
+    """
+    pattern = reference_pattern(url_stems(['https://example.com/data/', 'https://x.org/']))
+    assert reference_pattern(url_stems(['https://example.com/data/', 'https://x.org/'])) is pattern
+    text = "https://example.com/data/a.csv https://x.org/b.csv https://xxorg/c.csv https://geocomp.s3.amazonaws.com/data/d.las"
+    assert find_references(text, pattern)['data_urls'] == ['https://example.com/data/a.csv', 'https://x.org/b.csv']
@@ -0,0 +1,65 @@
+import threading
+
+from kosu.kosu import close_pools, handle_request
+from kosu.serve import run_server, send_request
+
+
+def test_send_request(tmp_path, monkeypatch):
+    """
+    Test that a command goes to the server, its output comes back as it is
+    printed, and the client can tell when there is no server.
+    """
+    monkeypatch.chdir(tmp_path)
+    assert send_request({'command': 'test'}) is None
+
+    def handler(message):
+        print(f"Running {message['command']}.")
+        return 3
+
+    server = threading.Thread(target=run_server, args=(handler,))
+    server.start()
+    try:
+        for _ in range(100):
+            if (tmp_path / 'build' / '.kosu.sock').exists():
+                break
+            server.join(0.01)
+        output = []
+        assert send_request({'command': 'test', 'cwd': str(tmp_path)}, write=output.append) == 3
+        assert ''.join(output) == "Running test.\n"
+        assert send_request({'command': 'test', 'cwd': '/elsewhere'}) is None
+    finally:
+        assert send_request({'command': 'stop'}) == 0
+        server.join()
+    assert not (tmp_path / 'build' / '.kosu.sock').exists()
+
+
+def test_handle_request(tmp_path, monkeypatch, capsys):
+    """
+    Test that the server runs commands as the command line would.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('kosu.kosu.SERVING', True)
+    (tmp_path / 'build').mkdir()
+    message = {'command': 'clean', 'params': {'course': None, 'all': True}, 'cwd': str(tmp_path)}
+    assert handle_request(message) == 0
+    assert "Finished." in capsys.readouterr().out
+
+    message = {'command': 'test', 'params': {'course': 'nope'}, 'cwd': str(tmp_path)}
+    assert handle_request(message) == 1
+    assert "No such file or directory: 'nope.yaml'" in capsys.readouterr().out
+
+
+def test_serve_jobs(project, monkeypatch, capsys):
+    """
+    Test that the server can process notebooks in its pool of processes
+    for one request after another.
+    """
+    monkeypatch.setattr('kosu.kosu.SERVING', True)
+    message = {'command': 'build', 'cwd': str(project),
+               'params': {'course': 'example_course', 'jobs': 2, 'clean': False, 'zip': False, 'clobber': True}}
+    try:
+        assert handle_request(message) == 0, capsys.readouterr().out
+        assert handle_request(message) == 0, capsys.readouterr().out
+    finally:
+        close_pools()
+    assert (project / 'build' / 'example_course' / 'master' / 'Intro_to_NumPy.ipynb').exists()
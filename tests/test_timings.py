@@ -0,0 +1,62 @@
+import functools
+import json
+import os
+import pstats
+
+from click.testing import CliRunner
+
+from kosu import cli, map_jobs
+from kosu.timings import PROFILE_FILE, instrument, stage, summarize, timed
+
+
+def test_stages(tmp_path, capsys):
+    """
+    Test that stages are recorded, added up, and saved as a Chrome trace.
+    """
+    trace, profile = tmp_path / 'timings.json', tmp_path / 'kosu.prof'
+    with instrument(trace, profile):
+        for course in ['a', 'b']:
+            with stage('data', course=course) as event:
+                event['items'], event['bytes'] = 2, 1000
+        with stage('zip', course='a'):
+            pass
+    with stage('zip', course='a'):
+        pass  # Not timing any more.
+
+    output = capsys.readouterr().out
+    assert 'data' in output and 'zip' in output
+    assert profile.stat().st_size > 0
+    saved = json.loads(trace.read_text())
+    assert [e['name'] for e in saved['traceEvents']] == ['data', 'data', 'zip']
+    assert saved['traceEvents'][0]['ph'] == 'X'
+    assert saved['traceEvents'][1]['args'] == {'bytes': 1000, 'items': 2, 'course': 'b'}
+    assert [(s['stage'], s['count'], s['items'], s['bytes']) for s in saved['stages']] == [('data', 2, 4, 2000), ('zip', 1, 0, 0)]
+
+
+def test_timed(tmp_path):
+    """
+    Test that notebooks processed in other processes bring their timings back.
+    """
+    tasks = []
+    for i in range(3):
+        (tmp_path / f'{i}.ipynb').write_text('x' * i)
+        tasks.append(dict(infile=tmp_path / f'{i}.ipynb'))
+    results = map_jobs(functools.partial(timed, dict), tasks, jobs=2)
+    assert [result for result, _ in results] == tasks
+
+    events = [event for _, event in results]
+    assert [e['bytes'] for e in events] == [0, 1, 2]
+    assert all(e['pid'] != os.getpid() for e in events)
+    rows = summarize(events)
+    assert rows[0]['stage'] == 'notebook' and rows[0]['count'] == 3
+
+
+def test_profile(project):
+    """
+    Test that profiling a build sees the notebooks being processed, even
+    though the build runs its tasks in other threads.
+    """
+    result = CliRunner().invoke(cli, ['build', 'example_course', '--no-zip', '--clobber', '--profile'])
+    assert result.exit_code == 0, result.output
+    stats = pstats.Stats(str(project / PROFILE_FILE))
+    assert any(name == 'process_notebook' for _, _, name in stats.stats)
@@ -0,0 +1,39 @@
+import os
+
+from kosu.trees import temp_tree, swap_tree, leftovers, remove_trees
+
+
+def test_swap_tree(tmp_path):
+    """
+    Test that a new tree replaces the old one, and the old one can be
+    removed, links and all.
+    """
+    target = tmp_path / 'build' / 'course'
+    (target / 'data').mkdir(parents=True)
+    (target / 'data' / 'old.txt').write_text('old')
+    os.symlink(target / 'data', target / 'link')
+
+    path = temp_tree(target)
+    assert path.name == 'course' and path.parent.parent == target.parent
+    (path / 'new.txt').write_text('new')
+    old = swap_tree(path, target)
+    assert (target / 'new.txt').read_text() == 'new'
+    assert (old / 'data' / 'old.txt').exists()
+
+    remove_trees([old, None, tmp_path / 'nothing'])
+    assert sorted(p.name for p in target.parent.iterdir()) == ['course']
+
+
+def test_leftovers(tmp_path):
+    """
+    Test that the trees left by interrupted builds of a course are found,
+    and only those.
+    """
+    build = tmp_path / 'build'
+    mine, theirs = temp_tree(build / 'course'), temp_tree(build / 'other')
+    trash = build / '.kosu-trash-course-1234'
+    trash.mkdir()
+    assert sorted(leftovers(build, ['course'])) == sorted([mine.parent, trash])
+
+    remove_trees(leftovers(build, ['course']))
+    assert list(build.iterdir()) == [theirs.parent]
@@ -0,0 +1,68 @@
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from kosu.upload import local_etag, upload_zip, upload_zips
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """
+    A stand-in for S3 with an empty bucket.
+    """
+    for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket='kosu-test')
+        yield client
+
+
+@pytest.mark.parametrize('size', [1000, 12 * 1024 * 1024])
+def test_upload_zip(s3, tmp_path, size):
+    """
+    Test that a file is uploaded once, in parts if it is big, and skipped
+    while it is unchanged.
+    """
+    fname = tmp_path / 'course.zip'
+    fname.write_bytes(bytes(range(256)) * (size // 256))
+    chunk_size = 5 * 1024 * 1024  # The smallest part S3 allows.
+    assert upload_zip(fname, 'kosu-test', client=s3, chunk_size=chunk_size) == 'uploaded'
+    assert s3.head_object(Bucket='kosu-test', Key='course.zip')['ETag'] == local_etag(fname, chunk_size)[1]
+    assert upload_zip(fname, 'kosu-test', client=s3, chunk_size=chunk_size) == 'unchanged'
+
+    # A different part size changes the ETag, but the MD5 is still stored.
+    assert upload_zip(fname, 'kosu-test', client=s3, chunk_size=2 * chunk_size) == 'unchanged'
+
+    fname.write_bytes(b'changed')
+    assert upload_zip(fname, 'kosu-test', client=s3, chunk_size=chunk_size) == 'uploaded'
+    assert s3.get_object(Bucket='kosu-test', Key='course.zip')['Body'].read() == b'changed'
+
+
+def test_upload_zips(s3, tmp_path):
+    """
+    Test that several files are uploaded at once over one client.
+    """
+    fnames = [tmp_path / f'course{i}.zip' for i in range(5)]
+    for fname in fnames:
+        fname.write_text(fname.name)
+    done = []
+    results = upload_zips(fnames, 'kosu-test', jobs=3, client=s3, callback=lambda f, r: done.append(f))
+    assert results == ['uploaded'] * 5
+    assert sorted(done) == fnames
+    assert upload_zips(fnames, 'kosu-test', client=s3) == ['unchanged'] * 5
+
+
+def test_upload_zip_from_kosu(s3, tmp_path, monkeypatch):
+    """
+    Test that scripts can still upload with `kosu.kosu.upload_zip()`.
+    """
+    from kosu.kosu import KOSU, upload_zip
+
+    monkeypatch.setitem(KOSU, 's3-bucket', 'kosu-test')
+    fname = tmp_path / 'course.zip'
+    fname.write_text('course')
+    assert upload_zip(fname) is True
+    assert s3.get_object(Bucket='kosu-test', Key='course.zip')['Body'].read() == b'course'
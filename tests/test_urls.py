@@ -0,0 +1,30 @@
+from kosu.urls import check_urls
+
+
+def test_check_urls(server, tmp_path):
+    """
+    Test that URLs are deduplicated, retried, and remembered once found.
+    """
+    server.files['/data/a.csv'] = b'a'
+    server.files['/data/b.csv'] = b'b'
+    server.fail['/data/b.csv'] = 1
+    urls = [f'{server.url}/data/{name}' for name in ['a.csv', 'nope.csv', 'b.csv', 'a.csv']]
+    cache_file = tmp_path / 'urls.json'
+
+    seen = []
+    missing = check_urls(urls, jobs=4, retries=2, cache_file=cache_file, callback=seen.append)
+    assert missing == [f'{server.url}/data/nope.csv']
+    assert sorted(seen) == sorted(set(urls))
+    assert server.requests.count(('HEAD', '/data/a.csv')) == 1
+    assert server.requests.count(('HEAD', '/data/b.csv')) == 2
+
+    # Only the missing URL is checked again.
+    server.requests.clear()
+    missing = check_urls(urls, cache_file=cache_file)
+    assert missing == [f'{server.url}/data/nope.csv']
+    assert server.requests == [('HEAD', '/data/nope.csv')]
+
+    # Unless we don't trust the cache for that long.
+    server.requests.clear()
+    _ = check_urls(urls, cache_file=cache_file, ttl=0)
+    assert len(server.requests) == 3
@@ -0,0 +1,97 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from kosu.kosu import KOSU, build_course, rebuild_course, watch_course
+from kosu.watch import INOTIFY_AVAILABLE, Inotify, Poller, changes
+
+
+@pytest.mark.parametrize('kind', ['inotify', 'poll'])
+def test_watcher(tmp_path, kind):
+    """
+    Test that writing, and deleting, a file in a watched folder is seen.
+    """
+    if kind == 'inotify' and not INOTIFY_AVAILABLE:
+        pytest.skip("No inotify here.")
+    watch = Inotify([tmp_path]) if kind == 'inotify' else Poller([tmp_path], interval=0.01)
+    try:
+        assert watch.wait(timeout=0.05) == set()
+        (tmp_path / 'a.ipynb').write_text('{}')
+        assert tmp_path / 'a.ipynb' in watch.wait(timeout=2)
+        (tmp_path / 'a.ipynb').unlink()
+        assert tmp_path / 'a.ipynb' in watch.wait(timeout=2)
+    finally:
+        watch.close()
+
+
+def test_changes(tmp_path):
+    """
+    Test that a burst of changes comes as one batch.
+    """
+    class Burst:
+        def __init__(self):
+            self.waits = [{tmp_path / 'a'}, {tmp_path / 'b'}, set(), {tmp_path / 'c'}, set()]
+
+        def wait(self, timeout=None):
+            return self.waits.pop(0)
+
+    batches = changes(Burst(), debounce=0)
+    assert next(batches) == {tmp_path / 'a', tmp_path / 'b'}
+    assert next(batches) == {tmp_path / 'c'}
+
+
+def files(folder):
+    """
+    The modification time of each file in a build.
+    """
+    return {p.relative_to(folder).as_posix(): p.stat().st_mtime_ns for p in Path(folder).rglob('*') if p.is_file()}
+
+
+def test_rebuild_course(project):
+    """
+    Test that a change to a notebook only remakes the notebooks and images,
+    and leaves the rest of the build alone.
+    """
+    build_course('example_course', clean=False, zip=False, upload=False, clobber=True)
+    path = Path('build') / 'example_course'
+    made = [KOSU[f'{kind}-target'] + '/' for kind in ['notebooks', 'master', 'demos', 'images']]
+    before = files(path)
+
+    notebook = Path('notebooks') / 'Intro_to_NumPy.ipynb'
+    nb = json.loads(notebook.read_text())
+    nb['cells'].append({'cell_type': 'markdown', 'metadata': {}, 'source': ['More about NumPy.']})
+    notebook.write_text(json.dumps(nb))
+    rebuild_course('example_course', path, {'notebooks'}, made)
+
+    after = files(path)
+    assert set(after) == set(before)
+    changed = {f for f in after if after[f] != before[f]}
+    assert {'notebooks/Intro_to_NumPy.ipynb', 'master/Intro_to_NumPy.ipynb'} <= changed
+    assert all(f.startswith(tuple(made)) for f in changed)
+    assert 'More about NumPy.' in (path / 'master' / 'Intro_to_NumPy.ipynb').read_text()
+
+
+def test_watch_course(project, monkeypatch):
+    """
+    Test that a change to a notebook rebuilds just the notebooks, a change
+    to the course's YAML builds the whole course again, and other changes
+    are ignored.
+    """
+    class Watch:
+        def close(self):
+            pass
+
+    def batches(watch, debounce):
+        yield {Path('notebooks/Intro_to_NumPy.ipynb')}
+        yield {Path('example_course.yaml')}
+        yield {Path('build/example_course/README.md')}
+        raise KeyboardInterrupt
+
+    calls = []
+    monkeypatch.setattr('kosu.kosu.watcher', lambda folders, poll: Watch())
+    monkeypatch.setattr('kosu.kosu.changes', batches)
+    monkeypatch.setattr('kosu.kosu.build_course', lambda course, **options: calls.append(('build', options['incremental'])))
+    monkeypatch.setattr('kosu.kosu.rebuild_course', lambda course, path, kinds, made, jobs: calls.append(('rebuild', kinds)))
+    watch_course('example_course')
+    assert calls == [('build', True), ('rebuild', {'notebooks'}), ('build', True)]